@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+'''
+bench_capture.py
+Capture file write and read throughput against a fully loaded 1 Mbps bus
+Packs and writes frames the way CaptureRecorder does, plain and zlib
+compressed, reads them back, and records a back to back 1 Mbps burst from
+an emulated controller (fakehw) end to end.
+Run from the repository root: python3 benchmarks/bench_capture.py
+'''
+import argparse
+import array
+import os
+import tempfile
+import time
+
+import fakehw
+
+BITRATE = 1000000
+# 8 byte standard frames without stuff bits plus the 3 bit intermission
+BUS_FRAMES_PER_SEC = BITRATE / float(47 + 64 + 3)
+DEFAULT_FRAMES = 200000
+# One block of distinct frames, so compression is not flattered by repeats
+RUN_LENGTH = 4096
+
+
+def columns(n):
+    """One RxRing run of n frames, as CaptureRecorder copies it out."""
+    ids = array.array("I", (0x100 + (i & 0x3F) for i in range(n)))
+    flags = array.array("B", bytes(n))
+    dlcs = array.array("B", [8] * n)
+    timestamps = array.array("q", (i * 110000 for i in range(n)))
+    # Random payloads, so compression is not flattered
+    payload = os.urandom(8 * n)
+    return ids, flags, dlcs, timestamps, payload
+
+
+def bench_write(path, frames, compress):
+    from can_driver.capture import CaptureWriter
+    run = columns(RUN_LENGTH)
+    t0 = time.perf_counter()
+    with CaptureWriter(path, compress=compress) as writer:
+        for _ in range(frames // RUN_LENGTH):
+            writer.write_columns(*run)
+    elapsed = time.perf_counter() - t0
+    n = frames // RUN_LENGTH * RUN_LENGTH
+    return n / elapsed, os.path.getsize(path) / float(n)
+
+
+def bench_read(path):
+    from can_driver.capture import CaptureReader
+    t0 = time.perf_counter()
+    n = sum(1 for _ in CaptureReader(path))
+    return n / (time.perf_counter() - t0)
+
+
+def bench_recorder(controllers, path, seconds):
+    """A back to back 1 Mbps burst recorded end to end."""
+    from can_driver import CAN_1
+    from can_driver.capture import CaptureRecorder
+    bus = CAN_1(rx_ring_size=16384)
+    emulator = controllers[(0, 0)]
+    bus.begin(BITRATE, 16000000)
+    n = int(BUS_FRAMES_PER_SEC * seconds)
+    with CaptureRecorder(bus, path) as recorder:
+        emulator.inject_many((0x100 + (i & 0x3F), i.to_bytes(8, "little")) for i in range(n))
+        time.sleep(seconds + 0.2)
+    stats = recorder.stats()
+    errors = bus.stats()["can"]["error_flags"]
+    bus.cleanup()
+    return n, stats, errors["RX0OVR"] + errors["RX1OVR"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[2])
+    parser.add_argument("--frames", type=int, default=DEFAULT_FRAMES)
+    parser.add_argument("--seconds", type=float, default=1.0, help="length of the recorded burst")
+    args = parser.parse_args()
+    controllers = fakehw.install(bitrate=BITRATE)
+
+    print("1 Mbps bus, 8 byte standard frames: %.0f frames/s" % BUS_FRAMES_PER_SEC)
+    with tempfile.TemporaryDirectory() as tmp:
+        for compress in (False, True):
+            path = os.path.join(tmp, "bench%d.cancap" % compress)
+            fps, per_frame = bench_write(path, args.frames, compress)
+            read_fps = bench_read(path)
+            print("%-10s write %8.0f frames/s (%4.1fx bus)  %5.1f bytes/frame  read %8.0f frames/s"
+                  % ("zlib" if compress else "plain", fps, fps / BUS_FRAMES_PER_SEC,
+                     per_frame, read_fps))
+
+        n, stats, overflows = bench_recorder(controllers, os.path.join(tmp, "burst.cancap"), args.seconds)
+        # Offered minus recorded is the loss, a controller overflow stands
+        # for one or more frames lost while both RX buffers were full
+        print("recorder   %d frames offered, %d recorded, %d lost (%.1f%%): %d in the receive "
+              "ring, %d controller overflows"
+              % (n, stats["recorded"], n - stats["recorded"], 100.0 * (n - stats["recorded"]) / n,
+                 stats["ring_lost"], overflows))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+'''
+bench_dbc.py
+Batch DBC decoding against decoding frame by frame
+Decodes the same mixed batch of J1939 style frames once with
+Database.decode_columns() and once with Message.decode() per frame, and
+reports frames per second of both. Needs numpy.
+Run from the repository root: python3 benchmarks/bench_dbc.py
+'''
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import numpy as np
+
+from can_driver.dbc import parse_dbc
+
+DEFAULT_FRAMES = 100000
+DBC = '''
+BO_ 2364540158 EEC1: 8 Engine
+ SG_ EngineTorqueMode : 0|4@1+ (1,0) [0|15] "" Vector__XXX
+ SG_ DriverDemandTorque : 8|8@1+ (1,-125) [-125|125] "%" Vector__XXX
+ SG_ ActualEngineTorque : 16|8@1+ (1,-125) [-125|125] "%" Vector__XXX
+ SG_ EngineSpeed : 24|16@1+ (0.125,0) [0|8031.875] "rpm" Vector__XXX
+ SG_ SourceAddress : 40|8@1+ (1,0) [0|255] "" Vector__XXX
+
+BO_ 2566844926 CCVS1: 8 Body
+ SG_ ParkingBrake : 2|2@1+ (1,0) [0|3] "" Vector__XXX
+ SG_ WheelSpeed : 8|16@1+ (0.00390625,0) [0|250.996] "km/h" Vector__XXX
+ SG_ CruiseActive : 24|2@1+ (1,0) [0|3] "" Vector__XXX
+
+BO_ 291 Status: 8 Gateway
+ SG_ Mode M : 0|8@1+ (1,0) [0|255] "" Vector__XXX
+ SG_ Voltage m1 : 15|16@0+ (0.001,0) [0|65.535] "V" Vector__XXX
+ SG_ Current m1 : 31|16@0- (0.01,0) [-327.68|327.67] "A" Vector__XXX
+ SG_ Temperature m2 : 15|12@0- (0.1,-40) [-40|160] "degC" Vector__XXX
+'''
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[2])
+    parser.add_argument("--frames", type=int, default=DEFAULT_FRAMES)
+    args = parser.parse_args()
+
+    db = parse_dbc(DBC)
+    rng = np.random.default_rng(1)
+    known = np.array(sorted(db.messages), np.uint32)
+    ids = known[rng.integers(0, len(known), args.frames)]
+    rows = rng.integers(0, 256, (args.frames, 8), dtype=np.uint8)
+    rows[ids == 291, 0] = rng.integers(1, 3, int((ids == 291).sum()))
+    payload = rows.tobytes()
+
+    t0 = time.perf_counter()
+    decoded = db.decode_columns(ids, payload)
+    batch = time.perf_counter() - t0
+    signals = sum(len(columns) - 1 for columns in decoded.values())
+
+    id_list = ids.tolist()
+    t0 = time.perf_counter()
+    for n, can_id in enumerate(id_list):
+        db.decode(can_id, payload[n * 8:n * 8 + 8])
+    single = time.perf_counter() - t0
+
+    print("%d frames, %d messages, %d signal columns" % (args.frames, len(decoded), signals))
+    print("decode_columns  %10.0f frames/s  %7.1f ms" % (args.frames / batch, batch * 1e3))
+    print("per frame       %10.0f frames/s  %7.1f ms  (%.0fx slower)"
+          % (args.frames / single, single * 1e3, single / batch))
+
+
+if __name__ == "__main__":
+    main()
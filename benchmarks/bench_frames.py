@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+'''
+bench_frames.py
+Microbenchmark of CanMsg construction cost and memory footprint
+Run from the repository root: python3 benchmarks/bench_frames.py
+'''
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from can_driver.can import CanMsg, CAN_EFF_FLAG
+
+N_FRAMES = 100000
+RAW_ID = 0x18FEF100 | CAN_EFF_FLAG
+# A READ RX BUFFER response, header followed by 8 data bytes
+RX_BUFFER = [0xC7, 0xEB, 0xF1, 0x00, 0x08, 1, 2, 3, 4, 5, 6, 7, 8]
+
+
+def from_rx_buffer():
+    return CanMsg._from_raw(RAW_ID, bytes(RX_BUFFER[5:13]))
+
+
+def from_user():
+    return CanMsg(0x18FEF100, b"\x01\x02\x03\x04\x05\x06\x07\x08", CAN_EFF_FLAG)
+
+
+def bench(name, fn):
+    per_frame = min(timeit.repeat(fn, number=N_FRAMES, repeat=5)) / N_FRAMES
+
+    tracemalloc.start()
+    frames = [fn() for _ in range(N_FRAMES)]
+    used, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del frames
+
+    print("%-16s %6.2f us/frame  %6.1f MB per %d buffered frames"
+          % (name, per_frame * 1e6, used / 1e6, N_FRAMES))
+
+
+if __name__ == "__main__":
+    bench("from RX buffer", from_rx_buffer)
+    bench("CanMsg(...)", from_user)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+'''
+bench_isotp.py
+ISO-TP transfer throughput in loopback mode
+Two sessions on one emulated controller in loopback mode (fakehw) talk to
+each other: every frame the sender puts on the bus comes back to the
+receiving session, whose flow control frames come back to the sender.
+Compares pipelined consecutive frames against waiting for every frame
+before sending the next, as hand-written segmentation does, and reports
+the payload rate against what the bus can carry.
+Run from the repository root: python3 benchmarks/bench_isotp.py
+'''
+import argparse
+import os
+import threading
+import time
+
+import fakehw
+
+DEFAULT_BITRATE = 500000
+DEFAULT_SIZE = 4095
+DEFAULT_ROUNDS = 10
+INT_PIN = 25
+# See bench_replay.py, stands in for the controller clock with --int
+TICK = 0.0002
+# 8 byte standard frame without stuff bits plus the 3 bit intermission
+FRAME_BITS = 47 + 64 + 3
+
+
+def ticker(controllers, stop):
+    while not stop.is_set():
+        for emulator in list(controllers.values()):
+            emulator.poll()
+        time.sleep(TICK)
+
+
+def run(bus, size, rounds, **options):
+    from can_driver import CanError
+    from can_driver.isotp import IsoTpStack
+    payload = os.urandom(size)
+    rx_options = {"block_size": options.pop("block_size", 0),
+                  "stmin": options.pop("stmin", 0), "max_length": size}
+    with IsoTpStack(bus) as stack:
+        sender = stack.open(0x7E0, 0x7E8, **options)
+        receiver = stack.open(0x7E8, 0x7E0, **rx_options)
+        ok = 0
+        t0 = time.perf_counter()
+        for _ in range(rounds):
+            if sender.send(payload) == CanError.ERROR_OK:
+                view = receiver.recv(1.0)
+                ok += view is not None and view == payload
+        elapsed = time.perf_counter() - t0
+        errors = receiver.stats()["rx_errors"]
+    return ok, errors, size * ok / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[2])
+    parser.add_argument("--bitrate", type=int, default=DEFAULT_BITRATE)
+    parser.add_argument("--size", type=int, default=DEFAULT_SIZE, help="message length in bytes")
+    parser.add_argument("--rounds", type=int, default=DEFAULT_ROUNDS)
+    parser.add_argument("--int", action="store_true", help="interrupt driven instead of polled")
+    args = parser.parse_args()
+    controllers = fakehw.install(bitrate=args.bitrate,
+                                 int_pins={(0, 0): INT_PIN} if args.int else None)
+    stop = threading.Event()
+    if args.int:
+        threading.Thread(target=ticker, args=(controllers, stop), daemon=True).start()
+
+    from can_driver import CAN_1
+    bus = CAN_1(int_pin=INT_PIN if args.int else None)
+    bus.begin(args.bitrate, 16000000, 'loopback')
+    # 7 payload bytes per consecutive frame, flow control not counted
+    bus_rate = args.bitrate / float(FRAME_BITS) * 7
+    print("%d byte messages at %d bit/s, the bus carries %.1f kB/s of payload"
+          % (args.size, args.bitrate, bus_rate / 1e3))
+    cases = (
+        ("frame by frame", {"tx_depth": 1}),
+        ("pipelined", {}),
+        ("pipelined BS=8", {"block_size": 8}),
+        ("STmin 1 ms", {"stmin": 0.001}),
+    )
+    for name, options in cases:
+        ok, errors, rate = run(bus, args.size, args.rounds, **options)
+        print("%-16s %6.1f kB/s  %3.0f%% of the bus  %d/%d received, %d aborted"
+              % (name, rate / 1e3, 100 * rate / bus_rate, ok, args.rounds, errors))
+    stop.set()
+    bus.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+'''
+bench_multibus.py
+Total throughput of two 500 kbps controllers on CE0/CE1 of SPI0
+Both buses receive frames at --rate and then send --frames each, once
+serviced by one CanGroup thread and once by a thread per bus. With --int
+the controllers drive INT pins, otherwise both buses are polled.
+spidev and RPi.GPIO are replaced by fakehw, see bench_suite.py
+Run from the repository root: python3 benchmarks/bench_multibus.py [--int]
+'''
+import argparse
+import threading
+import time
+
+import fakehw
+
+BITRATE = 500000
+DEFAULT_FRAMES = 2000
+# Frames per second offered to each bus, about two thirds of the 500 kbps
+# bus with 8 byte standard frames
+DEFAULT_RATE = 3000
+CE_PINS = (8, 7)
+INT_PINS = {(0, 0): 25, (0, 1): 24}
+# How often the emulated controllers look at the bus when nothing talks
+# to them over SPI, drives the INT edges
+TICK = 0.0002
+
+
+class Ticker(threading.Thread):
+    def __init__(self, emulators):
+        super().__init__(daemon=True)
+        self.emulators = emulators
+        self.running = True
+
+    def run(self):
+        while self.running:
+            for emulator in self.emulators:
+                emulator.poll()
+            time.sleep(TICK)
+
+
+def start(buses, shared):
+    from can_driver import CanGroup
+    if shared:
+        return CanGroup(buses)
+    for bus in buses:
+        bus._start_io()
+    return None
+
+
+def stop(buses, group):
+    if group is not None:
+        group.close()
+    for bus in buses:
+        bus._stop_io()
+
+
+def bench_rx(buses, emulators, args, shared):
+    for i, emulator in enumerate(emulators):
+        emulator.inject_many(
+            ((0x100 + i, n.to_bytes(8, "little")) for n in range(args.frames)), args.rate
+        )
+    received = [0] * len(buses)
+    # Rates are over the time the frames took to arrive
+    elapsed = float(args.frames) / args.rate
+    deadline = time.monotonic() + elapsed + 0.5
+    while sum(received) < args.frames * len(buses) and time.monotonic() < deadline:
+        for i, bus in enumerate(buses):
+            received[i] += len(bus.recv_many(timeout=0.01)[1])
+    return received, elapsed
+
+
+def bench_tx(buses, emulators, args, shared):
+    from can_driver import CanError, CanMsg
+    t0 = time.monotonic()
+    handles = [
+        (i, bus.send(CanMsg(0x200 + i, n.to_bytes(8, "little"))))
+        for n in range(args.frames) for i, bus in enumerate(buses)
+    ]
+    sent = [0] * len(buses)
+    for i, handle in handles:
+        if handle.wait() and handle.error == CanError.ERROR_OK:
+            sent[i] += 1
+    elapsed = time.monotonic() - t0
+    return sent, elapsed
+
+
+def run(name, buses, emulators, args, shared):
+    for bus in buses:
+        bus.begin(BITRATE, 16000000)
+    for emulator in emulators:
+        emulator.reset_stats()
+    group = start(buses, shared)
+    for label, fn in (("rx", bench_rx), ("tx", bench_tx)):
+        frames, elapsed = fn(buses, emulators, args, shared)
+        print("%-8s %s  %s  total %6.0f frames/s  missing %d"
+              % (name, label,
+                 "  ".join("bus%d %6.0f/s" % (i, n / elapsed) for i, n in enumerate(frames)),
+                 sum(frames) / elapsed, args.frames * len(buses) - sum(frames)))
+        for emulator in emulators:
+            emulator.reset_stats()
+    stop(buses, group)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[2])
+    parser.add_argument("--frames", type=int, default=DEFAULT_FRAMES, help="frames per bus")
+    parser.add_argument("--rate", type=float, default=DEFAULT_RATE,
+                        help="received frames per second and bus")
+    parser.add_argument("--int", action="store_true", help="wire the INT pins")
+    args = parser.parse_args()
+
+    controllers = fakehw.install(bitrate=BITRATE, int_pins=INT_PINS if args.int else None)
+    from can_driver import CAN_1
+    buses = [
+        CAN_1(spi=0, spics=pin, int_pin=INT_PINS[(0, device)] if args.int else None)
+        for device, pin in enumerate(CE_PINS)
+    ]
+    emulators = [controllers[(0, device)] for device in range(len(CE_PINS))]
+    ticker = Ticker(emulators)
+    if args.int:
+        ticker.start()
+
+    run("group", buses, emulators, args, shared=True)
+    run("threads", buses, emulators, args, shared=False)
+
+    ticker.running = False
+    for bus in buses:
+        bus.cleanup()
+
+
+if __name__ == "__main__":
+    main()
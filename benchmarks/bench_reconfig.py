@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+'''
+bench_reconfig.py
+Time the controller spends off the bus while masks and filters change,
+init_mask()/init_filter() one by one against a single configure()
+Run from the repository root: python3 benchmarks/bench_reconfig.py
+'''
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from can_driver import CAN_1, CAN_SPEED
+from can_driver.constants import ERROR
+
+ROUNDS = 20
+MASKS = [(False, 0x7FF), (True, 0x1FFFFF00)]
+FILTERS = [(False, 0x100), (False, 0x200), (True, 0x18FEF100),
+           (True, 0x18FEF200), (True, 0x18FEF300), (True, 0x18FEF400)]
+
+
+def one_by_one(can):
+    for n, (ext, mask) in enumerate(MASKS):
+        # init_mask() numbers the masks from -1
+        can.init_mask(n - 1, ext, mask)
+    for ft, (ext, value) in enumerate(FILTERS):
+        can.init_filter(ft, ext, value)
+
+
+def batched(can):
+    can.configure(masks=MASKS, filters=FILTERS, mode='normal')
+
+
+def main():
+    can = CAN_1()
+    if can.begin(CAN_SPEED.CAN_500KBPS) != ERROR.ERROR_OK:
+        print("CAN init failed")
+        return
+
+    for name, fn in (("init_mask/filter", one_by_one), ("configure", batched)):
+        best = None
+        for _ in range(ROUNDS):
+            start = time.perf_counter()
+            fn(can)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print("%-18s %7.3f ms" % (name, best * 1e3))
+    print("configure() off the bus for %.3f ms" % (can.can.config_downtime_ns / 1e6))
+    can.cleanup()
+
+
+if __name__ == "__main__":
+    main()
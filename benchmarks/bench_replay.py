@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+'''
+bench_replay.py
+Replay timing accuracy and saturation throughput against an emulated bus
+Replays generated traffic at a fixed frame gap and reports how far the
+frames were loaded from their due time, then sends back to back in
+saturate mode and compares the achieved frame rate with what the bus can
+carry. Uses the emulated controller of fakehw.
+Run from the repository root: python3 benchmarks/bench_replay.py
+'''
+import argparse
+import threading
+import time
+
+import fakehw
+
+BITRATE = 500000
+# 8 byte standard frames without stuff bits plus the 3 bit intermission
+BUS_FRAMES_PER_SEC = BITRATE / float(47 + 64 + 3)
+INT_PIN = 25
+# Period of the thread that stands in for the controller clock. The
+# emulator only advances when it is talked to, with --int nothing talks
+# to it while the I/O thread waits for INT
+TICK = 0.0002
+
+
+def ticker(controllers, stop):
+    """Polls the emulators as they get opened, until stop is set."""
+    while not stop.is_set():
+        for emulator in list(controllers.values()):
+            emulator.poll()
+        time.sleep(TICK)
+
+
+def run(saturate, frames, gap, rate, int_pin):
+    from can_driver import CAN_1
+    from can_driver.replay import SWITCH_INTERVAL, Replayer, generate_frames
+    bus = CAN_1(int_pin=int_pin)
+    bus.begin(BITRATE, 16000000)
+    records = generate_frames(frames, can_id="i", dlc=8, data="i", gap=gap, seed=1)
+    try:
+        return Replayer(bus, records, rate=rate, saturate=saturate,
+                        switch_interval=SWITCH_INTERVAL).run()
+    finally:
+        bus.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[2])
+    parser.add_argument("--frames", type=int, default=2000)
+    parser.add_argument("--gap", type=float, default=0.001, help="seconds between replayed frames")
+    parser.add_argument("--rate", type=float, default=1.0, help="replay speed factor")
+    parser.add_argument("--int", action="store_true", help="interrupt driven instead of polled")
+    args = parser.parse_args()
+    int_pin = INT_PIN if args.int else None
+    controllers = fakehw.install(bitrate=BITRATE, int_pins={(0, 0): INT_PIN} if args.int else None)
+    stop = threading.Event()
+
+    if args.int:
+        threading.Thread(target=ticker, args=(controllers, stop), daemon=True).start()
+
+    result = run(False, args.frames, args.gap, args.rate, int_pin)
+    print("scheduled  %d frames every %.0f us: %.0f frames/s, error p50 %.0f us  "
+          "p99 %.0f us  max %.0f us, %d dropped"
+          % (result["frames"], args.gap / args.rate * 1e6, result["frames_per_sec"],
+             result["error_p50_us"], result["error_p99_us"], result["error_max_us"],
+             result["dropped"]))
+    result = run(True, args.frames, 0.0, 1.0, int_pin)
+    print("saturate   %d frames: %.0f frames/s (%.0f%% of the %.0f frames/s bus), %d dropped"
+          % (result["frames"], result["frames_per_sec"],
+             100 * result["frames_per_sec"] / BUS_FRAMES_PER_SEC, BUS_FRAMES_PER_SEC,
+             result["dropped"]))
+    stop.set()
+
+
+if __name__ == "__main__":
+    main()
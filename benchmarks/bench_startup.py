@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+'''
+bench_startup.py
+Cold start time of CAN_1.begin(), broken down by phase
+Run from the repository root: python3 benchmarks/bench_startup.py
+'''
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from can_driver import CAN_1, CAN_SPEED
+from can_driver.constants import ERROR
+
+ROUNDS = 20
+PHASES = ("reset", "filters", "bit_timing", "mode", "total")
+
+
+def main():
+    can = CAN_1()
+    runs = []
+    for _ in range(ROUNDS):
+        if can.begin(CAN_SPEED.CAN_500KBPS) != ERROR.ERROR_OK:
+            print("CAN init failed")
+            return
+        runs.append(can.startup_timing())
+
+    print("%-12s %8s %8s" % ("phase", "min ms", "max ms"))
+    for phase in PHASES:
+        values = [run[phase] for run in runs]
+        print("%-12s %8.3f %8.3f" % (phase, min(values), max(values)))
+    can.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+'''
+bench_stats.py
+Overhead of the always-on counters behind CAN_1.stats()
+Runs the receive and transmit paths on emulated hardware with no syscall
+or SPI clocking cost, the worst case for relative overhead, once as
+shipped and once with rpi_spi.SPI.transaction() replaced by a copy
+without counters. The per-frame CAN counters are timed on their own.
+Run from the repository root: python3 benchmarks/bench_stats.py
+'''
+import time
+import timeit
+
+import fakehw
+
+ROUNDS = 5
+N_FRAMES = 5000
+
+
+def uncounted_transaction(self, tx):
+    # rpi_spi.SPI.transaction() without the counter updates
+    with self._bus_lock:
+        if self._SPICS is None:
+            return self._SPI.xfer2(list(tx))
+        GPIO.output(self._SPICS, GPIO.LOW)
+        rx = self._SPI.xfer2(list(tx))
+        GPIO.output(self._SPICS, GPIO.HIGH)
+        return rx
+
+
+def rx_tx_loop(bus, emulator, frames):
+    start = time.perf_counter()
+    for msg in frames:
+        emulator.inject(msg.can_id, msg.data)
+        bus.can.readMessage_()
+        bus.can.sendMessage(msg, 0)
+    return (time.perf_counter() - start) / len(frames)
+
+
+def main():
+    controllers = fakehw.install(syscall_cost=0.0, spi_clocking=False)
+    global GPIO
+    from can_driver import CAN_1, CanMsg, CAN_SPEED
+    from can_driver import rpi_spi
+    GPIO = rpi_spi.GPIO
+
+    bus = CAN_1()
+    emulator = next(iter(controllers.values()))
+    bus.begin(CAN_SPEED.CAN_500KBPS)
+    frames = [CanMsg(0x123, i.to_bytes(8, "little")) for i in range(N_FRAMES)]
+
+    counted = rpi_spi.SPI.transaction
+    best = {}
+    for _ in range(ROUNDS):
+        for name, fn in (("counted", counted), ("uncounted", uncounted_transaction)):
+            rpi_spi.SPI.transaction = fn
+            per_frame = rx_tx_loop(bus, emulator, frames)
+            best[name] = min(best.get(name, per_frame), per_frame)
+    rpi_spi.SPI.transaction = counted
+    spi_cost = best["counted"] - best["uncounted"]
+    print("RX+TX per frame: %.2f us with counters, %.2f us without, SPI counters %+.2f%%"
+          % (best["counted"] * 1e6, best["uncounted"] * 1e6, spi_cost / best["uncounted"] * 100))
+
+    # One rx_frames and one tx_frames increment per frame
+    can = bus.can
+    per_frame = min(timeit.repeat(
+        "can.rx_frames[0] += 1; can.tx_frames[0] += 1", globals=locals(), number=100000
+    )) / 100000
+    print("CAN counters per frame: %.3f us, %.2f%% of a frame"
+          % (per_frame * 1e6, per_frame / best["counted"] * 100))
+
+    snapshot = min(timeit.repeat(bus.stats, number=1000)) / 1000
+    print("stats() snapshot: %.1f us" % (snapshot * 1e6))
+    bus.cleanup()
+
+
+if __name__ == "__main__":
+    main()
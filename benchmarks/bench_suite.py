@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+'''
+bench_suite.py
+Throughput and latency of the driver hot paths against emulated hardware
+spidev and RPi.GPIO are replaced by fakehw, so the numbers measure the
+driver and the SPI traffic it causes, not the bus. Results are written
+as JSON and can be checked against an earlier run:
+
+    python3 benchmarks/bench_suite.py --out results.json
+    python3 benchmarks/bench_suite.py --baseline results.json
+
+Exits with status 1 if a gated metric is worse than the baseline by more
+than the tolerance
+'''
+import argparse
+import json
+import platform
+import sys
+import time
+
+import fakehw
+
+DEFAULT_FRAMES = 2000
+STARTUP_ROUNDS = 20
+RESET_ROUNDS = 5
+# Frame rate offered to the I/O thread, two RX buffers drained every
+# RX_POLL_INTERVAL keep up with it
+RX_RATE = 1000
+DEFAULT_TOLERANCE = 0.10
+# Metrics compared against a baseline and whether higher is better. The
+# tail latencies and drops follow the scheduler jitter of the machine,
+# they are reported but too noisy to gate on.
+GATED_METRICS = {
+    "frames_per_sec": True,
+    "transactions_per_frame": False,
+    "bytes_per_frame": False,
+    "p50_us": False,
+    "startup_ms": False,
+    "transactions": False,
+}
+
+
+def percentiles(samples_ns):
+    """p50/p99/p999 of a list of durations in ns, reported in us."""
+    samples = sorted(samples_ns)
+    if not samples:
+        return {}
+    pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))] / 1e3
+    return {"p50_us": pick(0.5), "p99_us": pick(0.99), "p999_us": pick(0.999)}
+
+
+def per_frame(emulator, start, n_frames, elapsed):
+    """Throughput and SPI traffic since start=(transactions, bytes)."""
+    return {
+        "frames_per_sec": n_frames / elapsed,
+        "transactions_per_frame": (emulator.transactions - start[0]) / n_frames,
+        "bytes_per_frame": (emulator.bytes - start[1]) / n_frames,
+    }
+
+
+def counters(emulator):
+    return emulator.transactions, emulator.bytes
+
+
+def bench_startup(bus, emulator, args):
+    times = []
+    start = counters(emulator)
+    for _ in range(STARTUP_ROUNDS):
+        t = time.perf_counter_ns()
+        bus.begin(args.bitrate, args.clock)
+        times.append(time.perf_counter_ns() - t)
+    times.sort()
+    return {
+        "startup_ms": times[len(times) // 2] / 1e6,
+        "transactions": (emulator.transactions - start[0]) / STARTUP_ROUNDS,
+    }
+
+
+def bench_reset(bus, emulator, args):
+    times = []
+    start = counters(emulator)
+    for _ in range(RESET_ROUNDS):
+        t = time.perf_counter_ns()
+        bus.can.reset()
+        times.append(time.perf_counter_ns() - t)
+    times.sort()
+    bus.begin(args.bitrate, args.clock)
+    return {
+        "startup_ms": times[len(times) // 2] / 1e6,
+        "transactions": (emulator.transactions - start[0]) / RESET_ROUNDS,
+    }
+
+
+def bench_send(bus, emulator, args):
+    """CAN_1.send() without an I/O thread, each call loads and starts the frame."""
+    from can_driver import CanMsg
+    bus.begin(args.bitrate, args.clock)
+    frames = [CanMsg(0x100 + (i & 0xFF), i.to_bytes(8, "little")) for i in range(args.frames)]
+    samples = []
+    start = counters(emulator)
+    t0 = time.perf_counter_ns()
+    for msg in frames:
+        t = time.perf_counter_ns()
+        handle = bus.send(msg)
+        samples.append(time.perf_counter_ns() - t)
+    handle.wait()
+    elapsed = (time.perf_counter_ns() - t0) / 1e9
+    result = per_frame(emulator, start, args.frames, elapsed)
+    result.update(percentiles(samples))
+    return result
+
+
+def bench_send_io(bus, emulator, args):
+    """send() with the I/O thread, latency is send() to TXnIF seen."""
+    from can_driver import CanMsg
+    bus.begin(args.bitrate, args.clock)
+    bus._start_io()
+    frames = [CanMsg(0x100 + (i & 0xFF), i.to_bytes(8, "little")) for i in range(args.frames)]
+    start = counters(emulator)
+    t0 = time.perf_counter_ns()
+    handles = [bus.send(msg) for msg in frames]
+    for handle in handles:
+        handle.wait()
+    elapsed = (time.perf_counter_ns() - t0) / 1e9
+    bus._stop_io()
+    result = per_frame(emulator, start, args.frames, elapsed)
+    result.update(percentiles([handle.latency_ns for handle in handles]))
+    return result
+
+
+def bench_read_message(bus, emulator, args):
+    """CAN.readMessage_() with one frame waiting."""
+    bus.begin(args.bitrate, args.clock)
+    samples = []
+    start = counters(emulator)
+    t0 = time.perf_counter_ns()
+    for i in range(args.frames):
+        emulator.inject(0x123, i.to_bytes(8, "little"))
+        t = time.perf_counter_ns()
+        bus.can.readMessage_()
+        samples.append(time.perf_counter_ns() - t)
+    elapsed = (time.perf_counter_ns() - t0) / 1e9
+    result = per_frame(emulator, start, args.frames, elapsed)
+    result.update(percentiles(samples))
+    return result
+
+
+def bench_recv(bus, emulator, args):
+    """CAN_1.recv() polling the controller, one frame waiting."""
+    bus.begin(args.bitrate, args.clock)
+    samples = []
+    start = counters(emulator)
+    t0 = time.perf_counter_ns()
+    for i in range(args.frames):
+        emulator.inject(0x123, i.to_bytes(8, "little"))
+        t = time.perf_counter_ns()
+        bus.recv()
+        samples.append(time.perf_counter_ns() - t)
+    elapsed = (time.perf_counter_ns() - t0) / 1e9
+    result = per_frame(emulator, start, args.frames, elapsed)
+    result.update(percentiles(samples))
+    return result
+
+
+def bench_drain(bus, emulator, args):
+    """CAN_1.recv_many() with both RX buffers full, latency per call."""
+    bus.begin(args.bitrate, args.clock)
+    samples = []
+    received = 0
+    start = counters(emulator)
+    t0 = time.perf_counter_ns()
+    for i in range(args.frames // 2):
+        emulator.inject(0x123, i.to_bytes(8, "little"))
+        emulator.inject(0x124, i.to_bytes(8, "little"))
+        emulator.poll()
+        t = time.perf_counter_ns()
+        _, msgs = bus.recv_many()
+        samples.append(time.perf_counter_ns() - t)
+        received += len(msgs)
+    elapsed = (time.perf_counter_ns() - t0) / 1e9
+    result = per_frame(emulator, start, max(received, 1), elapsed)
+    result.update(percentiles(samples))
+    return result
+
+
+def bench_rx_io(bus, emulator, args):
+    """Frames arriving at RX_RATE, latency is bus arrival to the RX ring."""
+    bus.begin(args.bitrate, args.clock)
+    bus._start_io()
+    t0 = time.monotonic() + 0.01
+    arrival = [t0 + i / float(RX_RATE) for i in range(args.frames)]
+    for i, at in enumerate(arrival):
+        emulator.inject(0x123, i.to_bytes(8, "little"), at)
+    start = counters(emulator)
+    msgs = []
+    deadline = arrival[-1] + 0.5
+    while len(msgs) < args.frames and time.monotonic() < deadline:
+        msgs.extend(bus.recv_many(timeout=0.05)[1])
+    elapsed = arrival[-1] - t0 + 1.0 / RX_RATE
+    bus._stop_io()
+    samples = [
+        msg.timestamp - int(arrival[int.from_bytes(msg.data, "little")] * 1e9)
+        for msg in msgs
+    ]
+    result = per_frame(emulator, start, max(len(msgs), 1), elapsed)
+    result.update(percentiles(samples))
+    result["dropped"] = args.frames - len(msgs)
+    return result
+
+
+BENCHMARKS = (
+    ("startup", bench_startup),
+    ("reset", bench_reset),
+    ("tx_send", bench_send),
+    ("tx_send_io_thread", bench_send_io),
+    ("rx_read_message", bench_read_message),
+    ("rx_recv", bench_recv),
+    ("rx_drain", bench_drain),
+    ("rx_io_thread", bench_rx_io),
+)
+
+
+def compare(results, baseline, tolerance):
+    """Print the change against a baseline run.
+
+    Returns:
+        List of (benchmark, metric, baseline, current) that regressed
+    """
+    regressions = []
+    for name, metrics in results.items():
+        old = baseline.get(name, {})
+        for metric, value in sorted(metrics.items()):
+            if metric not in old:
+                continue
+            before = old[metric]
+            change = (value - before) / before if before else 0.0
+            higher_is_better = GATED_METRICS.get(metric)
+            worse = higher_is_better is not None and (
+                change < -tolerance if higher_is_better else change > tolerance
+            )
+            if worse:
+                regressions.append((name, metric, before, value))
+            print("  %-20s %-24s %12.2f -> %12.2f %+7.1f%%%s"
+                  % (name, metric, before, value, change * 100, "  REGRESSION" if worse else ""))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[2])
+    parser.add_argument("--frames", type=int, default=DEFAULT_FRAMES)
+    parser.add_argument("--syscall-us", type=float, default=fakehw.DEFAULT_SYSCALL_COST * 1e6,
+                        help="cost of every SPI transfer and GPIO call")
+    parser.add_argument("--only", action="append", help="run only these benchmarks")
+    parser.add_argument("--out", help="write results as JSON to this file")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="allowed relative change of gated metrics")
+    args = parser.parse_args()
+
+    controllers = fakehw.install(args.syscall_us / 1e6)
+    from can_driver import CAN_1, __version__
+    from can_driver.constants import CAN_CLOCK, CAN_SPEED
+    args.bitrate = CAN_SPEED.CAN_500KBPS
+    args.clock = CAN_CLOCK.MCP_16MHZ
+
+    bus = CAN_1()
+    emulator = next(iter(controllers.values()))
+    results = {}
+    for name, fn in BENCHMARKS:
+        if args.only and name not in args.only:
+            continue
+        results[name] = fn(bus, emulator, args)
+        print("%-20s %s" % (name, "  ".join(
+            "%s=%.2f" % item for item in sorted(results[name].items()))))
+    bus.cleanup()
+
+    report = {
+        "version": __version__,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "params": {"frames": args.frames, "syscall_us": args.syscall_us, "rx_rate": RX_RATE},
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": results,
+    }
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print("against %s (%s)" % (args.baseline, baseline.get("version")))
+        regressions = compare(results, baseline["results"], args.tolerance)
+        if regressions:
+            print("%d regressions" % len(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+'''
+bench_timeseries.py
+Time-series store ingest rate and windowed query latency
+Fills a TimeSeriesStore with a minute of traffic from 64 cyclic IDs and
+times "last N seconds of one ID" queries against scanning a list of
+CanMsg objects, the way dashboards answered them before. Needs numpy.
+Run from the repository root: python3 benchmarks/bench_timeseries.py
+'''
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from can_driver import CanMsg
+from can_driver.timeseries import TimeSeriesStore
+
+IDS = 64
+# Bus load of the simulated minute, 8 byte frames
+FRAMES_PER_SEC = 4000
+QUERIES = 200
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[2])
+    parser.add_argument("--seconds", type=int, default=60, help="length of the simulated traffic")
+    parser.add_argument("--window", type=float, default=5.0, help="seconds per query")
+    args = parser.parse_args()
+
+    n = args.seconds * FRAMES_PER_SEC
+    step = 1000000000 // FRAMES_PER_SEC
+    msgs = [
+        CanMsg._from_raw(0x18FEF100 + i % IDS | 0x80000000, (i).to_bytes(8, "little"), i * step)
+        for i in range(n)
+    ]
+    store = TimeSeriesStore()
+    t0 = time.perf_counter()
+    for start in range(0, n, 64):
+        store.add_messages(msgs[start:start + 64])
+    ingest = time.perf_counter() - t0
+
+    target = 0x98FEF100 + 7
+    now = n * step
+    window = int(args.window * 1e9)
+    t0 = time.perf_counter()
+    for _ in range(QUERIES):
+        found = store.last(target, args.window, now_ns=now)
+    query = (time.perf_counter() - t0) / QUERIES
+
+    t0 = time.perf_counter()
+    for _ in range(max(QUERIES // 20, 1)):
+        scanned = [msg for msg in msgs if msg.raw_id == target and msg.timestamp > now - window]
+    scan = (time.perf_counter() - t0) / max(QUERIES // 20, 1)
+
+    stats = store.stats()
+    print("%d frames of %d IDs, ingest %.0f frames/s, %.1f MiB"
+          % (n, IDS, n / ingest, stats["bytes"] / 1048576.0))
+    print("last %.0f s of one ID (%d frames): store %.1f us, list scan %.1f ms (%.0fx)"
+          % (args.window, len(found.timestamps), query * 1e6, scan * 1e3, scan / query))
+    assert len(scanned) == len(found.timestamps)
+
+
+if __name__ == "__main__":
+    main()
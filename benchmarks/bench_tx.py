@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+'''
+bench_tx.py
+Throughput, queueing delay and send latency of the TX scheduler on a real MCP2515
+The controller runs in loopback mode, so no other node is needed
+Run from the repository root: python3 benchmarks/bench_tx.py [int_pin]
+'''
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from can_driver import CAN_1, CAN_SPEED, CanMsg
+from can_driver.constants import ERROR
+
+N_FRAMES = 5000
+# Every 8th frame uses a high priority ID
+URGENT_ID = 0x010
+BULK_ID = 0x400
+
+
+def main():
+    int_pin = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    can = CAN_1(int_pin=int_pin)
+    if can.begin(CAN_SPEED.CAN_500KBPS, mode='loopback') != ERROR.ERROR_OK:
+        print("CAN init failed")
+        return
+    if int_pin is None:
+        can._start_io()
+
+    done = threading.Event()
+    remaining = [N_FRAMES]
+
+    def on_sent(error):
+        remaining[0] -= 1
+        if remaining[0] == 0:
+            done.set()
+
+    frames = [
+        CanMsg(URGENT_ID if i % 8 == 0 else BULK_ID, i.to_bytes(8, "little"))
+        for i in range(N_FRAMES)
+    ]
+    start = time.perf_counter()
+    for msg in frames:
+        can.submit(msg, on_sent)
+    done.wait()
+    elapsed = time.perf_counter() - start
+
+    sched = can.tx_scheduler
+    print("%d frames in %.3f s, %.0f frames/s" % (N_FRAMES, elapsed, N_FRAMES / elapsed))
+    print("queue delay mean %.2f ms, max %.2f ms"
+          % (sched.total_queue_delay_ns / sched.loaded / 1e6, sched.max_queue_delay_ns / 1e6))
+    print("send latency mean %.2f ms, max %.2f ms, %d failed"
+          % (sched.total_latency_ns / max(sched.sent, 1) / 1e6, sched.max_latency_ns / 1e6,
+             sched.failed))
+
+    # One frame at a time shows the latency without queueing
+    latencies = []
+    for i in range(200):
+        handle = can.send(CanMsg(URGENT_ID, i.to_bytes(2, "little")))
+        handle.wait()
+        latencies.append(handle.latency_ns)
+    latencies.sort()
+    print("single frame latency median %.3f ms, max %.3f ms"
+          % (latencies[len(latencies) // 2] / 1e6, latencies[-1] / 1e6))
+    can.cleanup()
+
+
+if __name__ == "__main__":
+    main()
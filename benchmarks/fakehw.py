@@ -0,0 +1,121 @@
+'''
+fakehw.py
+Stand-ins for the spidev and RPi.GPIO modules backed by MCP2515Emulator
+install() has to run before can_driver is imported. Every SpiDev.open()
+then talks to its own emulated controller, and every xfer2() or GPIO call
+busy-waits for a fixed syscall cost plus the SPI clocking time, so the
+whole driver stack including rpi_spi.SPI runs as it would on a Pi
+'''
+import os
+import sys
+import time
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# Kernel round trip of one spidev ioctl or GPIO write on a Raspberry Pi 4
+DEFAULT_SYSCALL_COST = 15e-6
+# Fast enough that the simulated bus never limits the driver
+UNLIMITED_BITRATE = 10 ** 9
+
+
+def _spin(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def install(syscall_cost=DEFAULT_SYSCALL_COST, bitrate=UNLIMITED_BITRATE, spi_clocking=True,
+            int_pins=None):
+    """Register fake spidev and RPi.GPIO modules in sys.modules.
+
+    Args:
+        syscall_cost: Seconds added to every SPI transfer and GPIO call
+        bitrate: Bus bitrate of the emulated controllers
+        spi_clocking: Add the time to clock the bytes out at the SPI
+            speed the driver sets
+        int_pins: Dict of (bus, device) -> GPIO pin wired to the INT
+            output of that controller. Its level follows the emulator,
+            edges only happen on SPI transactions and emulator.poll()
+
+    Returns:
+        Dict of (bus, device) -> MCP2515Emulator, filled as devices are
+        opened. Emulators use time.monotonic, the clock of CanMsg
+        timestamps.
+    """
+    controllers = {}
+    int_pins = int_pins or {}
+    int_controller = {pin: key for key, pin in int_pins.items()}
+    edge_callbacks = {}
+
+    class SpiDev:
+        def __init__(self):
+            self.max_speed_hz = 500000
+            self.mode = 0
+            self.lsbfirst = False
+            self.emulator = None
+
+        def open(self, bus, device):
+            key = (bus, device)
+            if key not in controllers:
+                pin = int_pins.get(key)
+                on_interrupt = None
+                if pin is not None:
+                    on_interrupt = lambda: edge_callbacks.get(pin, lambda pin: None)(pin)
+                controllers[key] = MCP2515Emulator(
+                    bitrate=bitrate, clock=time.monotonic, on_interrupt=on_interrupt
+                )
+            self.emulator = controllers[key]
+
+        def close(self):
+            self.emulator = None
+
+        def xfer2(self, tx):
+            _spin(syscall_cost + (8.0 * len(tx) / self.max_speed_hz if spi_clocking else 0.0))
+            return self.emulator.transaction(tx)
+
+    spidev = types.ModuleType("spidev")
+    spidev.SpiDev = SpiDev
+
+    gpio = types.ModuleType("RPi.GPIO")
+    gpio.BCM = 11
+    gpio.OUT = 0
+    gpio.IN = 1
+    gpio.LOW = 0
+    gpio.HIGH = 1
+    gpio.FALLING = 32
+    gpio.PUD_UP = 22
+    levels = {}
+
+    def output(pin, value):
+        _spin(syscall_cost)
+        levels[pin] = value
+
+    def input(pin):
+        _spin(syscall_cost)
+        if pin in int_controller:
+            emulator = controllers.get(int_controller[pin])
+            return gpio.LOW if emulator is not None and emulator.interrupt else gpio.HIGH
+        return levels.get(pin, gpio.HIGH)
+
+    def add_event_detect(pin, edge, callback=None):
+        edge_callbacks[pin] = callback
+
+    def remove_event_detect(pin):
+        edge_callbacks.pop(pin, None)
+
+    gpio.output = output
+    gpio.input = input
+    gpio.add_event_detect = add_event_detect
+    gpio.remove_event_detect = remove_event_detect
+    for name in ("setwarnings", "setmode", "setup", "cleanup"):
+        setattr(gpio, name, lambda *args, **kwargs: None)
+
+    rpi = types.ModuleType("RPi")
+    rpi.GPIO = gpio
+    sys.modules["spidev"] = spidev
+    sys.modules["RPi"] = rpi
+    sys.modules["RPi.GPIO"] = gpio
+    # Only now, so rpi_spi picks up the fake modules
+    from can_driver.emulator import MCP2515Emulator
+    return controllers
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+'''
+stress_threads.py
+Concurrent RX, TX and configuration threads on one controller
+A receiver drains frames with recv_many(), a sender sends with send() and
+waits for completion, and a third thread reads stats(), checks the
+shadow registers and writes CANINTE, all without an I/O thread. The
+emulated controller sits behind a fake SPI that stretches every
+transaction and reports transactions that overlap, which is what
+interleaved CS-low/transfer/CS-high sequences would look like on the wire.
+Run from the repository root: python3 benchmarks/stress_threads.py
+Exits with status 1 if any check fails. --no-locks runs the same with the
+controller locks replaced by no-ops, to show what they prevent.
+'''
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from can_driver import CAN_1, CanError, CanMsg, MCP2515Emulator
+
+DEFAULT_FRAMES = 2000
+# Time every transaction keeps the fake CS low, long enough for another
+# thread to get scheduled in the middle of it
+HOLD = 20e-6
+
+
+class CheckedSPI:
+    """Passes transactions to an emulator and counts overlapping ones."""
+
+    def __init__(self, emulator):
+        self.emulator = emulator
+        self.active = 0
+        self.overlaps = 0
+        self._count = threading.Lock()
+
+    def transaction(self, tx):
+        with self._count:
+            self.active += 1
+            if self.active > 1:
+                self.overlaps += 1
+        end = time.perf_counter() + HOLD
+        while time.perf_counter() < end:
+            time.sleep(0)
+        rx = self.emulator.transaction(tx)
+        with self._count:
+            self.active -= 1
+        return rx
+
+    def cleanup(self):
+        pass
+
+
+class NoLock:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+    acquire = release = lambda self, *args: True
+
+
+def receiver(bus, emulator, n_frames, result):
+    """Injects two frames at a time and drains until both arrived."""
+    received = []
+    for n in range(0, n_frames, 2):
+        emulator.inject(0x100, n.to_bytes(4, "little"))
+        emulator.inject(0x101, (n + 1).to_bytes(4, "little"))
+        deadline = time.monotonic() + 1.0
+        got = 0
+        while got < 2 and time.monotonic() < deadline:
+            _, msgs = bus.recv_many(timeout=0.01)
+            received.extend(int.from_bytes(msg.data, "little") for msg in msgs)
+            got += len(msgs)
+    result["received"] = received
+
+
+def sender(bus, n_frames, result):
+    """Sends bursts of three frames, each burst fills all TX buffers."""
+    errors = 0
+    for n in range(0, n_frames, 3):
+        handles = [
+            bus.send(CanMsg(0x200, (n + i).to_bytes(4, "little")))
+            for i in range(min(3, n_frames - n))
+        ]
+        for handle in handles:
+            if not handle.wait(1.0) or handle.error != CanError.ERROR_OK:
+                errors += 1
+    result["tx_errors"] = errors
+
+
+def configurer(bus, stop, result):
+    """Snapshots, shadow checks and register writes while traffic flows."""
+    mismatches = 0
+    rounds = 0
+    while not stop.is_set():
+        bus.stats()
+        with bus._lock:
+            mismatches += len(bus.can.verifyShadow())
+        # A register the RX and TX paths leave alone, no mode change so
+        # no frame is lost
+        bus.can.setTXInterrupts(rounds % 2 == 0)
+        rounds += 1
+        time.sleep(0.005)
+    result["shadow_mismatches"] = mismatches
+    result["config_rounds"] = rounds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[2])
+    parser.add_argument("--frames", type=int, default=DEFAULT_FRAMES)
+    parser.add_argument("--no-locks", action="store_true")
+    args = parser.parse_args()
+
+    emulator = MCP2515Emulator(bitrate=1000000, clock=time.monotonic)
+    spi = CheckedSPI(emulator)
+    bus = CAN_1(spi_interface=spi, shadow=True)
+    if bus.begin(1000000, 16000000) != CanError.ERROR_OK:
+        print("begin failed")
+        sys.exit(1)
+    if args.no_locks:
+        bus.can._spi_lock = bus.can.rx_lock = bus.can.tx_lock = NoLock()
+
+    result = {}
+    stop = threading.Event()
+    threads = [
+        threading.Thread(target=receiver, args=(bus, emulator, args.frames, result)),
+        threading.Thread(target=sender, args=(bus, args.frames, result)),
+    ]
+    config = threading.Thread(target=configurer, args=(bus, stop, result))
+    t0 = time.monotonic()
+    for thread in threads + [config]:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stop.set()
+    config.join()
+    elapsed = time.monotonic() - t0
+
+    sent = [int.from_bytes(data, "little") for _, _, data in emulator.tx_log]
+    checks = {
+        "no overlapping transactions": spi.overlaps == 0,
+        "every frame received once in order": result["received"] == list(range(args.frames)),
+        "every frame sent": result["tx_errors"] == 0 and sent == list(range(args.frames)),
+        "shadow registers match the device": result["shadow_mismatches"] == 0,
+    }
+    print("%d frames each way in %.2f s, %d configuration rounds, %d transactions"
+          % (args.frames, elapsed, result["config_rounds"], emulator.transactions))
+    print("overlaps %d  received %d  tx errors %d  shadow mismatches %d"
+          % (spi.overlaps, len(result["received"]), result["tx_errors"],
+             result["shadow_mismatches"]))
+    for name, ok in checks.items():
+        print("%-36s %s" % (name, "ok" if ok else "FAILED"))
+    bus.cleanup()
+    if not all(checks.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,13 +7,51 @@ Modified by: Yui Nguyen
 Date: March 16th, 2025
 CAN_1 Class Adapter for Raspberry Pi 4
 '''
+import logging
+import threading
+import time
+
 from .constants import (
     CAN_CLOCK,
     CAN_SPEED,
+    CANCTRL_REQOP_MODE,
+    CANINTF,
+    DLC_MASK,
     ERROR,
+    MCP_DATA,
+    MCP_DLC,
+    RXF,
+    SPI_CE_PINS,
 )
-from .can import CANFrame, CAN_EFF_FLAG, CAN_RTR_FLAG
-from .rpi_spi import SPI
+from .can import CanMsg, CAN_EFF_FLAG, CAN_RTR_FLAG
+from .filters import plan_filters
+from .ring import RxRing
+from .rpi_spi import GPIO, SPI
+from .txsched import TxScheduler
+
+# How long the I/O thread sleeps between INT level checks when no edge
+# arrives, bounds the shutdown time and recovers from a missed edge
+INT_IDLE_TIMEOUT = 0.1
+# Poll interval of recv(timeout=...) and of the I/O thread when no interrupt
+# pin is used
+RX_POLL_INTERVAL = 0.001
+# How long a polling I/O thread keeps polling back to back after the last
+# frame. At 1 Mbps frames arrive every ~115 us, the two RX buffers would
+# overflow long before a sleep of RX_POLL_INTERVAL ends.
+RX_BUSY_POLL = 0.002
+# Frames buffered between the I/O thread and recv()
+RX_RING_SIZE = 1024
+# Frames read per I/O thread pass before queued TX messages get a turn
+RX_DRAIN_BATCH = 32
+# Operation modes accepted by begin() and configure()
+MODES = {
+    'normal': CANCTRL_REQOP_MODE.CANCTRL_REQOP_NORMAL,
+    'loopback': CANCTRL_REQOP_MODE.CANCTRL_REQOP_LOOPBACK,
+    'listen': CANCTRL_REQOP_MODE.CANCTRL_REQOP_LISTENONLY,
+    'config': CANCTRL_REQOP_MODE.CANCTRL_REQOP_CONFIG,
+}
+
+logger = logging.getLogger(__name__)
 
 class CanError:
     ERROR_OK = ERROR.ERROR_OK
@@ -23,84 +61,183 @@ class CanMsgFlag:
     RTR = CAN_RTR_FLAG
     EFF = CAN_EFF_FLAG
 
-class CanMsg:
-    def __init__(self, can_id=0, data=None, flags=None):
-        if flags:
-            self.frame = CANFrame(can_id | flags, data)
-        else:
-            self.frame = CANFrame(can_id, data)
-        self.is_remote_frame = self.frame.is_remote_frame
-        self.is_extended_id = self.frame.is_extended_id
-        self.can_id = self.frame.arbitration_id
-        self.data = self.frame.data
-        self.dlc = self.frame.dlc
-        
-    def _set_frame(self, frame):
-        self.frame = frame
-        self.is_remote_frame = self.frame.is_remote_frame
-        self.is_extended_id = self.frame.is_extended_id
-        self.can_id = self.frame.arbitration_id
-        self.data = self.frame.data
-        self.dlc = self.frame.dlc
-        
-    def _get_frame(self):
-        return self.frame
+class _Exclusive:
+    """Holds both the RX and the TX path of a controller, RX first."""
+    def __init__(self, can):
+        self.can = can
+
+    def __enter__(self):
+        self.can.rx_lock.acquire()
+        self.can.tx_lock.acquire()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.can.tx_lock.release()
+        self.can.rx_lock.release()
 
 class CAN_1:
     ERROR = ERROR
-    def __init__(self, board="RaspberryPi4", spi=0, spics=8):
+    def __init__(self, board="RaspberryPi4", spi=0, spics=8, int_pin=None,
+                 rx_ring_size=RX_RING_SIZE, rx_policy=RxRing.OVERWRITE_OLDEST,
+                 shadow=False, spi_interface=None):
         """Initialize CAN_1 interface for Raspberry Pi 4.
         
         Args:
             board: Board name (default: "RaspberryPi4")
             spi: SPI bus number (default: 0)
             spics: SPI chip select GPIO pin (default: 8 for CE0)
+            int_pin: GPIO pin wired to the MCP2515 INT output (BCM numbering),
+                enables interrupt driven receive (default: None, polling)
+            rx_ring_size: Frames buffered for recv() by the I/O thread
+            rx_policy: RxRing.OVERWRITE_OLDEST or RxRing.DROP_NEWEST, what
+                happens to new frames while the ring is full
+            shadow: Keep a copy of the configuration registers, so reads
+                of them and writes that change nothing skip the SPI bus
+                (default: False)
+            spi_interface: Object with the transaction() interface of
+                rpi_spi.SPI used instead of the SPI bus, for example an
+                emulator.MCP2515Emulator, spi and spics are then ignored
+                (default: None)
         """
         self.can = None
         self.board = board
         self.spi_bus = spi
         self.spics = spics
+        self.int_pin = int_pin
+        self.canclock = CAN_CLOCK.MCP_8MHZ
+        # Frames received by the I/O thread, guarded by _rx_ready
+        self.rx_ring = RxRing(rx_ring_size, rx_policy)
+        self._rx_ready = threading.Condition(threading.Lock())
+        self._on_message = None
+        # Exceptions raised by on_message, logged and counted so the I/O
+        # thread keeps running
+        self.callback_errors = 0
+        # Exact second stage behind the hardware filters, see set_id_filter()
+        self.id_filter = None
+        self.rx_filtered = 0
+        self._irq = threading.Event()
+        self._io_thread = None
+        self._running = False
+        # CanGroup whose thread services this controller, see group.py
+        self._io_group = None
         # Initialize the SPI interface
-        # For SPI0, CE0 ...not sure why its configured as device=1 for CE0,
-        # but just note that it may not be very intuitive
-        spi_interface = SPI(cs=spics, bus=spi, device=1)
+        # A hardware CE pin is left to spidev so each instruction is one
+        # kernel transfer. Any other pin is driven as a GPIO chip select,
+        # with the kernel CS parked on the last CE line of the bus, which
+        # must then not carry a controller of its own.
+        if int_pin is not None and GPIO is None:
+            raise ImportError("int_pin needs the RPi.GPIO package")
+        if spi_interface is None:
+            device = SPI_CE_PINS.get(spi, {}).get(spics)
+            if device is not None:
+                spi_interface = SPI(cs=None, bus=spi, device=device)
+            else:
+                parked = max(SPI_CE_PINS.get(spi, {1: 1}).values())
+                spi_interface = SPI(cs=spics, bus=spi, device=parked)
         # Initialize the CAN controller
         from .mcp2515 import CAN
-        self.can = CAN(spi_interface)
+        self.can = CAN(spi_interface, shadow)
+        # Every instruction is atomic, the RX and TX paths each hold their
+        # own lock of the controller only for their instruction sequence,
+        # configuration holds both
+        self._lock = _Exclusive(self.can)
+        # Frames queued by submit() for the I/O thread
+        self.tx_scheduler = TxScheduler(self.can)
         
-    def begin(self, bitrate=CAN_SPEED.CAN_250KBPS, canclock=CAN_CLOCK.MCP_8MHZ, mode='normal'):
+    def begin(self, bitrate=CAN_SPEED.CAN_250KBPS, canclock=CAN_CLOCK.MCP_8MHZ, mode='normal',
+              one_shot=False):
         """Initialize the CAN bus with the specified settings.
         
         Args:
-            bitrate: CAN bus bitrate (default: 250kbps)
-            canclock: MCP2515 crystal frequency (default: 8MHz)
+            bitrate: CAN_SPEED value or bitrate in bit/s (default: 250kbps)
+            canclock: CAN_CLOCK value or crystal frequency in Hz (default: 8MHz)
             mode: CAN operation mode (default: 'normal')
+            one_shot: Try every frame only once, so arbitration loss and
+                bus errors fail its TxHandle instead of being retried
+                (default: False)
             
         Returns:
-            ERROR_OK on success, otherwise error code
+            ERROR_OK on success, otherwise error code, the time spent in
+            each startup phase is in startup_timing()
         """
-        ret = self.can.reset()
-        if ret != ERROR.ERROR_OK:
-            print("Reset Error")
-            return ret
-            
-        ret = self.can.setBitrate(bitrate, canclock)
+        group, on_message = self._io_group, self._on_message
+        self._stop_io()
+        self.canclock = canclock
+        if mode not in MODES:
+            return ERROR.ERROR_FAIL
+
+        with self._lock:
+            ret = self.can.coldStart(bitrate, canclock, MODES[mode], one_shot)
+            self.tx_scheduler.reset()
         if ret != ERROR.ERROR_OK:
-            print("Set Bit Rate Error")
+            print("Begin Error")
             return ret
-        
-        # Set the CAN operation mode
-        if mode == 'normal':
-            ret = self.can.setNormalMode()
-        elif mode == 'loopback':
-            ret = self.can.setLoopbackMode()
-        elif mode == 'listen':
-            ret = self.can.setListenOnlyMode()
-        elif mode == 'config':
-            ret = self.can.setConfigMode()
+
+        if group is not None:
+            group.add(self, on_message)
+        elif self.int_pin is not None:
+            self._start_io()
         
         return ret
         
+    def startup_timing(self):
+        """Report how long the last begin() spent in each phase.
+        
+        Returns:
+            Dict of phase name -> milliseconds for reset, filters,
+            bit_timing, mode and total
+        """
+        return {
+            phase: ns / 1e6 for phase, ns in self.can.startup_timing.items()
+        }
+
+    def stats(self, reset=False):
+        """Snapshot of the driver counters.
+
+        EFLG is read once so that error flags currently set are counted.
+        All counters are copied while the I/O thread is held off, so the
+        snapshot is consistent.
+
+        Args:
+            reset: Zero the counters after taking the snapshot
+                (default: False)
+
+        Returns:
+            Dict with "spi" (see rpi_spi.SPI.stats()), "can" (see
+            mcp2515.CAN.getStats()), "tx" (see TxScheduler.stats()),
+            "rx" with received, dropped and overwritten frames of the
+            receive ring, frames buffered, frames removed by the
+            software ID filter and exceptions raised by on_message
+            callbacks, and "timestamp_ns"
+        """
+        spi = self.can.SPI
+        with self._lock, self._rx_ready:
+            self.can.getErrorFlags()
+            snapshot = {
+                "spi": spi.stats() if hasattr(spi, "stats") else {},
+                "can": self.can.getStats(),
+                "tx": self.tx_scheduler.stats(),
+                "rx": {
+                    "received": self.rx_ring.received,
+                    "dropped": self.rx_ring.dropped,
+                    "overwritten": self.rx_ring.overwritten,
+                    "buffered": len(self.rx_ring),
+                    "filtered": self.rx_filtered,
+                    "callback_errors": self.callback_errors,
+                },
+                "timestamp_ns": time.monotonic_ns(),
+            }
+            if reset:
+                if hasattr(spi, "reset_stats"):
+                    spi.reset_stats()
+                self.can.resetStats()
+                self.tx_scheduler.reset_stats()
+                self.rx_ring.received = 0
+                self.rx_ring.dropped = 0
+                self.rx_ring.overwritten = 0
+                self.rx_filtered = 0
+                self.callback_errors = 0
+        return snapshot
+
     def init_mask(self, mask, is_ext_id, mask_id):
         """Set CAN bus receive mask.
         
@@ -112,11 +249,12 @@ class CAN_1:
         Returns:
             ERROR_OK on success, otherwise error code
         """
-        ret = self.can.setFilterMask(mask + 1, is_ext_id, mask_id)
-        if ret != ERROR.ERROR_OK:
-            return ret
-            
-        ret = self.can.setNormalMode()
+        with self._lock:
+            ret = self.can.setFilterMask(mask + 1, is_ext_id, mask_id)
+            if ret != ERROR.ERROR_OK:
+                return ret
+                
+            ret = self.can.setNormalMode()
         return ret
         
     def init_filter(self, ft, is_ext_id, filter_id):
@@ -130,47 +268,403 @@ class CAN_1:
         Returns:
             ERROR_OK on success, otherwise error code
         """
-        ret = self.can.setFilter(ft, is_ext_id, filter_id)
-        if ret != ERROR.ERROR_OK:
-            return ret
+        with self._lock:
+            ret = self.can.setFilter(ft, is_ext_id, filter_id)
+            if ret != ERROR.ERROR_OK:
+                return ret
+                
+            ret = self.can.setNormalMode()
+        return ret
+        
+    def configure(self, bitrate=None, clock=None, masks=None, filters=None, mode=None):
+        """Change bitrate, masks, filters and mode in one step.
+        
+        Unlike a sequence of init_mask()/init_filter() calls, which leave
+        and re-enter normal mode for every register, the controller enters
+        configuration mode once, the registers are written in three burst
+        writes and the target mode is requested once. The time spent off
+        the bus is kept in self.can.config_downtime_ns.
+        
+        Args:
+            bitrate: CAN_SPEED value or bitrate in bit/s, None keeps the
+                current one
+            clock: MCP2515 crystal frequency (default: the one given to begin())
+            masks: List of up to 2 (is_ext_id, mask_id) for mask 0 and 1,
+                None keeps the masks
+            filters: List of up to 6 (is_ext_id, filter_id) from filter 0
+                on, None keeps the filters
+            mode: 'normal', 'loopback', 'listen' or 'config', None stays in
+                the current mode
             
-        ret = self.can.setNormalMode()
+        Returns:
+            ERROR_OK on success, otherwise error code
+        """
+        if mode is not None and mode not in MODES:
+            return ERROR.ERROR_FAIL
+        if clock is None:
+            clock = self.canclock
+        with self._lock:
+            ret = self.can.configure(
+                bitrate, clock, masks, filters, None if mode is None else MODES[mode]
+            )
+        if ret == ERROR.ERROR_OK:
+            self.canclock = clock
         return ret
+
+    def set_id_filter(self, std_ids=(), ext_ids=()):
+        """Receive only the given CAN IDs.
+        
+        Programs the masks and filters that let the fewest other IDs
+        through, see plan_filters(), and drops the rest in software with
+        a hash set lookup. Without any IDs everything is received again.
+        The operation mode is restored afterwards.
         
+        Args:
+            std_ids: 11 bit IDs, ints and/or range objects
+            ext_ids: 29 bit IDs, ints and/or range objects
+            
+        Returns:
+            Tuple with (error_code, FilterPlan or None), the plan reports
+            the expected hardware pass-through ratio
+        """
+        plan = plan_filters(std_ids, ext_ids)
+        if plan is None:
+            # Open filters as after CAN.reset()
+            masks = [(True, 0), (True, 0)]
+            filters = [(ft == RXF.RXF1, 0) for ft in range(6)]
+        else:
+            masks = [(True, mask) for mask in plan.masks]
+            filters = plan.filters
+
+        with self._lock:
+            self.id_filter = None
+            ret = self.configure(masks=masks, filters=filters)
+            if ret == ERROR.ERROR_OK and plan is not None and not plan.exact:
+                self.id_filter = plan.ids
+        return ret, plan
+
+    def _wanted(self, can_id):
+        if self.id_filter is None or can_id in self.id_filter:
+            return True
+        self.rx_filtered += 1
+        return False
+
     def checkReceive(self):
         """Check if any messages are available for reception.
         
         Returns:
             True if messages are available, False otherwise
         """
+        if self._io_thread is not None:
+            return len(self.rx_ring) > 0
         return self.can.checkReceive()
         
-    def recv(self):
+    def recv(self, timeout=None):
         """Receive a CAN message.
         
+        With an interrupt pin the message is taken from the ring filled by
+        the I/O thread, and timeout=None blocks until one arrives. When
+        polling, timeout=None checks the controller once as before.
+        
+        Args:
+            timeout: Seconds to wait for a message (default: None)
+            
         Returns:
             Tuple with (error_code, CanMsg object)
         """
-        error, frame = self.can.readMessage()
-        msg = CanMsg()
-        if frame:  # Only set the frame if it's not None
-            msg._set_frame(frame)
+        if self._io_thread is not None:
+            with self._rx_ready:
+                if not self._rx_ready.wait_for(self.rx_ring.__len__, timeout):
+                    return ERROR.ERROR_NOMSG, CanMsg()
+                can_id, data, timestamp = self.rx_ring.pop()
+            return ERROR.ERROR_OK, CanMsg._from_raw(can_id, data, timestamp)
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            error, msg = self.can.readMessage()
+            filtered = error == ERROR.ERROR_OK and not self._wanted(msg.raw_id)
+            if filtered:
+                error, msg = ERROR.ERROR_NOMSG, None
+            elif error != ERROR.ERROR_NOMSG or deadline is None:
+                break
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            if not filtered:
+                time.sleep(RX_POLL_INTERVAL)
+
+        if msg is None:
+            msg = CanMsg()
         return error, msg
         
-    def send(self, msg):
+    def recv_many(self, max_frames=RX_DRAIN_BATCH, timeout=None):
+        """Receive up to max_frames CAN messages at once.
+        
+        Returns as soon as at least one message is available. Without an
+        I/O thread both RX buffers are drained with one READ STATUS per
+        pass, see CAN.drain().
+        
+        Args:
+            max_frames: Maximum number of messages to return
+            timeout: Seconds to wait for the first message, None waits
+                forever with an interrupt pin and not at all when polling
+                (default: None)
+            
+        Returns:
+            Tuple with (error_code, list of CanMsg objects, oldest first)
+        """
+        if self._io_thread is not None:
+            msgs = []
+            with self._rx_ready:
+                if not self._rx_ready.wait_for(self.rx_ring.__len__, timeout):
+                    return ERROR.ERROR_NOMSG, msgs
+                while len(msgs) < max_frames:
+                    frame = self.rx_ring.pop()
+                    if frame is None:
+                        break
+                    msgs.append(CanMsg._from_raw(*frame))
+            return ERROR.ERROR_OK, msgs
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            msgs = self.can.drain(max_frames)
+            received = len(msgs)
+            if msgs and self.id_filter is not None:
+                msgs = [msg for msg in msgs if self._wanted(msg.raw_id)]
+            if msgs or time.monotonic() >= (deadline or 0):
+                break
+            if not received:
+                time.sleep(RX_POLL_INTERVAL)
+        return (ERROR.ERROR_OK if msgs else ERROR.ERROR_NOMSG), msgs
+
+    def send(self, msg, priority=None):
         """Send a CAN message.
         
+        The message is queued for the TX buffers and the returned handle
+        completes once the controller reports it on the bus (TXnIF), see
+        TxHandle. Queued messages are sent in CAN ID priority order, or by
+        the explicit priority. Without a running I/O thread the message is
+        loaded right away and TxHandle.wait() polls for the completion.
+        
         Args:
             msg: CanMsg object
+            priority: Lower values are sent first (default: None, by CAN ID)
             
         Returns:
-            ERROR_OK on success, otherwise error code
+            TxHandle, handle.wait() then handle.error is ERROR_OK once sent
+        """
+        if self._io_thread is not None:
+            handle = self.tx_scheduler.push(msg, priority)
+            self._irq.set()
+            return handle
+        handle = self.tx_scheduler.push(msg, priority, poll=self._poll_tx)
+        self._poll_tx()
+        return handle
+
+    def submit(self, msg, callback=None, priority=None):
+        """Send a CAN message and report the result through a callback.
+        
+        Args:
+            msg: CanMsg object
+            callback: Called with the error code once the message was sent
+                or failed, from the I/O thread (default: None)
+            priority: Lower values are sent first (default: None, by CAN ID)
+            
+        Returns:
+            TxHandle of the message
+        """
+        handle = self.send(msg, priority)
+        if callback is not None:
+            handle.add_done_callback(lambda h: callback(h.error))
+        return handle
+
+    def _poll_tx(self):
+        with self.can.tx_lock:
+            self.tx_scheduler.service(self.can.getStatus())
+
+    def _start_io(self, on_message=None):
+        """Start the background thread that services the controller.
+        
+        With an interrupt pin the thread sleeps until INT is asserted,
+        otherwise it polls every RX_POLL_INTERVAL.
+        
+        Args:
+            on_message: Called from the I/O thread for every received
+                message instead of queueing it for recv(), exceptions are
+                logged and counted in stats() (default: None)
+        """
+        self._stop_io(cancel_tx=False)
+        self._attach_io(on_message, threading.Event())
+        self._running = True
+        self._io_thread = threading.Thread(
+            target=self._io_loop, name="can-io", daemon=True
+        )
+        self._io_thread.start()
+
+    def _attach_consumer(self, on_message):
+        """Hand every received message to on_message from the I/O thread.
+
+        A running I/O thread, the bus's own or that of its CanGroup, keeps
+        running with on_message as its new consumer, otherwise a thread is
+        started. Consumers must detach in the reverse order of attaching.
+
+        Args:
+            on_message: Called from the I/O thread for every received
+                message, see _start_io()
+
+        Returns:
+            State to pass to _detach_consumer()
+        """
+        started = self._io_thread is None
+        previous = self._on_message
+        if started:
+            self._start_io(on_message)
+        else:
+            self._on_message = on_message
+        return started, previous
+
+    def _detach_consumer(self, state):
+        """Undo _attach_consumer(), queued frames are kept.
+
+        Messages go to the previous consumer or recv() again, an I/O
+        thread started by _attach_consumer() is stopped.
+
+        Args:
+            state: Return value of _attach_consumer()
+        """
+        started, previous = state
+        if started:
+            self._stop_io(cancel_tx=False)
+        else:
+            self._on_message = previous
+
+    def _stop_io(self, cancel_tx=True):
+        if self._io_group is not None:
+            self._io_group.remove(self, cancel_tx)
+            return
+        if self._io_thread is None:
+            return
+        self._running = False
+        self._irq.set()
+        self._io_thread.join()
+        self._io_thread = None
+        self._detach_io(cancel_tx)
+
+    def _attach_io(self, on_message, irq):
+        """Prepare for servicing by an I/O thread that waits on irq.
+
+        irq is set by the INT edge and by send(), a CanGroup passes the
+        event its shared thread waits on.
         """
-        frame = msg._get_frame()
-        error = self.can.sendMessage(frame)
-        return error
+        self._on_message = on_message
+        self._irq = irq
+        if self.int_pin is not None:
+            # TX completion wakes the thread to refill the buffers
+            self.can.setTXInterrupts(True)
+            GPIO.setwarnings(False)
+            GPIO.setmode(GPIO.BCM)
+            GPIO.setup(self.int_pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+            GPIO.add_event_detect(self.int_pin, GPIO.FALLING, callback=self._on_interrupt)
+
+    def _detach_io(self, cancel_tx):
+        self._on_message = None
+        self._irq = threading.Event()
+        if self.int_pin is not None:
+            GPIO.remove_event_detect(self.int_pin)
+            self.can.setTXInterrupts(False)
+        # Nothing is left to send queued messages
+        if cancel_tx:
+            self.tx_scheduler.cancel()
+
+    def _on_interrupt(self, channel):
+        self._irq.set()
+
+    def _io_loop(self):
+        # INT is level triggered and stays low while any enabled flag is set,
+        # so the pin level decides whether to service it, the edge only wakes
+        # us. TX buffers are tracked by the scheduler, queued frames only
+        # need a pass while it knows of a free buffer.
+        busy_until = 0.0
+        while self._running:
+            if self.int_pin is not None:
+                if GPIO.input(self.int_pin) == GPIO.LOW or (
+                    self.tx_scheduler.free and len(self.tx_scheduler)
+                ):
+                    if self._service() or GPIO.input(self.int_pin) == GPIO.LOW:
+                        continue
+                # An aborted or one shot frame leaves its buffer without
+                # raising INT, the idle timeout catches those
+                if not self._irq.wait(INT_IDLE_TIMEOUT) and self.tx_scheduler.in_flight:
+                    self._service()
+            else:
+                if self._service():
+                    busy_until = time.monotonic() + RX_BUSY_POLL
+                    continue
+                if time.monotonic() < busy_until:
+                    continue
+                self._irq.wait(RX_POLL_INTERVAL)
+            self._irq.clear()
+
+    def _service(self):
+        """Refill the TX buffers and move every pending frame to the
+        receive ring, sharing one READ STATUS.
+        
+        Returns:
+            Number of frames sent and received
+        """
+        can = self.can
+        # The RX path is held from the READ STATUS on so no other thread
+        # drains the buffers it reports, the TX path only while the
+        # scheduler uses it
+        with can.rx_lock:
+            with can.tx_lock:
+                status = can.getStatus()
+                sent = self.tx_scheduler.service(status)
+            frames, _ = can.drainRaw(RX_DRAIN_BATCH, status)
+            now = time.monotonic_ns()
+
+            # Count and clear error and overflow interrupts, which also
+            # releases INT. READ STATUS does not show ERRIF, so without INT
+            # CANINTF is read after every pass that moved frames, when an
+            # overflow or TX error can have happened, and idle polls stay
+            # one READ STATUS
+            if self.int_pin is not None:
+                check = GPIO.input(self.int_pin) == GPIO.LOW
+            else:
+                check = bool(frames or sent)
+            if check:
+                intf = self.can.getInterrupts()
+                if intf & CANINTF.CANINTF_ERRIF:
+                    # Counts the flags in self.can.error_flags
+                    self.can.getErrorFlags()
+                    self.can.clearRXnOVRFlags()
+                    self.can.clearERRIF()
+                if intf & CANINTF.CANINTF_MERRF:
+                    self.can.clearMERR()
+
+        received = len(frames)
+        if frames and self.id_filter is not None:
+            frames = [frame for frame in frames if self._wanted(frame[0])]
+        # Read once, _attach_consumer() may swap it at any time
+        on_message = self._on_message
+        if on_message is not None:
+            for can_id, buf in frames:
+                data = bytes(buf[MCP_DATA:MCP_DATA + (buf[MCP_DLC] & DLC_MASK)])
+                try:
+                    on_message(CanMsg._from_raw(can_id, data, now))
+                except Exception:
+                    # User code must not take down the I/O thread
+                    self.callback_errors += 1
+                    logger.exception("on_message callback failed")
+        elif frames:
+            with self._rx_ready:
+                for can_id, buf in frames:
+                    data = buf[MCP_DATA:MCP_DATA + (buf[MCP_DLC] & DLC_MASK)]
+                    self.rx_ring.push(can_id, data, now)
+                self._rx_ready.notify_all()
+        return sent + received
     
     def cleanup(self):
         """Release resources and cleanup."""
+        self._stop_io()
         if self.can:
             self.can.cleanup()
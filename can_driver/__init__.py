@@ -1,4 +1,7 @@
 from .CAN import CAN_1, CanMsg, CanMsgFlag, CanError
+from .aio import AsyncCAN
+from .emulator import MCP2515Emulator
+from .group import CanGroup
 from .constants import CAN_SPEED, CAN_CLOCK
 
 __version__ = "0.1.0"
@@ -0,0 +1,131 @@
+'''
+aio.py
+asyncio interface for CAN_1
+All SPI traffic stays on the CAN_1 I/O thread, coroutines only ever wait
+on asyncio futures and queues
+'''
+import asyncio
+
+from .constants import ERROR
+
+
+class AsyncCAN:
+    def __init__(self, bus, rx_queue_size=0):
+        """Wrap an initialized CAN_1 for use from an asyncio event loop.
+
+        Args:
+            bus: CAN_1 object, begin() must have been called
+            rx_queue_size: Maximum number of received messages kept for
+                recv(), the oldest are dropped when full (default: 0, unbounded)
+        """
+        self.bus = bus
+        self.rx_queue_size = rx_queue_size
+        self.rx_dropped = 0
+        self._loop = None
+        self._rx = None
+        # Returned by bus._attach_consumer(), restores the bus on close()
+        self._consumer = None
+        self._closed = True
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        msg = await self._get()
+        if msg is None:
+            raise StopAsyncIteration
+        return msg
+
+    async def start(self):
+        """Start delivering received messages to this event loop."""
+        self._loop = asyncio.get_running_loop()
+        self._rx = asyncio.Queue(self.rx_queue_size)
+        self._closed = False
+        self._consumer = await self._loop.run_in_executor(
+            None, self.bus._attach_consumer, self._on_message
+        )
+
+    async def close(self):
+        """Stop delivering messages, pending recv() calls see end of stream.
+
+        The bus goes back to how start() found it, messages queued by
+        other threads are still sent.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        # Joining an I/O thread started by start() may block for one poll
+        # interval
+        await self._loop.run_in_executor(None, self.bus._detach_consumer, self._consumer)
+        self._consumer = None
+        self._put(None)
+
+    async def recv(self, timeout=None):
+        """Wait for the next received message.
+
+        Args:
+            timeout: Seconds to wait, None waits forever (default: None)
+
+        Returns:
+            CanMsg object, or None once the interface was closed
+
+        Raises:
+            asyncio.TimeoutError: No message arrived within timeout
+        """
+        if timeout is None:
+            return await self._get()
+        return await asyncio.wait_for(self._get(), timeout)
+
+    async def _get(self):
+        msg = await self._rx.get()
+        if msg is None:
+            # Put the end of stream back for the next waiter
+            self._put(None)
+        return msg
+
+    async def send(self, msg, priority=None):
+        """Send a CAN message.
+
+        Waits until the controller reports the frame on the bus, so many
+        concurrent senders are throttled to the bus rate instead of
+        failing with ERROR_ALLTXBUSY.
+
+        Args:
+            msg: CanMsg object
+            priority: Lower values are sent first (default: None, by CAN ID)
+
+        Returns:
+            ERROR_OK once the message was sent, otherwise error code
+        """
+        if self._closed:
+            return ERROR.ERROR_FAILTX
+        future = self._loop.create_future()
+        self.bus.submit(msg, lambda error: self._loop.call_soon_threadsafe(
+            self._resolve, future, error
+        ), priority)
+        return await future
+
+    @staticmethod
+    def _resolve(future, error):
+        if not future.done():
+            future.set_result(error)
+
+    def _on_message(self, msg):
+        # Runs on the I/O thread
+        self._loop.call_soon_threadsafe(self._put, msg)
+
+    def _put(self, msg):
+        if msg is not None and self._closed:
+            # Arrived after close(), the end of stream stays last
+            return
+        if self._rx.full():
+            self._rx.get_nowait()
+            self.rx_dropped += 1
+        self._rx.put_nowait(msg)
@@ -0,0 +1,126 @@
+'''
+bittiming.py
+Bit timing calculation for the MCP2515
+Finds BRP, PropSeg, PS1, PS2 and SJW for any crystal and bitrate instead
+of looking them up in a fixed table, and packs them into CNF1-3
+'''
+import functools
+from collections import namedtuple
+from typing import Optional, Tuple
+
+from .constants import CAN_CLOCK_HZ, CAN_SPEED_BPS, CNF2_BTLMODE
+
+# Sample point recommended by CiA 301 for all bitrates
+DEFAULT_SAMPLE_POINT = 0.875
+# Largest bitrate deviation accepted, CAN allows at most 1.58 % oscillator
+# tolerance across the bus in total, so a node should stay well below it
+MAX_BITRATE_ERROR = 0.005
+
+# Limits from the MCP2515 datasheet, section 5. TQ = 2 * (BRP + 1) / Fosc
+BRP_MAX = 63
+SEG_MAX = 8
+PS2_MIN = 2
+SJW_MAX = 4
+# SyncSeg + PropSeg + PS1 + PS2
+TQ_MIN = 5
+TQ_MAX = 25
+
+BitTiming = namedtuple(
+    "BitTiming",
+    "brp prop_seg phase_seg1 phase_seg2 sjw bitrate sample_point error",
+)
+BitTiming.__doc__ = """One bit timing solution.
+
+brp is the register value, the segments and sjw are in time quanta.
+bitrate is the resulting rate in bit/s, error its relative deviation
+from the requested one.
+"""
+
+
+def cnf_registers(timing: BitTiming) -> Tuple[int, int, int]:
+    """Register values for a solution.
+
+    PS2 comes from CNF3 (BTLMODE set) and the bus is sampled once.
+
+    Returns:
+        Tuple with (CNF1, CNF2, CNF3)
+    """
+    cnf1 = (timing.sjw - 1) << 6 | timing.brp
+    cnf2 = CNF2_BTLMODE | (timing.phase_seg1 - 1) << 3 | (timing.prop_seg - 1)
+    cnf3 = timing.phase_seg2 - 1
+    return cnf1, cnf2, cnf3
+
+
+@functools.lru_cache(maxsize=None)
+def solve_bit_timing(
+    clock_hz: int,
+    bitrate: int,
+    sample_point: float = DEFAULT_SAMPLE_POINT,
+    max_error: float = MAX_BITRATE_ERROR,
+) -> Tuple[BitTiming, ...]:
+    """All valid bit timings for a crystal and bitrate, best first.
+
+    Solutions are ranked by bitrate error, then by distance from the
+    sample point, then by the number of time quanta per bit, more quanta
+    resynchronize in finer steps. Results are cached.
+
+    Args:
+        clock_hz: Crystal frequency in Hz
+        bitrate: Wanted bitrate in bit/s
+        sample_point: Wanted sample point as a fraction of the bit
+        max_error: Largest relative bitrate error accepted
+
+    Returns:
+        Tuple of BitTiming, empty if the bitrate cannot be reached
+    """
+    solutions = []
+    for brp in range(BRP_MAX + 1):
+        tq_hz = clock_hz / (2 * (brp + 1))
+        exact = tq_hz / bitrate
+        for n_tq in {int(exact), int(exact) + 1}:
+            if not TQ_MIN <= n_tq <= TQ_MAX:
+                continue
+            actual = tq_hz / n_tq
+            error = abs(actual - bitrate) / bitrate
+            if error > max_error:
+                continue
+
+            # PS2 sets the sample point, PropSeg + PS1 must cover it
+            ps2 = round(n_tq * (1 - sample_point))
+            ps2 = min(max(ps2, PS2_MIN, n_tq - 1 - 2 * SEG_MAX), SEG_MAX, (n_tq - 1) // 2)
+            tseg1 = n_tq - 1 - ps2
+            ps1 = tseg1 // 2
+            prop = tseg1 - ps1
+            # SJW must not exceed PS1 and has to stay below PS2
+            sjw = min(SJW_MAX, ps1, ps2 - 1)
+            solutions.append(BitTiming(
+                brp, prop, ps1, ps2, sjw, actual, (1 + tseg1) / n_tq, error
+            ))
+
+    solutions.sort(key=lambda t: (
+        round(t.error, 9), abs(t.sample_point - sample_point), -(t.phase_seg2 + t.phase_seg1 + t.prop_seg)
+    ))
+    return tuple(solutions)
+
+
+def bit_timing(
+    speed: int,
+    clock: int,
+    sample_point: float = DEFAULT_SAMPLE_POINT,
+) -> Optional[BitTiming]:
+    """Best bit timing for a CAN_SPEED or bitrate on a CAN_CLOCK or crystal.
+
+    Args:
+        speed: CAN_SPEED value or bitrate in bit/s
+        clock: CAN_CLOCK value or crystal frequency in Hz
+        sample_point: Wanted sample point as a fraction of the bit
+
+    Returns:
+        BitTiming, or None if the bitrate cannot be reached
+    """
+    bitrate = CAN_SPEED_BPS.get(speed, speed)
+    clock_hz = CAN_CLOCK_HZ.get(clock, clock)
+    if bitrate <= 0 or clock_hz <= 0:
+        return None
+    solutions = solve_bit_timing(clock_hz, bitrate, sample_point)
+    return solutions[0] if solutions else None
@@ -17,6 +17,9 @@ CAN_SFF_MASK = 0x000007FF  # standard frame format (SFF)
 CAN_EFF_MASK = 0x1FFFFFFF  # extended frame format (EFF)
 CAN_ERR_MASK = 0x1FFFFFFF  # omit EFF, RTR, ERR flags
 
+# Position of the flags in a 32 bit CAN ID
+CAN_FLAGS_SHIFT = 29
+
 CAN_SFF_ID_BITS = 11
 CAN_EFF_ID_BITS = 29
 
@@ -28,67 +31,72 @@ CAN_MAX_DLEN = 8
 CAN_IDLEN = 4
 
 
-class CANFrame:
-    def __init__(self, can_id: int, data: bytes = b"") -> None:
+class CanMsg:
+    # A received frame is kept for a while in queues and rings, so the
+    # per-object footprint matters: no __dict__, and everything derivable
+    # from the four stored fields is computed on access
+    __slots__ = ("can_id", "data", "_flags", "timestamp")
+
+    def __init__(self, can_id=0, data=None, flags=None, timestamp=0):
         #
-        # Controller Area Network Identifier structure
+        # can_id is the 11/29 bit identifier. The EFF/RTR/ERR flags may be
+        # passed in flags or in the top bits of can_id:
         #
         # bit 0-28 : CAN identifier (11/29 bit)
         # bit 29   : error message frame flag (0 = data frame, 1 = error message)
         # bit 30   : remote transmission request flag (1 = rtr frame)
         # bit 31   : frame format flag (0 = standard 11 bit, 1 = extended 29 bit)
         #
-        # 32 bit CAN ID + EFF/RTR/ERR flags
-        #
-        self.can_id = can_id  # type: int
-        self.data = data  # type: bytes
-
-    @property
-    def can_id(self) -> int:
-        return self._can_id
-
-    @can_id.setter
-    def can_id(self, can_id: int) -> None:
-        self._can_id = can_id
-        self._arbitration_id = can_id & CAN_EFF_MASK  # type: int
-
-    @property
-    def data(self) -> bytes:
-        return self._data
-
-    @data.setter
-    def data(self, data: bytes) -> None:
-        self._data = b""  # type: bytes
-        self._dlc = 0  # frame payload length in byte (0 .. CAN_MAX_DLEN)
-
+        if flags:
+            can_id |= flags
         if not data:
-            return
-
-        if len(data) > CAN_MAX_DLEN:
+            data = b""
+        elif len(data) > CAN_MAX_DLEN:
             raise Exception("The CAN frame data length exceeds the maximum")
+        self.can_id = can_id & CAN_EFF_MASK
+        # Stored shifted down, small ints are shared instead of allocated
+        self._flags = can_id >> CAN_FLAGS_SHIFT
+        self.data = bytes(data)
+        self.timestamp = timestamp
+
+    @classmethod
+    def _from_raw(cls, can_id, data, timestamp=0):
+        """Build a message from a decoded RX buffer, skipping validation.
+
+        can_id carries the EFF/RTR/ERR flags and data must be a bytes
+        object of at most CAN_MAX_DLEN bytes.
+        """
+        msg = cls.__new__(cls)
+        msg.can_id = can_id & CAN_EFF_MASK
+        msg._flags = can_id >> CAN_FLAGS_SHIFT
+        msg.data = data
+        msg.timestamp = timestamp
+        return msg
 
-        self._data = data
-        self._dlc = len(data)
+    @property
+    def raw_id(self) -> int:
+        """32 bit CAN ID with the EFF/RTR/ERR flags set."""
+        return self.can_id | (self._flags << CAN_FLAGS_SHIFT)
 
     @property
     def arbitration_id(self) -> int:
-        return self._arbitration_id
+        return self.can_id
 
     @property
     def dlc(self) -> int:
-        return self._dlc
+        return len(self.data)
 
     @property
     def is_extended_id(self) -> bool:
-        return bool(self._can_id & CAN_EFF_FLAG)
+        return bool(self._flags & (CAN_EFF_FLAG >> CAN_FLAGS_SHIFT))
 
     @property
     def is_remote_frame(self) -> bool:
-        return bool(self._can_id & CAN_RTR_FLAG)
+        return bool(self._flags & (CAN_RTR_FLAG >> CAN_FLAGS_SHIFT))
 
     @property
     def is_error_frame(self) -> bool:
-        return bool(self._can_id & CAN_ERR_FLAG)
+        return bool(self._flags & (CAN_ERR_FLAG >> CAN_FLAGS_SHIFT))
 
     def __str__(self) -> str:
         data = (
@@ -96,4 +104,8 @@ class CANFrame:
             if self.is_remote_frame
             else " ".join("{:02X}".format(b) for b in self.data)
         )
-        return "{: >8X}   [{}]  {}".format(self.arbitration_id, self.dlc, data)
+        return "{: >8X}   [{}]  {}".format(self.can_id, self.dlc, data)
+
+
+# CANFrame(can_id | flags, data) builds the same object
+CANFrame = CanMsg
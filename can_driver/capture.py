@@ -0,0 +1,501 @@
+'''
+capture.py
+Compact binary capture files for CAN traffic
+A capture is a 24 byte file header followed by fixed size records,
+
+    timestamp_ns  int64    time.monotonic_ns() of the frame
+    can_id        uint32   identifier with the EFF/RTR/ERR flags
+    dlc           uint8    payload length
+    (padding)     3 bytes
+    data          8 bytes  payload, zero past dlc
+
+so an uncompressed file can be mapped straight into a NumPy structured
+array. Compressed files hold the same records in zlib blocks, each after
+an 8 byte block header of (compressed length, record count).
+CaptureRecorder writes the frames received by a CAN_1 from a thread of its
+own, CaptureReader reads them back and the converters turn them into
+candump or Vector ASC text.
+'''
+import os
+import struct
+import threading
+import time
+import zlib
+from typing import Any, Iterator, List, Optional, Sequence, TextIO, Tuple, Union
+
+try:
+    import numpy as np
+except ImportError:
+    # Only CaptureReader.to_array() needs it
+    np = None
+
+from .can import CAN_EFF_FLAG, CAN_EFF_MASK, CAN_FLAGS_SHIFT, CAN_MAX_DLEN, CAN_RTR_FLAG
+from .can import CanMsg
+
+CAPTURE_MAGIC = b"CANCAP"
+CAPTURE_VERSION = 1
+# Header flags
+CAPTURE_COMPRESSED = 0x0001
+
+# magic, version, flags, record size, wall clock minus monotonic clock in
+# ns when the file was opened. Records keep monotonic time, candump and ASC
+# output is wall clock.
+HEADER = struct.Struct("<6sHHHq4x")
+RECORD = struct.Struct("<qIB3x8s")
+BLOCK_HEADER = struct.Struct("<II")
+HEADER_SIZE = HEADER.size
+RECORD_SIZE = RECORD.size
+
+# NumPy dtype of one record, see CaptureReader.to_array()
+CAPTURE_DTYPE = [
+    ("timestamp_ns", "<i8"),
+    ("can_id", "<u4"),
+    ("dlc", "u1"),
+    ("pad", "u1", (3,)),
+    ("data", "u1", (CAN_MAX_DLEN,)),
+]
+
+# Records packed before they are written out as one block, 96 KiB
+DEFAULT_BLOCK_RECORDS = 4096
+# zlib level of compressed blocks, 1 keeps up with a loaded bus on a Pi 4
+DEFAULT_COMPRESS_LEVEL = 1
+# Longest time frames stay in memory before CaptureRecorder writes them
+FLUSH_INTERVAL = 1.0
+# Bytes read per chunk of an uncompressed file
+READ_CHUNK = RECORD_SIZE * 16384
+
+# (can_id including flags, data, timestamp_ns) as from RxRing.pop()
+Record = Tuple[int, bytes, int]
+
+
+def rotated_path(path: str, index: int) -> str:
+    """Name of the index-th file of a rotated capture, log.cancap -> log.0003.cancap."""
+    root, ext = os.path.splitext(path)
+    return "%s.%04d%s" % (root, index, ext)
+
+
+class CaptureWriter:
+    def __init__(self, path: str, compress: bool = False, max_bytes: Optional[int] = None,
+                 max_files: Optional[int] = None, block_records: int = DEFAULT_BLOCK_RECORDS,
+                 compress_level: int = DEFAULT_COMPRESS_LEVEL) -> None:
+        """Append records to a capture file.
+
+        Records are packed into a preallocated block and written with one
+        write() call per block, so the file is only touched every
+        block_records frames or on flush().
+
+        Args:
+            path: File to write, with max_bytes the name the rotated files
+                are derived from, see rotated_path()
+            compress: Store zlib compressed blocks
+            max_bytes: Start a new file once this size is reached
+                (default: None, a single file)
+            max_files: With max_bytes, delete the oldest files beyond this
+                count (default: None, keep all)
+            block_records: Records per block
+            compress_level: zlib level of compressed blocks
+        """
+        if block_records <= 0:
+            raise ValueError("block_records must be positive")
+        self.path = path
+        self.compress = compress
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.block_records = block_records
+        self.compress_level = compress_level
+        # Files written and not deleted by max_files, oldest first
+        self.paths = []  # type: List[str]
+        self._index = 0
+        self.records = 0
+        self.bytes_written = 0
+
+        self._block = bytearray(RECORD_SIZE * block_records)
+        self._pending = 0
+        self._file = None
+        self._file_bytes = 0
+        self._open()
+
+    def __enter__(self) -> "CaptureWriter":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
+
+    def _open(self) -> None:
+        if self.max_bytes is None:
+            path = self.path
+        else:
+            path = rotated_path(self.path, self._index)
+        self._index += 1
+        self._file = open(path, "wb")
+        self.paths.append(path)
+        offset = time.time_ns() - time.monotonic_ns()
+        flags = CAPTURE_COMPRESSED if self.compress else 0
+        header = HEADER.pack(CAPTURE_MAGIC, CAPTURE_VERSION, flags, RECORD_SIZE, offset)
+        self._file.write(header)
+        self._file_bytes = len(header)
+        if self.max_files is not None and len(self.paths) > self.max_files:
+            for old in self.paths[:-self.max_files]:
+                try:
+                    os.remove(old)
+                except OSError:
+                    pass
+            del self.paths[:-self.max_files]
+
+    def write(self, can_id: int, data: bytes, timestamp_ns: int) -> None:
+        """Append one frame.
+
+        Args:
+            can_id: 32 bit CAN ID including the EFF/RTR/ERR flags
+            data: Payload, up to 8 bytes
+            timestamp_ns: time.monotonic_ns() of the frame
+        """
+        RECORD.pack_into(
+            self._block, self._pending * RECORD_SIZE, timestamp_ns, can_id, len(data), bytes(data)
+        )
+        self._pending += 1
+        if self._pending == self.block_records:
+            self.flush()
+
+    def write_msg(self, msg: CanMsg) -> None:
+        self.write(msg.raw_id, msg.data, msg.timestamp)
+
+    def write_columns(self, ids: Sequence[int], flags: Sequence[int], dlcs: Sequence[int],
+                      timestamps: Sequence[int], payload: bytes) -> None:
+        """Append frames stored column wise like in RxRing.
+
+        Frame i has the ID ids[i] with flags[i] shifted into the top bits
+        and the payload payload[i * 8:i * 8 + dlcs[i]].
+        """
+        pack_into = RECORD.pack_into
+        block = self._block
+        for i in range(len(ids)):
+            dlc = dlcs[i]
+            offset = i * CAN_MAX_DLEN
+            pack_into(
+                block, self._pending * RECORD_SIZE, timestamps[i],
+                ids[i] | flags[i] << CAN_FLAGS_SHIFT, dlc, payload[offset:offset + dlc],
+            )
+            self._pending += 1
+            if self._pending == self.block_records:
+                self.flush()
+
+    def flush(self) -> None:
+        """Write the records packed so far and rotate if the file is full."""
+        self._write_block()
+        self._file.flush()
+        if self.max_bytes is not None and self._file_bytes >= self.max_bytes:
+            self._file.close()
+            self._open()
+
+    def _write_block(self) -> None:
+        n = self._pending
+        if not n:
+            return
+        block = memoryview(self._block)[:n * RECORD_SIZE]
+        if self.compress:
+            packed = zlib.compress(block, self.compress_level)
+            self._file.write(BLOCK_HEADER.pack(len(packed), n))
+            self._file.write(packed)
+            size = BLOCK_HEADER.size + len(packed)
+        else:
+            self._file.write(block)
+            size = len(block)
+        self._pending = 0
+        self.records += n
+        self.bytes_written += size
+        self._file_bytes += size
+
+    def close(self) -> None:
+        if self._file is None:
+            return
+        self._write_block()
+        self._file.close()
+        self._file = None
+
+
+class CaptureReader:
+    def __init__(self, paths: Union[str, Sequence[str]]) -> None:
+        """Read one capture file or the files of a rotated capture in order.
+
+        Args:
+            paths: File name or list of file names
+        """
+        self.paths = [paths] if isinstance(paths, str) else list(paths)
+        # Wall clock minus monotonic time of the first file
+        self.epoch_offset_ns = self._header(self.paths[0])[1] if self.paths else 0
+
+    def __iter__(self) -> Iterator[Record]:
+        """Yield (can_id including flags, data, timestamp_ns) per frame."""
+        for block in self.blocks():
+            for timestamp, can_id, dlc, data in RECORD.iter_unpack(block):
+                yield can_id, data[:dlc], timestamp
+
+    def messages(self) -> Iterator[CanMsg]:
+        for can_id, data, timestamp in self:
+            yield CanMsg._from_raw(can_id, data, timestamp)
+
+    @staticmethod
+    def _header(path: str) -> Tuple[int, int]:
+        with open(path, "rb") as f:
+            raw = f.read(HEADER_SIZE)
+        if len(raw) < HEADER_SIZE:
+            raise ValueError("%s: not a capture file" % path)
+        magic, version, flags, record_size, offset = HEADER.unpack(raw)
+        if magic != CAPTURE_MAGIC or record_size != RECORD_SIZE:
+            raise ValueError("%s: not a capture file" % path)
+        if version > CAPTURE_VERSION:
+            raise ValueError("%s: capture version %d is not supported" % (path, version))
+        return flags, offset
+
+    def blocks(self) -> Iterator[bytes]:
+        """Yield the raw records in chunks of whole records."""
+        for path in self.paths:
+            flags = self._header(path)[0]
+            with open(path, "rb") as f:
+                if flags & CAPTURE_COMPRESSED:
+                    f.seek(HEADER_SIZE)
+                    while True:
+                        head = f.read(BLOCK_HEADER.size)
+                        if len(head) < BLOCK_HEADER.size:
+                            break
+                        size, n = BLOCK_HEADER.unpack(head)
+                        packed = f.read(size)
+                        if len(packed) < size:
+                            # Cut off by a crash while writing
+                            break
+                        yield zlib.decompress(packed)[:n * RECORD_SIZE]
+                    continue
+                f.seek(HEADER_SIZE)
+                while True:
+                    chunk = f.read(READ_CHUNK)
+                    # A record cut off by a crash while writing is skipped
+                    whole = len(chunk) // RECORD_SIZE * RECORD_SIZE
+                    if whole:
+                        yield chunk if whole == len(chunk) else chunk[:whole]
+                    if len(chunk) < READ_CHUNK:
+                        break
+
+    def arrays(self) -> Iterator[Any]:
+        """Yield the records as NumPy structured arrays of CAPTURE_DTYPE,
+        one per block or read chunk.
+
+        Raises:
+            ImportError: NumPy is not installed
+        """
+        if np is None:
+            raise ImportError("CaptureReader.arrays() needs numpy")
+        dtype = np.dtype(CAPTURE_DTYPE)
+        for block in self.blocks():
+            yield np.frombuffer(block, dtype)
+
+    def to_array(self) -> Any:
+        """All records as one NumPy structured array of CAPTURE_DTYPE."""
+        chunks = list(self.arrays())
+        if not chunks:
+            return np.zeros(0, np.dtype(CAPTURE_DTYPE))
+        return np.concatenate(chunks)
+
+
+def read_capture(paths: Union[str, Sequence[str]]) -> CaptureReader:
+    return CaptureReader(paths)
+
+
+def _id_text(can_id: int, ext_width: int, std_width: int) -> str:
+    if can_id & CAN_EFF_FLAG:
+        return "%0*X" % (ext_width, can_id & CAN_EFF_MASK)
+    return "%0*X" % (std_width, can_id & CAN_EFF_MASK)
+
+
+def write_candump(records: Any, out: TextIO, channel: str = "can0",
+                  epoch_offset_ns: Optional[int] = None) -> int:
+    """Write frames in the candump -L log format.
+
+    Args:
+        records: CaptureReader or iterable of (can_id, data, timestamp_ns)
+        out: Text file to write to
+        channel: Interface name in every line
+        epoch_offset_ns: Added to the timestamps to get wall clock time,
+            taken from a CaptureReader by default
+
+    Returns:
+        Number of frames written
+    """
+    if epoch_offset_ns is None:
+        epoch_offset_ns = getattr(records, "epoch_offset_ns", 0)
+    n = 0
+    for can_id, data, timestamp in records:
+        ts = timestamp + epoch_offset_ns
+        if can_id & CAN_RTR_FLAG:
+            payload = "R"
+        else:
+            payload = data.hex().upper()
+        out.write("(%d.%06d) %s %s#%s\n" % (
+            ts // 1000000000, ts % 1000000000 // 1000, channel,
+            _id_text(can_id, 8, 3), payload,
+        ))
+        n += 1
+    return n
+
+
+def write_asc(records: Any, out: TextIO, channel: int = 1,
+              epoch_offset_ns: Optional[int] = None) -> int:
+    """Write frames as a Vector ASC log, timestamps relative to the first.
+
+    Args:
+        records: CaptureReader or iterable of (can_id, data, timestamp_ns)
+        out: Text file to write to
+        channel: CAN channel number in every line
+        epoch_offset_ns: Added to the timestamps for the start date,
+            taken from a CaptureReader by default
+
+    Returns:
+        Number of frames written
+    """
+    if epoch_offset_ns is None:
+        epoch_offset_ns = getattr(records, "epoch_offset_ns", 0)
+    n = 0
+    start = None
+    for can_id, data, timestamp in records:
+        if start is None:
+            start = timestamp
+            when = time.localtime((timestamp + epoch_offset_ns) // 1000000000)
+            date = "%s %s %s" % (
+                time.strftime("%a %b %d %I:%M:%S.000", when),
+                time.strftime("%p", when).lower(),
+                time.strftime("%Y", when),
+            )
+            out.write("date %s\nbase hex  timestamps absolute\ninternal events logged\n" % date)
+            out.write("Begin Triggerblock %s\n" % date)
+        can_id_text = _id_text(can_id, 1, 1) + ("x" if can_id & CAN_EFF_FLAG else "")
+        if can_id & CAN_RTR_FLAG:
+            frame = "r"
+        else:
+            frame = "d %X%s" % (len(data), "".join(" %02X" % b for b in data))
+        out.write("%11.6f %d  %-15s Rx   %s\n" % (
+            (timestamp - start) / 1e9, channel, can_id_text, frame,
+        ))
+        n += 1
+    if start is not None:
+        out.write("End TriggerBlock\n")
+    return n
+
+
+class CaptureRecorder:
+    def __init__(self, bus: Any, path: str, **writer_args: Any) -> None:
+        """Record every frame a CAN_1 receives to a capture file.
+
+        The recorder takes frames straight from the receive ring filled by
+        the I/O thread, in place and a whole run at a time, and packs and
+        writes them on a thread of its own so disk writes never hold up
+        the controller. It is the consumer of the ring, recv() on the
+        same bus gets nothing while recording. For a loaded 1 Mbps bus
+        give the CAN_1 an rx_ring_size of several thousand frames.
+
+        Args:
+            bus: CAN_1 object, begin() must have been called
+            path: Capture file, see CaptureWriter
+            writer_args: Passed on to CaptureWriter, compress, max_bytes,
+                max_files, block_records and compress_level
+        """
+        self.bus = bus
+        self.writer = CaptureWriter(path, **writer_args)
+        self._thread = None
+        self._running = False
+        self._started_io = False
+        # Ring losses while recording, see stats()
+        self._ring_lost = 0
+
+    def __enter__(self) -> "CaptureRecorder":
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.stop()
+
+    def start(self) -> None:
+        """Start recording, with the I/O thread of the bus if not running."""
+        if self._thread is not None:
+            return
+        bus = self.bus
+        if bus._io_thread is None:
+            bus._start_io()
+            self._started_io = True
+        ring = bus.rx_ring
+        self._ring_lost = ring.dropped + ring.overwritten
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="can-capture", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Write out everything received so far and close the file."""
+        if self._thread is None:
+            return
+        self._running = False
+        with self.bus._rx_ready:
+            self.bus._rx_ready.notify_all()
+        self._thread.join()
+        self._thread = None
+        if self._started_io:
+            self.bus._stop_io()
+            self._started_io = False
+        self.writer.close()
+
+    def stats(self) -> dict:
+        """Frames recorded and lost to a full receive ring, and bytes written."""
+        ring = self.bus.rx_ring
+        return {
+            "recorded": self.writer.records + self.writer._pending,
+            "ring_lost": ring.dropped + ring.overwritten - self._ring_lost,
+            "bytes_written": self.writer.bytes_written,
+            "files": list(self.writer.paths),
+        }
+
+    def _run(self) -> None:
+        ring = self.bus.rx_ring
+        ready = self.bus._rx_ready
+        writer = self.writer
+        flushed = time.monotonic()
+        while True:
+            runs = []
+            with ready:
+                ready.wait_for(lambda: len(ring) or not self._running, FLUSH_INTERVAL)
+                # Copy the buffered runs out, packing happens unlocked
+                while True:
+                    slot, n = ring.readable()
+                    if not n:
+                        break
+                    end = slot + n
+                    runs.append((
+                        ring.ids[slot:end], ring.flags[slot:end], ring.dlcs[slot:end],
+                        ring.timestamps[slot:end],
+                        bytes(ring.payload[slot * CAN_MAX_DLEN:end * CAN_MAX_DLEN]),
+                    ))
+                    ring.consume(n)
+            for run in runs:
+                writer.write_columns(*run)
+            now = time.monotonic()
+            if now - flushed >= FLUSH_INTERVAL:
+                writer.flush()
+                flushed = now
+            if not self._running and not runs:
+                break
+
+
+def main() -> None:
+    import argparse
+    import sys
+    parser = argparse.ArgumentParser(description="Convert CAN capture files to text")
+    parser.add_argument("paths", nargs="+", help="capture files, rotated ones in order")
+    parser.add_argument("--format", choices=("candump", "asc"), default="candump")
+    parser.add_argument("--channel", help="interface name or ASC channel number")
+    args = parser.parse_args()
+    reader = CaptureReader(args.paths)
+    if args.format == "candump":
+        write_candump(reader, sys.stdout, args.channel or "can0")
+    else:
+        write_asc(reader, sys.stdout, int(args.channel or 1))
+
+
+if __name__ == "__main__":
+    main()
@@ -40,6 +40,8 @@ class EFLG:
     EFLG_EWARN = 0x01
 
 EFLG_ERRORMASK = 0xF8  # Mask for all error flags
+# EFLG bit names, indexed by bit number
+EFLG_NAMES = ("EWARN", "RXWAR", "TXWAR", "RXEP", "TXEP", "TXBO", "RX0OVR", "RX1OVR")
 
 # MCP2515 CANCTRL Register Bits for Clock Output
 class CAN_CLKOUT:
@@ -161,6 +163,8 @@ class REGISTER:
     MCP_RXF2SIDL = 0x09
     MCP_RXF2EID8 = 0x0A
     MCP_RXF2EID0 = 0x0B
+    MCP_BFPCTRL = 0x0C
+    MCP_TXRTSCTRL = 0x0D
     MCP_CANSTAT = 0x0E
     MCP_CANCTRL = 0x0F
     MCP_RXF3SIDH = 0x10
@@ -240,6 +244,8 @@ CANCTRL_ABAT = 0x10
 CANCTRL_OSM = 0x08
 CANCTRL_CLKEN = 0x04
 CANCTRL_CLKPRE = 0x03
+# CANCTRL after reset: configuration mode, CLKOUT enabled at Fosc/8
+CANCTRL_RESET = CANCTRL_REQOP_MODE.CANCTRL_REQOP_CONFIG | CANCTRL_CLKEN | CANCTRL_CLKPRE
 
 # MCP2515 Standard Filter and Mask Entry Indices
 MCP_SIDH = 0
@@ -249,10 +255,13 @@ MCP_EID0 = 3
 MCP_DLC = 4
 MCP_DATA = 5
 
+CNF2_BTLMODE = 0x80
+CNF2_SAM = 0x40
 CNF3_SOF = 0x80
 RTR_MASK = 0x40
 DLC_MASK = 0x0F
 TXB_EXIDE_MASK = 0x08
+RXB_SRR_MASK = 0x10
 
 # MCP2515 RXBnCTRL Register Bits
 RXBnCTRL_RXM_MASK = 0x60
@@ -268,71 +277,52 @@ RXB0CTRL_FILHIT = 0x00
 RXB1CTRL_FILHIT = 0x01
 
 STAT_RXIF_MASK = STAT.STAT_RX0IF | STAT.STAT_RX1IF
+CANINTF_TXIF_MASK = CANINTF.CANINTF_TX0IF | CANINTF.CANINTF_TX1IF | CANINTF.CANINTF_TX2IF
 
 # constants.py - Constants for MCP2515 CAN controller implementation
 
 # SPI interface constants
-SPI_DEFAULT_BAUDRATE = 1000000  # 10MHz SPI clock
+SPI_DEFAULT_BAUDRATE = 10000000  # 10MHz SPI clock, the MCP2515 maximum
 SPI_DUMMY_INT = 0x00
 SPI_TRANSFER_LEN = 1
 SPI_HOLD_US = 10
 
-# MCP2515 CAN Configuration for different clock frequencies and baudrates
-# Format: CFG1, CFG2, CFG3
-CAN_CFGS = {
-    CAN_CLOCK.MCP_16MHZ: {
-        CAN_SPEED.CAN_5KBPS: (0x3F, 0xFF, 0x87),
-        CAN_SPEED.CAN_10KBPS: (0x1F, 0xFF, 0x87),
-        CAN_SPEED.CAN_20KBPS: (0x0F, 0xFF, 0x87),
-        CAN_SPEED.CAN_31K25BPS: (0x0F, 0xF1, 0x85),
-        CAN_SPEED.CAN_33KBPS: (0x09, 0xBE, 0x07),
-        CAN_SPEED.CAN_40KBPS: (0x07, 0xFF, 0x87),
-        CAN_SPEED.CAN_50KBPS: (0x07, 0xFA, 0x87),
-        CAN_SPEED.CAN_80KBPS: (0x03, 0xFF, 0x87),
-        CAN_SPEED.CAN_83K3BPS: (0x03, 0xBE, 0x07),
-        CAN_SPEED.CAN_95KBPS: (0x03, 0xAD, 0x07),
-        CAN_SPEED.CAN_100KBPS: (0x03, 0xFA, 0x87),
-        CAN_SPEED.CAN_125KBPS: (0x03, 0xF0, 0x86),
-        CAN_SPEED.CAN_200KBPS: (0x01, 0xFA, 0x87),
-        CAN_SPEED.CAN_250KBPS: (0x41, 0xF1, 0x85),
-        CAN_SPEED.CAN_500KBPS: (0x00, 0xF0, 0x86),
-        CAN_SPEED.CAN_666KBPS: (0x00, 0xA0, 0x04),
-        CAN_SPEED.CAN_1000KBPS: (0x00, 0xD0, 0x82),
-    },
-    CAN_CLOCK.MCP_8MHZ: {
-        CAN_SPEED.CAN_5KBPS: (0x1F, 0xFF, 0x87),
-        CAN_SPEED.CAN_10KBPS: (0x0F, 0xFF, 0x87),
-        CAN_SPEED.CAN_20KBPS: (0x07, 0xFF, 0x87),
-        CAN_SPEED.CAN_31K25BPS: (0x07, 0xA4, 0x04),
-        CAN_SPEED.CAN_33KBPS: (0x04, 0xF1, 0x85),
-        CAN_SPEED.CAN_40KBPS: (0x04, 0xF1, 0x85),
-        CAN_SPEED.CAN_50KBPS: (0x03, 0xFA, 0x87),
-        CAN_SPEED.CAN_80KBPS: (0x01, 0xFA, 0x87),
-        CAN_SPEED.CAN_83K3BPS: (0x01, 0xF0, 0x86),
-        CAN_SPEED.CAN_95KBPS: (0x01, 0xAD, 0x07),
-        CAN_SPEED.CAN_100KBPS: (0x01, 0xF0, 0x86),
-        CAN_SPEED.CAN_125KBPS: (0x01, 0xF0, 0x86),
-        CAN_SPEED.CAN_200KBPS: (0x00, 0xFA, 0x87),
-        CAN_SPEED.CAN_250KBPS: (0x00, 0xF0, 0x86),
-        CAN_SPEED.CAN_500KBPS: (0x00, 0xF0, 0x86),
-        CAN_SPEED.CAN_1000KBPS: (0x00, 0xD0, 0x82),
-    },
-    CAN_CLOCK.MCP_10MHZ: {
-        CAN_SPEED.CAN_5KBPS: (0x3F, 0xFF, 0x87),
-        CAN_SPEED.CAN_10KBPS: (0x1F, 0xFF, 0x87),
-        CAN_SPEED.CAN_20KBPS: (0x0F, 0xFF, 0x87),
-        CAN_SPEED.CAN_31K25BPS: (0x0F, 0xF1, 0x85),
-        CAN_SPEED.CAN_33KBPS: (0x09, 0xBE, 0x07),
-        CAN_SPEED.CAN_40KBPS: (0x07, 0xFF, 0x87),
-        CAN_SPEED.CAN_50KBPS: (0x07, 0xFA, 0x87),
-        CAN_SPEED.CAN_80KBPS: (0x03, 0xFF, 0x87),
-        CAN_SPEED.CAN_83K3BPS: (0x03, 0xBE, 0x07),
-        CAN_SPEED.CAN_95KBPS: (0x03, 0xAD, 0x07),
-        CAN_SPEED.CAN_100KBPS: (0x03, 0xFA, 0x87),
-        CAN_SPEED.CAN_125KBPS: (0x01, 0xFA, 0x87),
-        CAN_SPEED.CAN_200KBPS: (0x00, 0xFA, 0x87),
-        CAN_SPEED.CAN_250KBPS: (0x00, 0xF0, 0x86),
-        CAN_SPEED.CAN_500KBPS: (0x00, 0xF0, 0x86),
-        CAN_SPEED.CAN_1000KBPS: (0x00, 0xD0, 0x82),
-    },
-}
\ No newline at end of file
+# Wait after the RESET instruction, the oscillator start-up timer holds
+# the device for 128 OSC1 cycles (16 us at 8 MHz)
+MCP_RESET_DELAY = 0.0001
+# How long to wait for the device to report the reset state
+MCP_RESET_TIMEOUT = 0.01
+
+# Hardware chip select lines, SPI bus -> {CE GPIO pin (BCM): spidev device}
+SPI_CE_PINS = {
+    0: {8: 0, 7: 1},
+    1: {18: 0, 17: 1, 16: 2},
+}
+
+# Crystal frequency in Hz for each CAN_CLOCK value
+CAN_CLOCK_HZ = {
+    CAN_CLOCK.MCP_8MHZ: 8000000,
+    CAN_CLOCK.MCP_10MHZ: 10000000,
+    CAN_CLOCK.MCP_16MHZ: 16000000,
+}
+
+# Bitrate in bit/s for each CAN_SPEED value
+CAN_SPEED_BPS = {
+    CAN_SPEED.CAN_5KBPS: 5000,
+    CAN_SPEED.CAN_10KBPS: 10000,
+    CAN_SPEED.CAN_20KBPS: 20000,
+    CAN_SPEED.CAN_31K25BPS: 31250,
+    CAN_SPEED.CAN_33KBPS: 33333,
+    CAN_SPEED.CAN_40KBPS: 40000,
+    CAN_SPEED.CAN_50KBPS: 50000,
+    CAN_SPEED.CAN_80KBPS: 80000,
+    CAN_SPEED.CAN_83K3BPS: 83333,
+    CAN_SPEED.CAN_95KBPS: 95238,
+    CAN_SPEED.CAN_100KBPS: 100000,
+    CAN_SPEED.CAN_125KBPS: 125000,
+    CAN_SPEED.CAN_200KBPS: 200000,
+    CAN_SPEED.CAN_250KBPS: 250000,
+    CAN_SPEED.CAN_500KBPS: 500000,
+    CAN_SPEED.CAN_666KBPS: 666666,
+    CAN_SPEED.CAN_1000KBPS: 1000000,
+}
@@ -0,0 +1,378 @@
+'''
+dbc.py
+DBC signal definitions and batch decoding into NumPy columns
+load_dbc() parses the messages and signals of a DBC file and compiles
+every signal into a shift and mask on the payload read as one 64 bit word,
+little endian for Intel and big endian for Motorola byte order. Decoding
+a batch then costs a handful of array operations per signal, whatever
+the number of frames: a mixed batch is split by ID with one sort, and the
+payloads of each ID are gathered once and viewed as uint64 words. Simple
+multiplexing (M / mN) is supported, extended multiplexing (SG_MUL_VAL_)
+is not
+'''
+import re
+import struct
+from collections import namedtuple
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+
+try:
+    import numpy as np
+except ImportError:
+    # Parsing and Message.decode() work without it, batch decoding not
+    np = None
+
+from .can import CAN_EFF_FLAG, CAN_EFF_MASK, CAN_ERR_FLAG, CAN_MAX_DLEN, CAN_RTR_FLAG
+
+# Bit 31 of a DBC message ID marks an extended frame, the same bit as
+# CAN_EFF_FLAG, so DBC IDs are used as CAN IDs with flags unchanged
+DBC_EXTENDED = 0x80000000
+# SIG_VALTYPE_ values
+SIG_INTEGER = 0
+SIG_FLOAT32 = 1
+SIG_FLOAT64 = 2
+
+Signal = namedtuple(
+    "Signal",
+    "name start length little_endian signed scale offset minimum maximum unit "
+    "mux_value is_multiplexer value_type",
+)
+Signal.__doc__ = """One signal of a DBC message.
+
+start and length are in bits as written in the DBC, start is the LSB for
+Intel (little_endian) and the MSB for Motorola byte order. mux_value is
+the multiplexer value the signal is present for, None if it is always
+present, is_multiplexer marks the multiplexer switch itself. value_type
+is SIG_INTEGER, SIG_FLOAT32 or SIG_FLOAT64.
+"""
+
+_BO = re.compile(r"^BO_\s+(\d+)\s+(\w+)\s*:\s*(\d+)\s+(\S+)")
+_SG = re.compile(
+    r"^SG_\s+(\w+)\s*(M|m\d+M?)?\s*:\s*(\d+)\|(\d+)@([01])([+-])\s*"
+    r"\(\s*([^,\s]+)\s*,\s*([^)\s]+)\s*\)\s*\[\s*([^|\s]*)\s*\|\s*([^\]\s]*)\s*\]\s*\"([^\"]*)\""
+)
+_VALTYPE = re.compile(r"^SIG_VALTYPE_\s+(\d+)\s+(\w+)\s*:\s*([012])\s*;")
+
+
+def _lsb_shift(signal: Signal) -> int:
+    """Right shift that brings the signal to bit 0 of the payload word.
+
+    Intel signals use the payload as a little endian word, where DBC bit
+    numbering is the word bit numbering. Motorola signals use it as a big
+    endian word, where byte b bit i is word bit 63 - (8 * b + 7 - i).
+    """
+    if signal.little_endian:
+        return signal.start
+    msb_from_top = signal.start // 8 * 8 + 7 - signal.start % 8
+    return 64 - msb_from_top - signal.length
+
+
+class Message:
+    def __init__(self, can_id: int, name: str, dlc: int, sender: str = "") -> None:
+        """A DBC message, signals are added by the parser.
+
+        Args:
+            can_id: CAN ID, CAN_EFF_FLAG set for extended frames
+            name: Message name
+            dlc: Payload length in bytes
+            sender: Transmitting node
+        """
+        self.can_id = can_id
+        self.name = name
+        self.dlc = dlc
+        self.sender = sender
+        self.signals = []  # type: List[Signal]
+        self.multiplexer = None  # type: Optional[Signal]
+        self._compiled = None
+
+    def __repr__(self) -> str:
+        return "Message(%#x, %r, %d signals)" % (self.can_id, self.name, len(self.signals))
+
+    def add_signal(self, signal: Signal) -> None:
+        if not 0 <= _lsb_shift(signal) <= 64 - signal.length:
+            raise ValueError("%s.%s does not fit in 8 bytes" % (self.name, signal.name))
+        self.signals.append(signal)
+        if signal.is_multiplexer:
+            self.multiplexer = signal
+        self._compiled = None
+
+    def signal(self, name: str) -> Signal:
+        for signal in self.signals:
+            if signal.name == name:
+                return signal
+        raise KeyError(name)
+
+    def _compile(self) -> List[Tuple]:
+        """Per signal (signal, big endian, shift, mask, sign bit), the
+        multiplexer first so its column exists for the others."""
+        if self._compiled is None:
+            signals = sorted(self.signals, key=lambda s: not s.is_multiplexer)
+            self._compiled = [
+                (
+                    signal,
+                    not signal.little_endian,
+                    _lsb_shift(signal),
+                    (1 << signal.length) - 1,
+                    1 << signal.length - 1 if signal.signed else 0,
+                )
+                for signal in signals
+            ]
+        return self._compiled
+
+    def decode(self, data: bytes, raw: bool = False) -> Dict[str, Union[int, float]]:
+        """Decode the payload of one frame, works without NumPy.
+
+        Args:
+            data: Payload, shorter payloads are zero padded
+            raw: Return the raw integers instead of scale * raw + offset
+
+        Returns:
+            Dict of signal name -> value, multiplexed signals only when
+            the multiplexer selects them
+        """
+        data = bytes(data[:CAN_MAX_DLEN]).ljust(CAN_MAX_DLEN, b"\0")
+        words = (int.from_bytes(data, "little"), int.from_bytes(data, "big"))
+        values = {}
+        mux = None
+        for signal, big, shift, mask, sign in self._compile():
+            if signal.mux_value is not None and signal.mux_value != mux:
+                continue
+            value = words[big] >> shift & mask
+            if signal.is_multiplexer:
+                mux = value
+            if signal.value_type == SIG_FLOAT32:
+                value = struct.unpack("<f", value.to_bytes(4, "little"))[0]
+            elif signal.value_type == SIG_FLOAT64:
+                value = struct.unpack("<d", value.to_bytes(8, "little"))[0]
+            elif sign:
+                value = (value ^ sign) - sign
+            values[signal.name] = value if raw else value * signal.scale + signal.offset
+        return values
+
+    def decode_batch(self, payload: Any, raw: bool = False) -> Dict[str, Any]:
+        """Decode the payloads of many frames of this message at once.
+
+        Args:
+            payload: Payloads of n frames, 8 bytes each and zero past the
+                DLC, as a bytes-like object of n * 8 bytes (RxRing.payload,
+                a capture block) or an (n, 8) uint8 array
+            raw: Return int64 raw values instead of float64 physical ones,
+                uint64 for unsigned 64 bit signals
+
+        Returns:
+            Dict of signal name -> array of n values. Where the multiplexer
+            selects another value a multiplexed signal is NaN, or 0 in raw
+            mode.
+
+        Raises:
+            ImportError: NumPy is not installed
+        """
+        if np is None:
+            raise ImportError("Message.decode_batch() needs numpy")
+        if isinstance(payload, np.ndarray) and payload.ndim == 2:
+            payload = np.ascontiguousarray(payload, np.uint8)
+        # The same 8 * n bytes as n little and n big endian words
+        words = (np.frombuffer(payload, "<u8"), np.frombuffer(payload, ">u8"))
+        columns = {}
+        mux = None
+        for signal, big, shift, mask, sign in self._compile():
+            value = words[big] >> np.uint64(shift)
+            if signal.length < 64:
+                value = value & np.uint64(mask)
+            if signal.value_type == SIG_FLOAT32:
+                # Signaling NaN bit patterns raise the invalid flag on widening
+                with np.errstate(invalid="ignore"):
+                    value = value.astype(np.uint32).view(np.float32).astype(np.float64)
+            elif signal.value_type == SIG_FLOAT64:
+                value = value.view(np.float64)
+            elif sign and signal.length == 64:
+                value = value.view(np.int64)
+            elif sign:
+                value = (value.astype(np.int64) ^ sign) - sign
+            elif signal.length < 64:
+                value = value.astype(np.int64)
+            if signal.is_multiplexer:
+                mux = value
+            if not raw:
+                value = value.astype(np.float64, copy=False)
+                if signal.scale != 1 or signal.offset != 0:
+                    value = value * signal.scale + signal.offset
+            if signal.mux_value is not None and mux is not None:
+                value = np.where(mux == signal.mux_value, value, 0 if raw else np.nan)
+            columns[signal.name] = value
+        return columns
+
+
+class Database:
+    def __init__(self, messages: Iterable[Message] = ()) -> None:
+        """Messages of a DBC file by CAN ID, see load_dbc()."""
+        self.messages = {}  # type: Dict[int, Message]
+        self._by_name = {}  # type: Dict[str, Message]
+        for message in messages:
+            self.add_message(message)
+
+    def __repr__(self) -> str:
+        return "Database(%d messages)" % len(self.messages)
+
+    def __len__(self) -> int:
+        return len(self.messages)
+
+    def add_message(self, message: Message) -> None:
+        self.messages[message.can_id] = message
+        self._by_name[message.name] = message
+
+    def message(self, key: Union[int, str]) -> Message:
+        """Message by name or by CAN ID, CAN_EFF_FLAG set for extended."""
+        if isinstance(key, str):
+            return self._by_name[key]
+        return self.messages[key]
+
+    def decode(self, can_id: int, data: bytes, raw: bool = False) -> Optional[Dict[str, Any]]:
+        """Decode one frame, None if the ID is not in the database."""
+        message = self.messages.get(can_id & (CAN_EFF_FLAG | CAN_EFF_MASK))
+        if message is None:
+            return None
+        return message.decode(data, raw)
+
+    def decode_columns(self, ids: Any, payload: Any, timestamps: Any = None,
+                       raw: bool = False) -> Dict[str, Dict[str, Any]]:
+        """Decode a batch of frames of mixed IDs.
+
+        The batch is split by ID with one stable sort, then every message
+        is decoded with one Message.decode_batch() call. Remote and error
+        frames and IDs not in the database are skipped.
+
+        Args:
+            ids: n CAN IDs with the EFF/RTR/ERR flags, any integer array
+            payload: n * 8 payload bytes or an (n, 8) uint8 array, zero
+                past the DLC
+            timestamps: n timestamps, returned per message under
+                "timestamp" (default: None)
+            raw: Return int64 raw values instead of float64 physical ones
+
+        Returns:
+            Dict of message name -> dict of signal name -> array. Every
+            message dict also has "index", the positions of its frames in
+            the batch, in order.
+
+        Raises:
+            ImportError: NumPy is not installed
+        """
+        if np is None:
+            raise ImportError("Database.decode_columns() needs numpy")
+        ids = np.asarray(ids, np.uint32)
+        rows = np.frombuffer(payload, np.uint8) if not isinstance(payload, np.ndarray) else payload
+        rows = rows.reshape(-1, CAN_MAX_DLEN)
+        data_frames = (ids & np.uint32(CAN_RTR_FLAG | CAN_ERR_FLAG)) == 0
+        keys = np.where(data_frames, ids, np.uint32(CAN_ERR_FLAG))
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        present, starts = np.unique(sorted_keys, return_index=True)
+        ends = np.append(starts[1:], len(sorted_keys))
+        if timestamps is not None:
+            timestamps = np.asarray(timestamps)
+
+        decoded = {}
+        for key, start, end in zip(present.tolist(), starts.tolist(), ends.tolist()):
+            message = self.messages.get(key)
+            if message is None:
+                continue
+            index = order[start:end]
+            columns = message.decode_batch(rows[index], raw)
+            columns["index"] = index
+            if timestamps is not None:
+                columns["timestamp"] = timestamps[index]
+            decoded[message.name] = columns
+        return decoded
+
+    def decode_array(self, records: Any, raw: bool = False) -> Dict[str, Dict[str, Any]]:
+        """Decode a structured array of CAPTURE_DTYPE, as from
+        CaptureReader.to_array(), timestamps in ns."""
+        return self.decode_columns(records["can_id"], records["data"], records["timestamp_ns"], raw)
+
+    def decode_messages(self, msgs: Iterable[Any], raw: bool = False) -> Dict[str, Dict[str, Any]]:
+        """Decode a list of CanMsg, as from CAN_1.recv_many().
+
+        Building the columns touches every message once, the decoding
+        itself is per message ID.
+        """
+        msgs = list(msgs)
+        ids = [msg.raw_id for msg in msgs]
+        payload = b"".join(msg.data.ljust(CAN_MAX_DLEN, b"\0") for msg in msgs)
+        timestamps = [msg.timestamp for msg in msgs]
+        return self.decode_columns(ids, payload, timestamps, raw)
+
+
+def _number(text: str) -> Union[int, float]:
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+
+def parse_dbc(text: str) -> Database:
+    """Build a Database from the text of a DBC file.
+
+    BO_, SG_ and SIG_VALTYPE_ lines are used, everything else is skipped.
+
+    Raises:
+        ValueError: A signal does not fit in 8 bytes
+    """
+    db = Database()
+    message = None
+    value_types = []
+    for line in text.splitlines():
+        line = line.strip()
+        match = _BO.match(line)
+        if match:
+            dbc_id, name, dlc, sender = match.groups()
+            dbc_id = int(dbc_id)
+            if dbc_id & DBC_EXTENDED:
+                can_id = CAN_EFF_FLAG | dbc_id & CAN_EFF_MASK
+            else:
+                can_id = dbc_id & CAN_EFF_MASK
+            message = Message(can_id, name, int(dlc), sender)
+            db.add_message(message)
+            continue
+        match = _SG.match(line)
+        if match:
+            if message is None:
+                continue
+            (name, mux, start, length, order, sign, scale, offset,
+             minimum, maximum, unit) = match.groups()
+            mux_value = None
+            if mux and mux.startswith("m"):
+                mux_value = int(mux[1:].rstrip("M"))
+            message.add_signal(Signal(
+                name, int(start), int(length), order == "1", sign == "-",
+                _number(scale), _number(offset),
+                _number(minimum) if minimum else 0, _number(maximum) if maximum else 0,
+                unit, mux_value, bool(mux) and mux.endswith("M"), SIG_INTEGER,
+            ))
+            continue
+        match = _VALTYPE.match(line)
+        if match:
+            value_types.append(match.groups())
+
+    for dbc_id, name, value_type in value_types:
+        dbc_id = int(dbc_id)
+        can_id = CAN_EFF_FLAG | dbc_id & CAN_EFF_MASK if dbc_id & DBC_EXTENDED else dbc_id
+        found = db.messages.get(can_id)
+        if found is None:
+            continue
+        found.signals = [
+            signal._replace(value_type=int(value_type)) if signal.name == name else signal
+            for signal in found.signals
+        ]
+        found._compiled = None
+    return db
+
+
+def load_dbc(path: str, encoding: str = "cp1252") -> Database:
+    """Parse a DBC file, see parse_dbc().
+
+    Args:
+        path: DBC file name
+        encoding: Text encoding, DBC editors write cp1252 by default
+    """
+    with open(path, encoding=encoding, errors="replace") as f:
+        return parse_dbc(f.read())
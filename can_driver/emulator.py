@@ -0,0 +1,514 @@
+'''
+emulator.py
+Register level software model of the MCP2515
+MCP2515Emulator has the transaction() interface of rpi_spi.SPI, so the
+driver can be exercised and benchmarked without a Pi, spidev or a
+transceiver:
+
+    bus = CAN_1(spi_interface=MCP2515Emulator(bitrate=500000))
+
+Frames from other nodes are injected at the simulated bus rate, frames
+sent in normal mode go to connected emulators, loopback mode receives
+its own frames. Errors, bit stuffing, one shot mode and arbitration
+between connected emulators are not modelled.
+'''
+import collections
+import threading
+import time
+from typing import Any, Callable, List, Optional
+
+from .constants import (
+    CANCTRL_ABAT,
+    CANCTRL_REQOP,
+    CANCTRL_REQOP_MODE,
+    CANCTRL_RESET,
+    CANINTF,
+    CANSTAT_OPMOD,
+    DLC_MASK,
+    EFLG,
+    INSTRUCTION,
+    REGISTER,
+    RTR_MASK,
+    RXB0CTRL_BUKT,
+    RXBnCTRL_RTR,
+    TXB_EXIDE_MASK,
+    TXBnCTRL,
+)
+from .can import CAN_EFF_FLAG, CAN_EFF_MASK, CAN_RTR_FLAG, CAN_SFF_MASK
+
+# Registers that accept the BIT MODIFY instruction, a BITMOD on any other
+# register behaves like a WRITE with a mask of 0xFF
+BITMOD_REGISTERS = frozenset(
+    [0x0C, 0x0D, 0x0F, 0x28, 0x29, 0x2A, 0x2B, 0x2C, 0x2D, 0x30, 0x40, 0x50, 0x60, 0x70]
+)
+
+# Registers that can only be written in configuration mode
+CONFIG_ONLY_REGISTERS = frozenset(
+    list(range(0x00, 0x0C)) + list(range(0x10, 0x1C)) + list(range(0x20, 0x2B))
+)
+
+TXB_CTRL = (REGISTER.MCP_TXB0CTRL, REGISTER.MCP_TXB1CTRL, REGISTER.MCP_TXB2CTRL)
+TX_IF = (CANINTF.CANINTF_TX0IF, CANINTF.CANINTF_TX1IF, CANINTF.CANINTF_TX2IF)
+RXB_CTRL = (REGISTER.MCP_RXB0CTRL, REGISTER.MCP_RXB1CTRL)
+RX_IF = (CANINTF.CANINTF_RX0IF, CANINTF.CANINTF_RX1IF)
+RX_OVR = (EFLG.EFLG_RX0OVR, EFLG.EFLG_RX1OVR)
+
+FILTER_REGS = (
+    REGISTER.MCP_RXF0SIDH,
+    REGISTER.MCP_RXF1SIDH,
+    REGISTER.MCP_RXF2SIDH,
+    REGISTER.MCP_RXF3SIDH,
+    REGISTER.MCP_RXF4SIDH,
+    REGISTER.MCP_RXF5SIDH,
+)
+MASK_REGS = (REGISTER.MCP_RXM0SIDH, REGISTER.MCP_RXM1SIDH)
+
+# RXBnCTRL.RXM = 11 turns masks and filters off
+RXM_ANY = 0x60
+SIDL_SRR = 0x10
+# Frames kept in MCP2515Emulator.tx_log
+TX_LOG_SIZE = 100000
+
+
+def frame_bits(can_id: int, dlc: int) -> int:
+    """Approximate length of a frame on the wire, without bit stuffing."""
+    if can_id & CAN_RTR_FLAG:
+        dlc = 0
+    base = 67 if can_id & CAN_EFF_FLAG else 47
+    return base + 8 * dlc
+
+
+class MCP2515Emulator:
+    def __init__(
+        self,
+        bitrate: int = 500000,
+        transfer_latency: float = 0.0,
+        spi_hz: Optional[int] = None,
+        clock: Callable[[], float] = time.perf_counter,
+        on_interrupt: Optional[Callable[[], None]] = None,
+    ) -> None:
+        """Software MCP2515 with the SPI transaction interface of rpi_spi.SPI.
+
+        Args:
+            bitrate: Simulated CAN bus bitrate, used to pace TX and injected RX
+            transfer_latency: Fixed cost in seconds added to every transaction
+            spi_hz: SPI clock, adds 8 bits per byte of transfer time if set
+            clock: Monotonic time source in seconds
+            on_interrupt: Called when the INT pin goes from high to low
+        """
+        self.bitrate = bitrate
+        self.transfer_latency = transfer_latency
+        self.spi_hz = spi_hz
+        self.clock = clock
+        self.on_interrupt = on_interrupt
+        self._int_level = False
+
+        self.transactions = 0
+        self.bytes = 0
+
+        # Frames put on the bus by this controller, (time, can_id, data)
+        self.tx_log = collections.deque(maxlen=TX_LOG_SIZE)
+        self.peers = []  # type: List[MCP2515Emulator]
+
+        # The INT pin and bus side can be polled from other threads
+        self._lock = threading.RLock()
+        # Injected frames, (earliest start, can_id, data), paced by the bus
+        self._rx_pending = collections.deque()
+        # Frames a peer finished sending, (time, can_id, data). Peers only
+        # append here so no emulator ever takes another one's lock.
+        self._rx_delivered = collections.deque()
+        self._bus_free_at = 0.0
+        self._tx_done = []  # type: List[Any]
+        self._tx_ready_at = [0.0, 0.0, 0.0]
+        self.regs = bytearray(0x80)
+        self._reset_registers()
+
+    # SPI interface
+
+    def transaction(self, tx):
+        """Run one CS-low..CS-high instruction and return the bytes read back."""
+        with self._lock:
+            rx = self._transaction(tx)
+        self._update_int()
+        return rx
+
+    def _transaction(self, tx):
+        self.transactions += 1
+        self.bytes += len(tx)
+        cost = self.transfer_latency
+        if self.spi_hz:
+            cost += 8.0 * len(tx) / self.spi_hz
+        if cost:
+            end = self.clock() + cost
+            while self.clock() < end:
+                pass
+        self._advance()
+
+        rx = [0] * len(tx)
+        if not tx:
+            return rx
+        op = tx[0]
+        if op == INSTRUCTION.INSTRUCTION_RESET:
+            self._reset_registers()
+        elif op == INSTRUCTION.INSTRUCTION_READ and len(tx) > 2:
+            addr = tx[1]
+            for i in range(2, len(tx)):
+                rx[i] = self.regs[addr & 0x7F]
+                addr += 1
+        elif op == INSTRUCTION.INSTRUCTION_WRITE and len(tx) > 2:
+            addr = tx[1]
+            for v in tx[2:]:
+                self._write(addr & 0x7F, v, 0xFF)
+                addr += 1
+        elif op == INSTRUCTION.INSTRUCTION_BITMOD and len(tx) >= 4:
+            reg, mask = tx[1], tx[2]
+            if reg not in BITMOD_REGISTERS:
+                mask = 0xFF
+            self._write(reg, tx[3], mask)
+        elif op == INSTRUCTION.INSTRUCTION_READ_STATUS:
+            status = self._status()
+            for i in range(1, len(tx)):
+                rx[i] = status
+        elif op == INSTRUCTION.INSTRUCTION_RX_STATUS:
+            status = self._rx_status()
+            for i in range(1, len(tx)):
+                rx[i] = status
+        elif op & 0xF9 == INSTRUCTION.INSTRUCTION_READ_RX0:
+            n = (op >> 2) & 0x01
+            addr = RXB_CTRL[n] + (6 if op & 0x02 else 1)
+            for i in range(1, len(tx)):
+                rx[i] = self.regs[addr]
+                addr = (addr + 1) & 0x7F
+            self.regs[REGISTER.MCP_CANINTF] &= ~RX_IF[n] & 0xFF
+        elif op & 0xF8 == INSTRUCTION.INSTRUCTION_LOAD_TX0:
+            n = (op >> 1) & 0x03
+            if n < 3:
+                addr = TXB_CTRL[n] + (6 if op & 0x01 else 1)
+                for v in tx[1:]:
+                    self.regs[addr] = v
+                    addr += 1
+        elif op & 0xF0 == 0x80 and op & 0x07:
+            for n in range(3):
+                if op & (1 << n):
+                    self._write(TXB_CTRL[n], TXBnCTRL.TXB_TXREQ, TXBnCTRL.TXB_TXREQ)
+        self._advance()
+        return rx
+
+    def stats(self) -> dict:
+        """SPI counters in the format of rpi_spi.SPI.stats()."""
+        return {"transactions": self.transactions, "bytes": self.bytes,
+                "cs_toggles": 0, "sleep_ns": 0}
+
+    def reset_stats(self) -> None:
+        self.transactions = 0
+        self.bytes = 0
+
+    def cleanup(self) -> None:
+        pass
+
+    # Bus side
+
+    def connect(self, other: "MCP2515Emulator") -> None:
+        """Put two emulated controllers on the same bus."""
+        self.peers.append(other)
+        other.peers.append(self)
+
+    def inject(self, can_id: int, data: bytes = b"", at: Optional[float] = None) -> None:
+        """Queue a frame from another node on the bus.
+
+        Args:
+            can_id: Identifier with CAN_EFF_FLAG/CAN_RTR_FLAG set as needed
+            data: Payload, up to 8 bytes
+            at: Earliest arrival time, default is as soon as the bus is free
+        """
+        if at is None:
+            at = self.clock()
+        with self._lock:
+            self._rx_pending.append((at, can_id, bytes(data)))
+
+    def inject_many(self, frames, rate: Optional[float] = None) -> None:
+        """Queue frames arriving back to back, or at `rate` frames/sec."""
+        t = self.clock()
+        with self._lock:
+            for can_id, data in frames:
+                self._rx_pending.append((t, can_id, bytes(data)))
+                if rate:
+                    t += 1.0 / rate
+
+    @property
+    def pending(self) -> int:
+        """Injected frames that have not reached the controller yet."""
+        return len(self._rx_pending)
+
+    @property
+    def mode(self) -> int:
+        return self.regs[REGISTER.MCP_CANSTAT] & CANSTAT_OPMOD
+
+    @property
+    def interrupt(self) -> bool:
+        """Level of the active-low INT pin, True while asserted."""
+        with self._lock:
+            self._advance()
+            return self._int_asserted()
+
+    def poll(self) -> None:
+        """Let simulated bus time pass without an SPI transaction."""
+        with self._lock:
+            self._advance()
+        self._update_int()
+
+    # Internals
+
+    def _int_asserted(self) -> bool:
+        return bool(self.regs[REGISTER.MCP_CANINTF] & self.regs[REGISTER.MCP_CANINTE])
+
+    def _update_int(self) -> None:
+        with self._lock:
+            level = self._int_asserted()
+            edge = level and not self._int_level
+            self._int_level = level
+        if edge and self.on_interrupt is not None:
+            self.on_interrupt()
+
+    def _reset_registers(self) -> None:
+        self.regs[:] = bytes(0x80)
+        self.regs[REGISTER.MCP_CANSTAT] = CANCTRL_REQOP_MODE.CANCTRL_REQOP_CONFIG
+        self.regs[REGISTER.MCP_CANCTRL] = CANCTRL_RESET
+        self._tx_done = []
+
+    def _write(self, reg: int, value: int, mask: int) -> None:
+        mode = self.mode
+        if reg in CONFIG_ONLY_REGISTERS and mode != CANCTRL_REQOP_MODE.CANCTRL_REQOP_CONFIG:
+            return
+        if reg == REGISTER.MCP_CANSTAT or reg in (REGISTER.MCP_TEC, REGISTER.MCP_REC):
+            return
+        old = self.regs[reg]
+        new = (old & ~mask | value & mask) & 0xFF
+
+        if reg in TXB_CTRL:
+            # Only TXREQ and TXP are writable from the host
+            writable = TXBnCTRL.TXB_TXREQ | TXBnCTRL.TXB_TXP
+            new = old & ~writable | new & writable
+            n = TXB_CTRL.index(reg)
+            if new & TXBnCTRL.TXB_TXREQ and not old & TXBnCTRL.TXB_TXREQ:
+                self._tx_ready_at[n] = self.clock()
+                # Setting TXREQ clears the previous attempt's status bits
+                new &= ~(TXBnCTRL.TXB_ABTF | TXBnCTRL.TXB_MLOA | TXBnCTRL.TXB_TXERR)
+            elif old & TXBnCTRL.TXB_TXREQ and not new & TXBnCTRL.TXB_TXREQ:
+                new |= TXBnCTRL.TXB_ABTF
+                self._tx_done = [d for d in self._tx_done if d[1] != n]
+            self.regs[reg] = new
+            return
+        if reg in RXB_CTRL:
+            writable = 0x64 if reg == REGISTER.MCP_RXB0CTRL else 0x60
+            new = old & ~writable | new & writable
+        elif reg == REGISTER.MCP_EFLG:
+            # Only the overflow flags can be cleared by the host
+            new = old & ~(EFLG.EFLG_RX0OVR | EFLG.EFLG_RX1OVR) | new & old & (
+                EFLG.EFLG_RX0OVR | EFLG.EFLG_RX1OVR
+            )
+        self.regs[reg] = new
+
+        if reg == REGISTER.MCP_CANCTRL:
+            reqop = new & CANCTRL_REQOP
+            self.regs[REGISTER.MCP_CANSTAT] = (
+                self.regs[REGISTER.MCP_CANSTAT] & ~CANSTAT_OPMOD | reqop
+            )
+            if new & CANCTRL_ABAT:
+                for n, ctrl in enumerate(TXB_CTRL):
+                    if self.regs[ctrl] & TXBnCTRL.TXB_TXREQ:
+                        self.regs[ctrl] = (self.regs[ctrl] & ~TXBnCTRL.TXB_TXREQ) | TXBnCTRL.TXB_ABTF
+                self._tx_done = []
+
+    def _status(self) -> int:
+        intf = self.regs[REGISTER.MCP_CANINTF]
+        status = intf & 0x03
+        for n, ctrl in enumerate(TXB_CTRL):
+            if self.regs[ctrl] & TXBnCTRL.TXB_TXREQ:
+                status |= 0x04 << (2 * n)
+            if intf & TX_IF[n]:
+                status |= 0x08 << (2 * n)
+        return status
+
+    def _rx_status(self) -> int:
+        intf = self.regs[REGISTER.MCP_CANINTF]
+        rx = intf & 0x03
+        status = rx << 6
+        if rx:
+            n = 0 if rx & 0x01 else 1
+            base = RXB_CTRL[n]
+            ext = self.regs[base + 2] & TXB_EXIDE_MASK
+            ctrl = self.regs[base]
+            status |= (0x10 if ext else 0) | (0x08 if ctrl & RXBnCTRL_RTR else 0)
+            status |= ctrl & (0x01 if n == 0 else 0x07)
+        return status
+
+    def _advance(self) -> None:
+        now = self.clock()
+        while self._rx_delivered and self._rx_delivered[0][0] <= now:
+            _, can_id, data = self._rx_delivered.popleft()
+            if self.mode not in (
+                CANCTRL_REQOP_MODE.CANCTRL_REQOP_CONFIG,
+                CANCTRL_REQOP_MODE.CANCTRL_REQOP_SLEEP,
+                CANCTRL_REQOP_MODE.CANCTRL_REQOP_LOOPBACK,
+            ):
+                self._receive(can_id, data)
+        while True:
+            if self._tx_done:
+                done_at, n, can_id, data = self._tx_done[0]
+                if done_at > now:
+                    break
+                self._tx_done.pop(0)
+                self._complete_tx(n, done_at, can_id, data)
+                continue
+
+            # The bus is idle, pick whichever frame would start next
+            mode = self.mode
+            idle = self._bus_free_at
+            txn = None
+            tx_start = None
+            if mode in (
+                CANCTRL_REQOP_MODE.CANCTRL_REQOP_NORMAL,
+                CANCTRL_REQOP_MODE.CANCTRL_REQOP_LOOPBACK,
+            ):
+                txn = self._next_tx()
+                if txn is not None:
+                    tx_start = max(idle, self._tx_ready_at[txn])
+            rx_start = None
+            if self._rx_pending and mode != CANCTRL_REQOP_MODE.CANCTRL_REQOP_LOOPBACK:
+                rx_start = max(idle, self._rx_pending[0][0])
+
+            if tx_start is not None and (rx_start is None or tx_start <= rx_start):
+                if tx_start > now:
+                    break
+                can_id, data = self._load_tx(txn)
+                done = tx_start + frame_bits(can_id, len(data)) / float(self.bitrate)
+                self._bus_free_at = done
+                self._tx_done.append((done, txn, can_id, data))
+                continue
+            if rx_start is not None:
+                _, can_id, data = self._rx_pending[0]
+                done = rx_start + frame_bits(can_id, len(data)) / float(self.bitrate)
+                if done > now:
+                    break
+                self._rx_pending.popleft()
+                self._bus_free_at = done
+                if mode not in (
+                    CANCTRL_REQOP_MODE.CANCTRL_REQOP_CONFIG,
+                    CANCTRL_REQOP_MODE.CANCTRL_REQOP_SLEEP,
+                ):
+                    self._receive(can_id, data)
+                continue
+            break
+
+    def _next_tx(self) -> Optional[int]:
+        best = None
+        best_prio = -1
+        for n in (2, 1, 0):
+            ctrl = self.regs[TXB_CTRL[n]]
+            if ctrl & TXBnCTRL.TXB_TXREQ and (ctrl & TXBnCTRL.TXB_TXP) > best_prio:
+                best, best_prio = n, ctrl & TXBnCTRL.TXB_TXP
+        return best
+
+    def _load_tx(self, n: int):
+        base = TXB_CTRL[n] + 1
+        sidh, sidl, eid8, eid0, dlc = self.regs[base:base + 5]
+        can_id = (sidh << 3) | (sidl >> 5)
+        if sidl & TXB_EXIDE_MASK:
+            can_id = (can_id << 18) | ((sidl & 0x03) << 16) | (eid8 << 8) | eid0
+            can_id |= CAN_EFF_FLAG
+        if dlc & RTR_MASK:
+            can_id |= CAN_RTR_FLAG
+        length = min(dlc & DLC_MASK, 8)
+        data = bytes(self.regs[base + 5:base + 5 + length])
+        return can_id, data
+
+    def _complete_tx(self, n: int, when: float, can_id: int, data: bytes) -> None:
+        ctrl = TXB_CTRL[n]
+        self.regs[ctrl] &= ~TXBnCTRL.TXB_TXREQ & 0xFF
+        self.regs[REGISTER.MCP_CANINTF] |= TX_IF[n]
+        self.tx_log.append((when, can_id, data))
+        if self.mode == CANCTRL_REQOP_MODE.CANCTRL_REQOP_LOOPBACK:
+            self._receive(can_id, data)
+        else:
+            for peer in self.peers:
+                peer._rx_delivered.append((when, can_id, data))
+
+    def _match(self, can_id: int, data: bytes, filt: int, mask: int) -> bool:
+        f = self.regs[filt:filt + 4]
+        m = self.regs[mask:mask + 4]
+        ext = bool(can_id & CAN_EFF_FLAG)
+        if bool(f[1] & TXB_EXIDE_MASK) != ext:
+            return False
+        if ext:
+            ident = can_id & CAN_EFF_MASK
+            fid = ((f[0] << 3 | f[1] >> 5) << 18) | ((f[1] & 0x03) << 16) | (f[2] << 8) | f[3]
+            mid = ((m[0] << 3 | m[1] >> 5) << 18) | ((m[1] & 0x03) << 16) | (m[2] << 8) | m[3]
+            return (ident ^ fid) & mid == 0
+        ident = can_id & CAN_SFF_MASK
+        fid = f[0] << 3 | f[1] >> 5
+        mid = m[0] << 3 | m[1] >> 5
+        if (ident ^ fid) & mid:
+            return False
+        # The EID bytes of a standard filter apply to the first two data bytes
+        if can_id & CAN_RTR_FLAG:
+            return True
+        d = (data + b"\x00\x00")[:2]
+        return (d[0] ^ f[2]) & m[2] == 0 and (d[1] ^ f[3]) & m[3] == 0
+
+    def _accept(self, n: int, can_id: int, data: bytes) -> Optional[int]:
+        if self.regs[RXB_CTRL[n]] & RXM_ANY == RXM_ANY:
+            return 0 if n == 0 else 1
+        mask = MASK_REGS[n]
+        filters = (0, 1) if n == 0 else (2, 3, 4, 5)
+        for ft in filters:
+            if self._match(can_id, data, FILTER_REGS[ft], mask):
+                return ft
+        return None
+
+    def _receive(self, can_id: int, data: bytes) -> None:
+        intf = self.regs[REGISTER.MCP_CANINTF]
+        target = None
+        filhit = 0
+        ft = self._accept(0, can_id, data)
+        if ft is not None:
+            if not intf & RX_IF[0]:
+                target, filhit = 0, ft
+            elif self.regs[REGISTER.MCP_RXB0CTRL] & RXB0CTRL_BUKT:
+                target, filhit = 1, ft
+            else:
+                self._overflow(0)
+                return
+        else:
+            ft = self._accept(1, can_id, data)
+            if ft is None:
+                return
+            target, filhit = 1, ft
+        if intf & RX_IF[target]:
+            self._overflow(target)
+            return
+
+        base = RXB_CTRL[target]
+        ext = can_id & CAN_EFF_FLAG
+        rtr = can_id & CAN_RTR_FLAG
+        if ext:
+            ident = can_id & CAN_EFF_MASK
+            sid = ident >> 18
+            sidl = ((sid & 0x07) << 5) | TXB_EXIDE_MASK | ((ident >> 16) & 0x03)
+            hdr = [sid >> 3, sidl, (ident >> 8) & 0xFF, ident & 0xFF]
+        else:
+            ident = can_id & CAN_SFF_MASK
+            hdr = [ident >> 3, ((ident & 0x07) << 5) | (SIDL_SRR if rtr else 0), 0, 0]
+        dlc = len(data) | (RTR_MASK if rtr and ext else 0)
+        self.regs[base + 1:base + 6] = bytes(hdr + [dlc])
+        self.regs[base + 6:base + 6 + len(data)] = data
+        ctrl = self.regs[base] & 0x64
+        if rtr:
+            ctrl |= RXBnCTRL_RTR
+        ctrl |= filhit & (0x01 if target == 0 else 0x07)
+        self.regs[base] = ctrl
+        self.regs[REGISTER.MCP_CANINTF] |= RX_IF[target]
+
+    def _overflow(self, n: int) -> None:
+        self.regs[REGISTER.MCP_EFLG] |= RX_OVR[n]
+        self.regs[REGISTER.MCP_CANINTF] |= CANINTF.CANINTF_ERRIF
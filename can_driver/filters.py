@@ -0,0 +1,278 @@
+'''
+filters.py
+Acceptance filter planning for the MCP2515
+Turns the set of CAN IDs an application wants into values for the 2 masks
+and 6 filters that let as few other frames through as possible, plus an
+exact software check for whatever the hardware still lets through
+'''
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union
+
+from .can import CAN_EFF_FLAG, CAN_EFF_MASK, CAN_SFF_MASK
+
+# Mask and filter registers hold a 29 bit ID, a standard ID sits in the
+# top 11 bits (SID10:0) and the low 18 bits are the extension
+EID_BITS = 18
+# For standard frames EID15:0 of the mask and filter are compared against
+# the first two data bytes, so a mask shared with standard filters must
+# leave them open. EID17:16 are ignored for standard frames.
+EID_DATA_MASK = 0xFFFF
+# Filters per receive buffer: RXB0 has RXF0-1 under RXM0, RXB1 has RXF2-5
+# under RXM1
+BUFFER_FILTERS = (2, 4)
+# Partitions that split the wanted IDs on a single bit are only tried for
+# up to this many blocks, the search is quadratic in the ID bits
+SPLIT_SEARCH_LIMIT = 512
+
+IdSpec = Iterable[Union[int, range]]
+# (extended, value, mask) in 29 bit register layout, see _to_blocks()
+Block = Tuple[bool, int, int]
+
+
+class IdSet:
+    def __init__(self, std_blocks: List[Block], ext_blocks: List[Block]) -> None:
+        """Exact membership test for the wanted IDs.
+
+        Blocks are grouped by mask, so a test costs one set lookup per
+        distinct mask, a single lookup for a plain list of IDs.
+        """
+        self._std = self._group(std_blocks, EID_BITS)
+        self._ext = self._group(ext_blocks, 0)
+
+    @staticmethod
+    def _group(blocks: List[Block], shift: int) -> List[Tuple[int, Set[int]]]:
+        groups = {}  # type: Dict[int, Set[int]]
+        for _, value, mask in blocks:
+            groups.setdefault(mask >> shift, set()).add(value >> shift)
+        # Widest blocks first, they are the most likely to match
+        return sorted(groups.items(), key=lambda item: bin(item[0]).count("1"))
+
+    def __contains__(self, can_id: int) -> bool:
+        """Test a CAN ID including the EFF flag, RTR/ERR flags are ignored."""
+        if can_id & CAN_EFF_FLAG:
+            ident = can_id & CAN_EFF_MASK
+            groups = self._ext
+        else:
+            ident = can_id & CAN_SFF_MASK
+            groups = self._std
+        for mask, values in groups:
+            if ident & mask in values:
+                return True
+        return False
+
+
+class FilterPlan:
+    def __init__(self, masks: List[int], filters: List[Tuple[bool, int]],
+                 ids: IdSet, wanted: int, accepted: int) -> None:
+        """Register values for the MCP2515 acceptance filters.
+
+        Args:
+            masks: RXM0 and RXM1 as 29 bit values
+            filters: RXF0-5 as (extended, ID), a standard ID is 11 bits
+            ids: Exact software check for received frames
+            wanted: Number of IDs asked for
+            accepted: Number of IDs the hardware lets through
+        """
+        self.masks = masks
+        self.filters = filters
+        self.ids = ids
+        self.wanted = wanted
+        self.accepted = accepted
+
+    @property
+    def passthrough_ratio(self) -> float:
+        """IDs the hardware accepts per wanted ID, 1.0 is an exact match.
+
+        This is the share of unwanted traffic reaching the host if all IDs
+        are equally likely on the bus.
+        """
+        return self.accepted / self.wanted if self.wanted else 1.0
+
+    @property
+    def exact(self) -> bool:
+        """True if the hardware alone filters exactly."""
+        return self.accepted == self.wanted
+
+    def __str__(self) -> str:
+        lines = ["RXM%d 0x%08X" % (n, mask) for n, mask in enumerate(self.masks)]
+        for n, (ext, value) in enumerate(self.filters):
+            lines.append("RXF%d %s 0x%08X" % (n, "EXT" if ext else "STD", value))
+        lines.append("pass-through ratio %.3f" % self.passthrough_ratio)
+        return "\n".join(lines)
+
+
+def plan_filters(std_ids: IdSpec = (), ext_ids: IdSpec = ()) -> Optional[FilterPlan]:
+    """Compute mask and filter values that accept the given IDs.
+
+    Every wanted ID is always accepted. Among the assignments tried, the
+    one accepting the fewest other IDs wins.
+
+    Args:
+        std_ids: 11 bit IDs, ints and/or range objects
+        ext_ids: 29 bit IDs, ints and/or range objects
+
+    Returns:
+        FilterPlan, or None if no ID was given
+    """
+    std_blocks = _to_blocks(std_ids, CAN_SFF_MASK, False)
+    ext_blocks = _to_blocks(ext_ids, CAN_EFF_MASK, True)
+    blocks = std_blocks + ext_blocks
+    if not blocks:
+        return None
+    wanted = sum(_block_size(block) for block in blocks)
+
+    candidates = [(blocks, [])]
+    if std_blocks and ext_blocks:
+        candidates.append((std_blocks, ext_blocks))
+        candidates.append((ext_blocks, std_blocks))
+    if len(blocks) <= SPLIT_SEARCH_LIMIT:
+        for bit in range(29):
+            ones = [block for block in blocks if block[1] >> bit & 1 and block[2] >> bit & 1]
+            if ones and len(ones) < len(blocks):
+                picked = set(ones)
+                zeros = [block for block in blocks if block not in picked]
+                candidates.append((ones, zeros))
+                candidates.append((zeros, ones))
+
+    best = None
+    for rxb1, rxb0 in candidates:
+        plan1 = _plan_buffer(rxb1, BUFFER_FILTERS[1])
+        if rxb0:
+            plan0 = _plan_buffer(rxb0, BUFFER_FILTERS[0])
+        else:
+            # RXB0 only repeats filters of RXB1, so it accepts nothing more
+            plan0 = (plan1[0], plan1[1][:BUFFER_FILTERS[0]])
+        accepted = _union_size(plan0, plan1)
+        if best is None or accepted < best[0]:
+            best = (accepted, plan0, plan1)
+
+    accepted, (mask0, filters0), (mask1, filters1) = best
+    filters = _pad(filters0, BUFFER_FILTERS[0]) + _pad(filters1, BUFFER_FILTERS[1])
+    return FilterPlan(
+        [mask0, mask1],
+        [(ext, value if ext else value >> EID_BITS) for ext, value in filters],
+        IdSet(std_blocks, ext_blocks),
+        wanted,
+        accepted,
+    )
+
+
+def _to_blocks(ids: IdSpec, id_mask: int, ext: bool) -> List[Block]:
+    """Split the IDs into disjoint aligned power of two blocks.
+
+    A block (ext, value, mask) holds every ID with id & mask == value. All
+    values and masks use the 29 bit register layout, so a standard block
+    is shifted up by EID_BITS with the low bits of its mask set.
+    """
+    intervals = []
+    for item in ids:
+        if isinstance(item, range):
+            if item.step != 1:
+                intervals.extend((i, i + 1) for i in item)
+            elif len(item):
+                intervals.append((item.start, item.stop))
+        else:
+            intervals.append((item, item + 1))
+    for start, stop in intervals:
+        if start < 0 or stop - 1 > id_mask:
+            raise ValueError("CAN ID out of range: 0x%X" % (stop - 1))
+
+    merged = []
+    for start, stop in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], stop)
+        else:
+            merged.append([start, stop])
+
+    shift = 0 if ext else EID_BITS
+    low = 0 if ext else (1 << EID_BITS) - 1
+    blocks = []
+    for start, stop in merged:
+        while start < stop:
+            # Largest aligned block starting at start that fits
+            size = start & -start if start else 1 << 29
+            while size > stop - start:
+                size >>= 1
+            mask = id_mask & ~(size - 1)
+            blocks.append((ext, start << shift, mask << shift | low))
+            start += size
+    return blocks
+
+
+def _block_size(block: Block) -> int:
+    ext, _, mask = block
+    return 1 << (29 - bin(mask).count("1")) if ext else 1 << (11 - bin(mask >> EID_BITS).count("1"))
+
+
+def _filter_keys(blocks: List[Block], mask: int) -> Set[Tuple[bool, int]]:
+    return {(ext, value & mask) for ext, value, _ in blocks}
+
+
+def _plan_buffer(blocks: List[Block], n_filters: int) -> Tuple[int, List[Tuple[bool, int]]]:
+    """Find the most specific mask for which blocks need at most n_filters.
+
+    Starts from the bits every block fixes and greedily opens the mask bit
+    that merges the most filters until they fit.
+
+    Returns:
+        Tuple with (mask, list of (extended, filter value))
+    """
+    mask = CAN_EFF_MASK
+    for _, _, block_mask in blocks:
+        mask &= block_mask
+    if any(not ext for ext, _, _ in blocks):
+        mask &= ~EID_DATA_MASK
+
+    keys = _filter_keys(blocks, mask)
+    while len(keys) > n_filters:
+        best = None
+        for bit in range(29):
+            if not mask >> bit & 1:
+                continue
+            trial = _filter_keys(blocks, mask & ~(1 << bit))
+            if best is None or len(trial) < len(best[1]):
+                best = (bit, trial)
+        mask &= ~(1 << best[0])
+        keys = best[1]
+    return mask, sorted(keys)
+
+
+def _pad(filters: List[Tuple[bool, int]], n: int) -> List[Tuple[bool, int]]:
+    # Unused filters repeat a used one, so they do not accept anything new
+    return (filters * n)[:n]
+
+
+def _union_size(*plans: Tuple[int, List[Tuple[bool, int]]]) -> int:
+    """Number of IDs accepted by the filters of all buffers together."""
+    std = set()
+    ext = set()
+    for mask, filters in plans:
+        for is_ext, value in filters:
+            if is_ext:
+                ext.add((value, mask))
+            else:
+                std.add((value >> EID_BITS, mask >> EID_BITS & CAN_SFF_MASK))
+    return _union_count(list(std), 11) + _union_count(list(ext), 29)
+
+
+def _union_count(blocks: List[Tuple[int, int]], bits: int) -> int:
+    # Inclusion-exclusion over at most 6 filters
+    total = 0
+    n = len(blocks)
+    for subset in range(1, 1 << n):
+        value = 0
+        mask = 0
+        disjoint = False
+        for i in range(n):
+            if not subset >> i & 1:
+                continue
+            v, m = blocks[i]
+            if (value ^ v) & mask & m:
+                disjoint = True
+                break
+            value |= v & m
+            mask |= m
+        if disjoint:
+            continue
+        size = 1 << (bits - bin(mask).count("1"))
+        total += size if bin(subset).count("1") % 2 else -size
+    return total
@@ -0,0 +1,141 @@
+'''
+group.py
+One I/O thread servicing several MCP2515 controllers
+Dual CAN HATs put two controllers on CE0/CE1 of SPI0, more can sit on SPI1.
+Instead of a thread per CAN_1 a CanGroup runs a single thread that wakes
+on the INT edge or send() of any member, services the controllers with INT
+asserted first and then those with queued frames and a free TX buffer.
+Each bus keeps its own RX ring and TX scheduler, transactions on a shared
+SPI bus are serialized by rpi_spi.SPI
+'''
+import threading
+
+from .CAN import INT_IDLE_TIMEOUT, RX_POLL_INTERVAL
+from .rpi_spi import GPIO
+
+
+class CanGroup:
+    def __init__(self, buses=()):
+        """Service the given CAN_1 objects from one I/O thread.
+
+        Args:
+            buses: CAN_1 objects to add right away, begin() must have
+                succeeded on each (default: none)
+        """
+        self._buses = []
+        # Set by the INT edge and send() of every member
+        self._wake = threading.Event()
+        # Held for a whole pass, so remove() never detaches a bus mid pass
+        self._pass_lock = threading.RLock()
+        self._thread = None
+        self._running = False
+        for bus in buses:
+            self.add(bus)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __len__(self):
+        return len(self._buses)
+
+    @property
+    def buses(self):
+        return list(self._buses)
+
+    def add(self, bus, on_message=None):
+        """Move a bus to the group thread, stopping its own I/O thread.
+
+        begin() keeps the bus in its group. Frames go to recv() of the bus
+        unless on_message is given.
+
+        Args:
+            bus: CAN_1 object
+            on_message: Called from the group thread for every message
+                received on this bus (default: None)
+        """
+        if bus._io_group is self:
+            return
+        bus._stop_io(cancel_tx=False)
+        with self._pass_lock:
+            bus._attach_io(on_message, self._wake)
+            bus._io_group = self
+            self._buses.append(bus)
+            if self._thread is None:
+                self._running = True
+                self._thread = threading.Thread(
+                    target=self._io_loop, name="can-group-io", daemon=True
+                )
+                self._thread.start()
+            # send() queues for the I/O thread while this is set
+            bus._io_thread = self._thread
+        self._wake.set()
+
+    def remove(self, bus, cancel_tx=True):
+        """Stop servicing a bus, the thread exits with the last one.
+
+        Args:
+            bus: CAN_1 object in this group
+            cancel_tx: Fail the frames still queued for the bus
+                (default: True)
+        """
+        with self._pass_lock:
+            if bus not in self._buses:
+                return
+            self._buses.remove(bus)
+            bus._io_group = None
+            bus._io_thread = None
+            bus._detach_io(cancel_tx)
+            if self._buses:
+                return
+            thread, self._thread = self._thread, None
+            self._running = False
+        self._wake.set()
+        if thread is not threading.current_thread():
+            thread.join()
+
+    def close(self):
+        """Remove every bus, failing their queued frames."""
+        for bus in self.buses:
+            self.remove(bus)
+
+    def _io_loop(self):
+        while self._running:
+            with self._pass_lock:
+                buses = list(self._buses)
+                if self._service(buses):
+                    continue
+            polled = any(bus.int_pin is None for bus in buses)
+            if not self._wake.wait(RX_POLL_INTERVAL if polled else INT_IDLE_TIMEOUT):
+                # An aborted or one shot frame leaves its buffer without
+                # raising INT, the idle timeout catches those
+                with self._pass_lock:
+                    for bus in self._buses:
+                        if bus.int_pin is not None and bus.tx_scheduler.in_flight:
+                            bus._service()
+            self._wake.clear()
+
+    def _service(self, buses):
+        """One pass over the members, see CAN_1._io_loop() for one bus.
+
+        Returns:
+            True if another pass is needed right away
+        """
+        # INT is level triggered, controllers holding it low have frames
+        # waiting in their two RX buffers and go first
+        pending = [
+            bus for bus in buses
+            if bus.int_pin is not None and GPIO.input(bus.int_pin) == GPIO.LOW
+        ]
+        work = 0
+        for bus in pending:
+            work += bus._service()
+        for bus in buses:
+            if bus in pending:
+                continue
+            scheduler = bus.tx_scheduler
+            if bus.int_pin is None or (scheduler.free and len(scheduler)):
+                work += bus._service()
+        return work > 0 or bool(pending)
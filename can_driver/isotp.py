@@ -0,0 +1,547 @@
+'''
+isotp.py
+ISO 15765-2 (ISO-TP) transport on top of CAN_1, normal addressing
+IsoTpStack takes the frames received by a CAN_1 from its I/O thread and
+routes them by CAN ID to IsoTpSessions, one per (tx_id, rx_id) pair.
+Reception runs entirely in the I/O thread: consecutive frames are copied
+straight into a preallocated buffer of the session, flow control frames
+are sent from there and a complete message is handed out as a memoryview
+of that buffer. send() blocks the caller's thread, but the consecutive
+frames are queued from the I/O thread as flow control frames and TX
+completions come in, keeping up to tx_depth frames in the TX buffers so
+the controller sends a block back to back without waiting for this side
+'''
+import collections
+import functools
+import math
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+from .can import CAN_EFF_FLAG, CAN_EFF_MASK, CAN_ERR_FLAG, CAN_MAX_DLEN, CAN_RTR_FLAG, CanMsg
+from .constants import ERROR
+
+# Protocol control information, the high nibble of the first byte
+PCI_SF = 0x0
+PCI_FF = 0x1
+PCI_CF = 0x2
+PCI_FC = 0x3
+# Flow status of a flow control frame
+FC_CTS = 0x0
+FC_WAIT = 0x1
+FC_OVFLW = 0x2
+
+SF_MAX_LENGTH = CAN_MAX_DLEN - 1
+# Largest length of a 12 bit first frame, longer messages use the 32 bit
+# escape of ISO 15765-2:2016
+FF_MAX_LENGTH = 0xFFF
+MAX_LENGTH = 0xFFFFFFFF
+
+# Timeouts of the standard, N_Bs for the flow control after a first frame
+# or block and N_Cr between consecutive frames, in seconds
+N_BS = 1.0
+N_CR = 1.0
+# FC.WAIT frames accepted in a row before the sender gives up (N_WFTmax)
+MAX_WAIT_FRAMES = 10
+# Consecutive frames queued at once while sending a block. Two keep the
+# bus busy, one on the wire and the next loaded. More would let a receiver
+# with two RX buffers, an MCP2515 or this controller in loopback, fall a
+# third frame behind and lose it whenever it is serviced late
+DEFAULT_TX_DEPTH = 2
+# Buffers a session reassembles into, one is held by the last recv()
+DEFAULT_RX_BUFFERS = 2
+DEFAULT_MAX_LENGTH = FF_MAX_LENGTH
+
+
+def encode_stmin(seconds: float) -> int:
+    """STmin byte for a minimum separation time, rounded up."""
+    if seconds <= 0:
+        return 0
+    if seconds < 0.001:
+        # 0xF1 - 0xF9 are 100 - 900 us
+        return 0xF0 + min(max(math.ceil(seconds * 1e4 - 1e-9), 1), 9)
+    return min(math.ceil(seconds * 1e3 - 1e-9), 0x7F)
+
+
+def decode_stmin(value: int) -> float:
+    """Separation time in seconds of an STmin byte, reserved values are
+    read as the longest time, 127 ms, as the standard requires."""
+    if value <= 0x7F:
+        return value / 1e3
+    if 0xF1 <= value <= 0xF9:
+        return (value - 0xF0) / 1e4
+    return 0.127
+
+
+class _Transfer:
+    __slots__ = ("data", "offset", "sn", "block", "separation", "in_flight", "progress",
+                 "waits", "error")
+
+    def __init__(self, data: memoryview, offset: int) -> None:
+        self.data = data
+        # Bytes queued so far and sequence number of the next frame
+        self.offset = offset
+        self.sn = 1
+        # Frames left in the block, negative without a limit, 0 while
+        # waiting for flow control
+        self.block = 0
+        self.separation = 0.0
+        self.in_flight = 0
+        # Flow control frames and completions, a timeout without any
+        # progress ends the transfer
+        self.progress = 0
+        self.waits = 0
+        self.error = None  # type: Optional[int]
+
+    def finished(self) -> bool:
+        return self.offset >= len(self.data) and not self.in_flight
+
+
+class IsoTpSession:
+    def __init__(self, stack: "IsoTpStack", tx_id: int, rx_id: int,
+                 block_size: int = 0, stmin: float = 0, padding: Optional[int] = 0xCC,
+                 max_length: int = DEFAULT_MAX_LENGTH, rx_buffers: int = DEFAULT_RX_BUFFERS,
+                 tx_depth: int = DEFAULT_TX_DEPTH,
+                 on_message: Optional[Callable[[memoryview], None]] = None) -> None:
+        """One ISO-TP connection, see IsoTpStack.open()."""
+        if not 0 <= block_size <= 0xFF:
+            raise ValueError("block_size must be 0 - 255")
+        if max_length > MAX_LENGTH:
+            raise ValueError("max_length is at most %d" % MAX_LENGTH)
+        self.stack = stack
+        self.bus = stack.bus
+        self.tx_id = tx_id
+        self.rx_id = rx_id
+        self.block_size = block_size
+        self.stmin = encode_stmin(stmin)
+        self.padding = padding
+        self.max_length = max_length
+        self.tx_depth = max(tx_depth, 1)
+        self.on_message = on_message
+
+        # Reassembly state, only touched by the I/O thread
+        self._buffers = [bytearray(max_length) for _ in range(max(rx_buffers, 1))]
+        self._views = {id(buf): memoryview(buf) for buf in self._buffers}
+        self._rx_buffer = None  # type: Optional[bytearray]
+        self._rx_length = 0
+        self._rx_offset = 0
+        self._rx_sn = 0
+        self._rx_block = 0
+        self._rx_last = 0.0
+
+        # Buffers not in use, completed messages and the buffer handed out
+        # by the last recv(), shared with the receiving thread
+        self._rx_ready = threading.Condition()
+        self._free = list(self._buffers)
+        self._complete = collections.deque()
+        self._held = None  # type: Optional[bytearray]
+
+        # The transfer in progress, driven by the sending thread and by
+        # flow control and TX completions on the I/O thread
+        self._tx_lock = threading.Lock()
+        self._tx_cond = threading.Condition(threading.RLock())
+        self._transfer = None  # type: Optional[_Transfer]
+
+        self.sent = 0
+        self.received = 0
+        self.tx_errors = 0
+        self.rx_errors = 0
+        self.rx_overflows = 0
+
+    def __repr__(self) -> str:
+        return "IsoTpSession(tx=%#x, rx=%#x)" % (self.tx_id, self.rx_id)
+
+    def close(self) -> None:
+        """Stop routing frames to this session."""
+        self.stack.close(self)
+
+    def stats(self) -> dict:
+        """Messages sent and received and the transfers that failed."""
+        return {
+            "sent": self.sent,
+            "received": self.received,
+            "tx_errors": self.tx_errors,
+            "rx_errors": self.rx_errors,
+            "rx_overflows": self.rx_overflows,
+        }
+
+    def _frame(self, payload: bytes) -> CanMsg:
+        if self.padding is not None and len(payload) < CAN_MAX_DLEN:
+            payload += bytes((self.padding,)) * (CAN_MAX_DLEN - len(payload))
+        return CanMsg(self.tx_id, payload)
+
+    # Sending
+
+    def send(self, data: bytes, timeout: float = N_BS) -> int:
+        """Send one message, blocking until the last frame is on the bus.
+
+        Transfers of one session run one at a time, several sessions can
+        send at once from different threads.
+
+        Args:
+            data: Payload, any bytes-like object of 1 - 4294967295 bytes
+            timeout: Seconds the transfer may go without progress, waiting
+                for a flow control frame or for frames to be sent
+                (default: N_BS)
+
+        Returns:
+            ERROR_OK, or ERROR_FAILTX if a frame failed, the receiver
+            reported an overflow or did not answer in time
+        """
+        data = memoryview(data).cast("B")
+        length = len(data)
+        if not length:
+            raise ValueError("ISO-TP messages are at least 1 byte")
+        if length > MAX_LENGTH:
+            raise ValueError("ISO-TP messages are at most %d bytes" % MAX_LENGTH)
+        with self._tx_lock:
+            if length <= SF_MAX_LENGTH:
+                handle = self.bus.send(self._frame(bytes((PCI_SF << 4 | length,)) + data))
+                ok = handle.wait(timeout) and handle.error == ERROR.ERROR_OK
+                error = ERROR.ERROR_OK if ok else ERROR.ERROR_FAILTX
+            else:
+                error = self._send_segmented(data, timeout)
+        if error == ERROR.ERROR_OK:
+            self.sent += 1
+        else:
+            self.tx_errors += 1
+        return error
+
+    def _send_segmented(self, data: memoryview, timeout: float) -> int:
+        """Send a first frame and wait while the I/O thread sends the rest.
+
+        Flow control frames and TX completions arrive on the I/O thread,
+        which queues the next consecutive frames right there, see _pump().
+        Only blocks with an STmin are paced from this thread.
+        """
+        length = len(data)
+        if length <= FF_MAX_LENGTH:
+            head = bytes((PCI_FF << 4 | length >> 8, length & 0xFF))
+        else:
+            head = bytes((PCI_FF << 4, 0)) + length.to_bytes(4, "big")
+        transfer = _Transfer(data, CAN_MAX_DLEN - len(head))
+        cond = self._tx_cond
+        with cond:
+            self._transfer = transfer
+            self._push(transfer, head + data[:transfer.offset])
+            progress = -1
+            while transfer.error is None and not transfer.finished():
+                if transfer.separation and transfer.block and transfer.offset < length:
+                    self._send_paced(transfer, timeout)
+                    continue
+                if transfer.progress == progress:
+                    transfer.error = ERROR.ERROR_FAILTX
+                    break
+                progress = transfer.progress
+                cond.wait(timeout)
+            self._transfer = None
+        return ERROR.ERROR_OK if transfer.error is None else transfer.error
+
+    def _send_paced(self, transfer: "_Transfer", timeout: float) -> None:
+        """Send a block with STmin, called and returning with _tx_cond held."""
+        cond = self._tx_cond
+        while transfer.block and transfer.offset < len(transfer.data) and transfer.error is None:
+            handle = self._push_cf(transfer)
+            cond.release()
+            try:
+                # STmin counts from the end of the previous frame
+                handle.wait(timeout)
+                time.sleep(transfer.separation)
+            finally:
+                cond.acquire()
+
+    def _push(self, transfer: "_Transfer", payload: bytes) -> Any:
+        handle = self.bus.send(self._frame(payload))
+        transfer.in_flight += 1
+        handle.add_done_callback(functools.partial(self._sent, transfer))
+        return handle
+
+    def _push_cf(self, transfer: "_Transfer") -> Any:
+        offset = transfer.offset
+        end = offset + SF_MAX_LENGTH
+        handle = self._push(transfer, bytes((PCI_CF << 4 | transfer.sn,)) + transfer.data[offset:end])
+        transfer.offset = min(end, len(transfer.data))
+        transfer.sn = (transfer.sn + 1) & 0xF
+        transfer.block -= 1
+        return handle
+
+    def _pump(self, transfer: "_Transfer") -> None:
+        """Keep up to tx_depth consecutive frames of the block queued, with
+        _tx_cond held."""
+        while (transfer.block and transfer.offset < len(transfer.data)
+               and transfer.in_flight < self.tx_depth and transfer.error is None):
+            self._push_cf(transfer)
+
+    def _sent(self, transfer: "_Transfer", handle: Any) -> None:
+        """TX completion of a frame of transfer, on the I/O thread."""
+        with self._tx_cond:
+            transfer.in_flight -= 1
+            transfer.progress += 1
+            if handle.error != ERROR.ERROR_OK:
+                transfer.error = ERROR.ERROR_FAILTX
+            elif not transfer.separation and transfer is self._transfer:
+                self._pump(transfer)
+            self._tx_cond.notify()
+
+    def _on_flow_control(self, status: int, block_size: int, stmin: int) -> None:
+        with self._tx_cond:
+            transfer = self._transfer
+            # Only expected after the first frame and at the end of a block
+            if transfer is None or transfer.block or transfer.error is not None:
+                return
+            transfer.progress += 1
+            if status == FC_WAIT:
+                transfer.waits += 1
+                if transfer.waits > MAX_WAIT_FRAMES:
+                    transfer.error = ERROR.ERROR_FAILTX
+            elif status == FC_CTS:
+                transfer.waits = 0
+                transfer.block = block_size or -1
+                transfer.separation = decode_stmin(stmin)
+                if not transfer.separation:
+                    self._pump(transfer)
+            else:
+                transfer.error = ERROR.ERROR_FAILTX
+            self._tx_cond.notify()
+
+    # Receiving
+
+    def recv(self, timeout: Optional[float] = None) -> Optional[memoryview]:
+        """Take the next complete message.
+
+        The message stays in the reassembly buffer, the view is valid
+        until the next recv() call, copy it with bytes() to keep it.
+
+        Args:
+            timeout: Seconds to wait, None waits forever
+
+        Returns:
+            memoryview of the payload, or None on timeout
+        """
+        with self._rx_ready:
+            if self._held is not None:
+                self._free.append(self._held)
+                self._held = None
+            if not self._rx_ready.wait_for(self._complete.__len__, timeout):
+                return None
+            buf, length = self._complete.popleft()
+            self._held = buf
+        return self._views[id(buf)][:length]
+
+    def _send_fc(self, status: int) -> None:
+        block_size = self.block_size if status == FC_CTS else 0
+        self.bus.send(self._frame(bytes((PCI_FC << 4 | status, block_size, self.stmin))))
+
+    def _take_buffer(self) -> Optional[bytearray]:
+        if self._rx_buffer is not None:
+            # A new first or single frame ends the reception in progress
+            self.rx_errors += 1
+            buf, self._rx_buffer = self._rx_buffer, None
+            return buf
+        with self._rx_ready:
+            return self._free.pop() if self._free else None
+
+    def _deliver(self, buf: bytearray, length: int) -> None:
+        self.received += 1
+        if self.on_message is not None:
+            self.on_message(self._views[id(buf)][:length])
+            with self._rx_ready:
+                self._free.append(buf)
+            return
+        with self._rx_ready:
+            self._complete.append((buf, length))
+            self._rx_ready.notify()
+
+    def _on_frame(self, data: bytes) -> None:
+        """Handle one frame received on rx_id, from the I/O thread."""
+        if not data:
+            return
+        pci = data[0] >> 4
+        if pci == PCI_CF:
+            self._on_consecutive(data)
+        elif pci == PCI_FC:
+            if len(data) >= 3:
+                self._on_flow_control(data[0] & 0xF, data[1], data[2])
+        elif pci == PCI_SF:
+            length = data[0] & 0xF
+            if not 0 < length < len(data):
+                return
+            buf = self._take_buffer()
+            if buf is None or length > self.max_length:
+                self.rx_overflows += 1
+                if buf is not None:
+                    with self._rx_ready:
+                        self._free.append(buf)
+                return
+            buf[:length] = memoryview(data)[1:1 + length]
+            self._deliver(buf, length)
+        elif pci == PCI_FF:
+            self._on_first(data)
+
+    def _on_first(self, data: bytes) -> None:
+        if len(data) < CAN_MAX_DLEN:
+            return
+        length = (data[0] & 0xF) << 8 | data[1]
+        header = 2
+        # Lengths a single frame could carry, and escaped lengths that fit
+        # 12 bits, are invalid first frames and ignored
+        shortest = SF_MAX_LENGTH + 1
+        if length == 0:
+            length = int.from_bytes(data[2:6], "big")
+            header = 6
+            shortest = FF_MAX_LENGTH + 1
+        if length < shortest:
+            return
+        if self._rx_buffer is not None:
+            # A new first frame ends the message in progress
+            self.rx_errors += 1
+            with self._rx_ready:
+                self._free.append(self._rx_buffer)
+            self._rx_buffer = None
+        buf = self._take_buffer()
+        if buf is None or length > self.max_length:
+            self.rx_overflows += 1
+            if buf is not None:
+                with self._rx_ready:
+                    self._free.append(buf)
+            self._send_fc(FC_OVFLW)
+            return
+        first = CAN_MAX_DLEN - header
+        buf[:first] = memoryview(data)[header:CAN_MAX_DLEN]
+        self._rx_buffer = buf
+        self._rx_length = length
+        self._rx_offset = first
+        self._rx_sn = 1
+        self._rx_block = self.block_size
+        self._rx_last = time.monotonic()
+        self._send_fc(FC_CTS)
+
+    def _on_consecutive(self, data: bytes) -> None:
+        buf = self._rx_buffer
+        if buf is None:
+            return
+        now = time.monotonic()
+        if data[0] & 0xF != self._rx_sn or now - self._rx_last > N_CR:
+            # Lost frame or timed out sender, the message is dropped
+            self.rx_errors += 1
+            self._rx_buffer = None
+            with self._rx_ready:
+                self._free.append(buf)
+            return
+        self._rx_last = now
+        offset = self._rx_offset
+        n = max(min(self._rx_length - offset, len(data) - 1), 0)
+        buf[offset:offset + n] = memoryview(data)[1:1 + n]
+        offset += n
+        if offset >= self._rx_length:
+            self._rx_buffer = None
+            self._deliver(buf, self._rx_length)
+            return
+        self._rx_offset = offset
+        self._rx_sn = (self._rx_sn + 1) & 0xF
+        if self._rx_block:
+            self._rx_block -= 1
+            if not self._rx_block:
+                self._rx_block = self.block_size
+                self._send_fc(FC_CTS)
+
+
+class IsoTpStack:
+    def __init__(self, bus: Any, on_other: Optional[Callable[[CanMsg], None]] = None) -> None:
+        """ISO-TP sessions on one CAN_1, see open() and attach().
+
+        Args:
+            bus: CAN_1 object, begin() must have been called
+            on_other: Called from the I/O thread with every received frame
+                that belongs to no session (default: None, dropped)
+        """
+        self.bus = bus
+        self.on_other = on_other
+        self._sessions = {}  # type: Dict[int, IsoTpSession]
+        self._lock = threading.Lock()
+        # Returned by bus._attach_consumer(), restores the bus on detach()
+        self._consumer = None
+
+    def __enter__(self) -> "IsoTpStack":
+        self.attach()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.detach()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def open(self, tx_id: int, rx_id: int, **options: Any) -> IsoTpSession:
+        """Open a session that sends on tx_id and receives on rx_id.
+
+        With normal addressing the receive ID identifies the session, so
+        every session of a stack needs its own rx_id.
+
+        Args:
+            tx_id: CAN ID of the frames sent, CAN_EFF_FLAG set for 29 bit
+            rx_id: CAN ID of the frames received, CAN_EFF_FLAG set for 29 bit
+            options: block_size (BS sent in flow control, 0 for no
+                limit), stmin (seconds the sender has to leave between
+                consecutive frames), padding (fill byte of short frames,
+                None sends them short), max_length (largest message
+                received), rx_buffers (messages buffered before first
+                frames are answered with an overflow), tx_depth
+                (consecutive frames queued ahead) and on_message (called
+                from the I/O thread with each message instead of queueing
+                it for recv(), the view is valid during the call)
+
+        Raises:
+            ValueError: A session already receives on rx_id
+        """
+        key = rx_id & (CAN_EFF_FLAG | CAN_EFF_MASK)
+        with self._lock:
+            if key in self._sessions:
+                raise ValueError("a session already receives on %#x" % rx_id)
+            session = IsoTpSession(self, tx_id, rx_id, **options)
+            self._sessions[key] = session
+        return session
+
+    def close(self, session: IsoTpSession) -> None:
+        with self._lock:
+            key = session.rx_id & (CAN_EFF_FLAG | CAN_EFF_MASK)
+            if self._sessions.get(key) is session:
+                del self._sessions[key]
+
+    def session(self, tx_id: int, rx_id: int) -> Optional[IsoTpSession]:
+        """The open session of an ID pair, or None."""
+        session = self._sessions.get(rx_id & (CAN_EFF_FLAG | CAN_EFF_MASK))
+        if session is None or session.tx_id != tx_id:
+            return None
+        return session
+
+    def attach(self) -> None:
+        """Receive from the I/O thread of the bus, recv() on the bus gets
+        nothing while attached. A running I/O thread of the bus or its
+        CanGroup is used as is."""
+        if self._consumer is not None:
+            return
+        self._consumer = self.bus._attach_consumer(self.handle_frame)
+
+    def detach(self) -> None:
+        """Stop receiving, the bus goes back to how attach() found it."""
+        if self._consumer is not None:
+            self.bus._detach_consumer(self._consumer)
+            self._consumer = None
+
+    def handle_frame(self, msg: CanMsg) -> bool:
+        """Route one received frame, for feeding the stack by hand.
+
+        Returns:
+            True if the frame belonged to a session
+        """
+        can_id = msg.raw_id
+        session = None
+        if not can_id & (CAN_RTR_FLAG | CAN_ERR_FLAG):
+            session = self._sessions.get(can_id)
+        if session is None:
+            if self.on_other is not None:
+                self.on_other(msg)
+            return False
+        session._on_frame(msg.data)
+        return True
@@ -0,0 +1,253 @@
+'''
+latest.py
+Latest-value cache of received frames with change-only delivery
+LatestCache keeps the newest payload of every CAN ID and passes a frame on
+only when its payload differs from the cached one, optionally compared
+under a per-ID byte mask so alive counters and checksums do not count as
+changes. The current state of the bus is read from the cache in O(1),
+together with how old each ID's last frame is
+'''
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from .can import CAN_EFF_FLAG, CAN_EFF_MASK, CAN_ERR_FLAG, CAN_MAX_DLEN, CAN_RTR_FLAG, CanMsg
+
+
+class _Entry:
+    __slots__ = ("data", "timestamp", "passed_at", "mask", "frames", "changes", "passed")
+
+    def __init__(self, mask: Optional[int]) -> None:
+        self.data = None  # type: Optional[bytes]
+        self.timestamp = 0
+        # Timestamp of the last frame passed on
+        self.passed_at = 0
+        self.mask = mask
+        self.frames = 0
+        self.changes = 0
+        self.passed = 0
+
+
+def _mask_int(mask: bytes) -> Optional[int]:
+    """Byte mask as an integer over the little endian payload, None if
+    every bit is compared and plain bytes equality will do."""
+    mask = bytes(mask[:CAN_MAX_DLEN]).ljust(CAN_MAX_DLEN, b"\0")
+    if mask == b"\xff" * CAN_MAX_DLEN:
+        return None
+    return int.from_bytes(mask, "little")
+
+
+class LatestCache:
+    def __init__(self, masks: Optional[Dict[int, bytes]] = None,
+                 on_change: Optional[Callable[[CanMsg], None]] = None,
+                 refresh: Optional[float] = None) -> None:
+        """Cache of the newest frame per CAN ID that passes on changes only.
+
+        IDs are CAN IDs with CAN_EFF_FLAG set for extended frames. Remote
+        and error frames are always passed on and never cached. A change
+        of the payload length always counts as a change.
+
+        Args:
+            masks: Dict of CAN ID -> byte mask of up to 8 bytes, only
+                payload bits set in the mask are compared, missing bytes
+                are not compared. Unlisted IDs compare every byte.
+            on_change: Called with every frame passed on, from the thread
+                that feeds the cache (default: None)
+            refresh: Pass on an unchanged frame anyway when nothing was
+                passed on for the ID for this many seconds, so consumers
+                see that it is still sent (default: None, never)
+        """
+        self.on_change = on_change
+        self.refresh_ns = None if refresh is None else int(refresh * 1e9)
+        self._masks = {}  # type: Dict[int, Optional[int]]
+        self._entries = {}  # type: Dict[int, _Entry]
+        self._lock = threading.Lock()
+        self._bus = None
+        # Returned by bus._attach_consumer(), restores the bus on detach()
+        self._consumer = None
+        for can_id, mask in (masks or {}).items():
+            self.set_mask(can_id, mask)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, can_id: int) -> bool:
+        return can_id in self._entries
+
+    def set_mask(self, can_id: int, mask: Optional[bytes]) -> None:
+        """Compare only the payload bits set in mask for can_id, None
+        compares every byte again."""
+        mask = None if mask is None else _mask_int(mask)
+        with self._lock:
+            self._masks[can_id] = mask
+            entry = self._entries.get(can_id)
+            if entry is not None:
+                entry.mask = mask
+
+    def update(self, can_id: int, data: bytes, timestamp_ns: Optional[int] = None) -> bool:
+        """Cache one frame.
+
+        Args:
+            can_id: CAN ID including the EFF/RTR/ERR flags
+            data: Payload as bytes
+            timestamp_ns: Receive time, defaults to time.monotonic_ns()
+
+        Returns:
+            True if the frame is to be passed on
+        """
+        if timestamp_ns is None:
+            timestamp_ns = time.monotonic_ns()
+        with self._lock:
+            return self._update(can_id, data, timestamp_ns)
+
+    def _update(self, can_id: int, data: bytes, timestamp: int) -> bool:
+        if can_id & (CAN_RTR_FLAG | CAN_ERR_FLAG):
+            return True
+        key = can_id & (CAN_EFF_FLAG | CAN_EFF_MASK)
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = _Entry(self._masks.get(key))
+        cached = entry.data
+        entry.frames += 1
+        if cached is None or len(cached) != len(data):
+            changed = True
+        elif entry.mask is None:
+            changed = data != cached
+        else:
+            changed = bool(
+                (int.from_bytes(data, "little") ^ int.from_bytes(cached, "little")) & entry.mask
+            )
+        entry.data = data
+        entry.timestamp = timestamp
+        if changed:
+            entry.changes += 1
+        elif self.refresh_ns is None or timestamp - entry.passed_at < self.refresh_ns:
+            return False
+        entry.passed_at = timestamp
+        entry.passed += 1
+        return True
+
+    def filter(self, msgs: Iterable[CanMsg]) -> List[CanMsg]:
+        """Cache a batch of CanMsg, as from CAN_1.recv_many().
+
+        Messages received without an I/O thread carry no timestamp, they
+        are cached with the current time. on_change is called for every
+        message passed on.
+
+        Returns:
+            The messages to pass on, in order
+        """
+        now = time.monotonic_ns()
+        with self._lock:
+            passed = [msg for msg in msgs if self._update(msg.raw_id, msg.data, msg.timestamp or now)]
+        if self.on_change is not None:
+            for msg in passed:
+                self.on_change(msg)
+        return passed
+
+    def feed(self, bus: Any, max_frames: int = 64, timeout: Optional[float] = None) -> List[CanMsg]:
+        """Receive from a CAN_1 once and cache what arrived, see filter().
+
+        Args:
+            bus: CAN_1 object
+            max_frames: Most frames taken, see CAN_1.recv_many()
+            timeout: Seconds to wait for the first frame
+        """
+        _, msgs = bus.recv_many(max_frames, timeout)
+        return self.filter(msgs)
+
+    def attach(self, bus: Any) -> None:
+        """Feed the cache from the I/O thread of a CAN_1.
+
+        Every received frame is cached as it arrives and on_change gets
+        the ones passed on, recv() on the bus gets nothing while attached.
+        A running I/O thread of the bus or its CanGroup is used as is.
+
+        Args:
+            bus: CAN_1 object, begin() must have been called
+        """
+        self.detach()
+        self._consumer = bus._attach_consumer(self._on_message)
+        self._bus = bus
+
+    def detach(self) -> None:
+        """Stop feeding from the bus given to attach(), which goes back
+        to how attach() found it."""
+        if self._bus is not None:
+            self._bus._detach_consumer(self._consumer)
+        self._bus = None
+        self._consumer = None
+
+    def _on_message(self, msg: CanMsg) -> None:
+        with self._lock:
+            passed = self._update(msg.raw_id, msg.data, msg.timestamp or time.monotonic_ns())
+        if passed and self.on_change is not None:
+            self.on_change(msg)
+
+    def get(self, can_id: int) -> Optional[Tuple[bytes, int]]:
+        """(data, timestamp_ns) of the newest frame of can_id, or None."""
+        with self._lock:
+            entry = self._entries.get(can_id)
+            if entry is None:
+                return None
+            return entry.data, entry.timestamp
+
+    def age(self, can_id: int, now_ns: Optional[int] = None) -> Optional[float]:
+        """Seconds since the newest frame of can_id, None if never seen.
+
+        Args:
+            can_id: CAN ID, CAN_EFF_FLAG set for extended frames
+            now_ns: Reference time (default: None, time.monotonic_ns())
+        """
+        now = time.monotonic_ns() if now_ns is None else now_ns
+        with self._lock:
+            entry = self._entries.get(can_id)
+            if entry is None:
+                return None
+            return (now - entry.timestamp) / 1e9
+
+    def snapshot(self) -> Dict[int, Tuple[bytes, int]]:
+        """Dict of CAN ID -> (data, timestamp_ns) of all cached IDs."""
+        with self._lock:
+            return {key: (entry.data, entry.timestamp) for key, entry in self._entries.items()}
+
+    def stats(self, now_ns: Optional[int] = None) -> dict:
+        """Frames seen, passed on and suppressed, overall and per ID.
+
+        Args:
+            now_ns: Reference time of the ages (default: None,
+                time.monotonic_ns())
+
+        Returns:
+            Dict with frames, passed, suppressed and suppression_rate over
+            all IDs, and "ids", a dict of CAN ID -> dict with frames,
+            changes, passed (changes plus refreshes), suppressed,
+            suppression_rate and age_s
+        """
+        now = time.monotonic_ns() if now_ns is None else now_ns
+        ids = {}
+        frames = passed = 0
+        with self._lock:
+            for key, entry in self._entries.items():
+                frames += entry.frames
+                passed += entry.passed
+                ids[key] = {
+                    "frames": entry.frames,
+                    "changes": entry.changes,
+                    "passed": entry.passed,
+                    "suppressed": entry.frames - entry.passed,
+                    "suppression_rate": (entry.frames - entry.passed) / entry.frames,
+                    "age_s": (now - entry.timestamp) / 1e9,
+                }
+        return {
+            "frames": frames,
+            "passed": passed,
+            "suppressed": frames - passed,
+            "suppression_rate": (frames - passed) / frames if frames else 0.0,
+            "ids": ids,
+        }
+
+    def clear(self) -> None:
+        """Forget all cached frames and counters, masks are kept."""
+        with self._lock:
+            self._entries.clear()
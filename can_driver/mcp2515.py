@@ -9,21 +9,51 @@ MCP2515 CAN controller implementation for Raspberry Pi 4
 '''
 import time
 import collections
+import functools
+import threading
 from typing import Any, Optional, List, Tuple
 
 # Import SPI interface and CAN frame implementation
 from .rpi_spi import SPI
 from .constants import *
 from .can import CAN_EFF_FLAG, CAN_EFF_MASK, CAN_ERR_FLAG, CAN_ERR_MASK
-from .can import CAN_RTR_FLAG, CAN_SFF_MASK, CAN_IDLEN, CAN_MAX_DLEN, CANFrame
+from .can import CAN_RTR_FLAG, CAN_SFF_MASK, CAN_IDLEN, CAN_MAX_DLEN, CanMsg
+from .bittiming import bit_timing, cnf_registers
 
-TXBnREGS = collections.namedtuple("TXBnREGS", "CTRL SIDH DATA")
-RXBnREGS = collections.namedtuple("RXBnREGS", "CTRL SIDH DATA CANINTFRXnIF")
+TXBnREGS = collections.namedtuple("TXBnREGS", "CTRL SIDH DATA LOAD RTS STATTXREQ STATTXIF CANINTFTXnIF")
+RXBnREGS = collections.namedtuple("RXBnREGS", "CTRL SIDH DATA CANINTFRXnIF READ")
 
 TXB = [
-    TXBnREGS(REGISTER.MCP_TXB0CTRL, REGISTER.MCP_TXB0SIDH, REGISTER.MCP_TXB0DATA),
-    TXBnREGS(REGISTER.MCP_TXB1CTRL, REGISTER.MCP_TXB1SIDH, REGISTER.MCP_TXB1DATA),
-    TXBnREGS(REGISTER.MCP_TXB2CTRL, REGISTER.MCP_TXB2SIDH, REGISTER.MCP_TXB2DATA),
+    TXBnREGS(
+        REGISTER.MCP_TXB0CTRL,
+        REGISTER.MCP_TXB0SIDH,
+        REGISTER.MCP_TXB0DATA,
+        INSTRUCTION.INSTRUCTION_LOAD_TX0,
+        INSTRUCTION.INSTRUCTION_RTS_TX0,
+        STAT.STAT_TX0REQ,
+        STAT.STAT_TX0IF,
+        CANINTF.CANINTF_TX0IF,
+    ),
+    TXBnREGS(
+        REGISTER.MCP_TXB1CTRL,
+        REGISTER.MCP_TXB1SIDH,
+        REGISTER.MCP_TXB1DATA,
+        INSTRUCTION.INSTRUCTION_LOAD_TX1,
+        INSTRUCTION.INSTRUCTION_RTS_TX1,
+        STAT.STAT_TX1REQ,
+        STAT.STAT_TX1IF,
+        CANINTF.CANINTF_TX1IF,
+    ),
+    TXBnREGS(
+        REGISTER.MCP_TXB2CTRL,
+        REGISTER.MCP_TXB2SIDH,
+        REGISTER.MCP_TXB2DATA,
+        INSTRUCTION.INSTRUCTION_LOAD_TX2,
+        INSTRUCTION.INSTRUCTION_RTS_TX2,
+        STAT.STAT_TX2REQ,
+        STAT.STAT_TX2IF,
+        CANINTF.CANINTF_TX2IF,
+    ),
 ]
 
 RXB = [
@@ -32,27 +62,116 @@ RXB = [
         REGISTER.MCP_RXB0SIDH,
         REGISTER.MCP_RXB0DATA,
         CANINTF.CANINTF_RX0IF,
+        INSTRUCTION.INSTRUCTION_READ_RX0,
     ),
     RXBnREGS(
         REGISTER.MCP_RXB1CTRL,
         REGISTER.MCP_RXB1SIDH,
         REGISTER.MCP_RXB1DATA,
         CANINTF.CANINTF_RX1IF,
+        INSTRUCTION.INSTRUCTION_READ_RX1,
     ),
 ]
 
+# READ RX BUFFER from SIDH returns SIDH, SIDL, EID8, EID0, DLC and 8 data bytes
+RXB_READ_LEN = CAN_IDLEN + 1 + CAN_MAX_DLEN
+
+# Bits of each register that only the host changes and the shadow copy
+# tracks. Reads are served from the copy only for fully host owned
+# registers, flags, error counters and RX buffers are always read.
+SHADOW_BITS = bytearray(0x80)
+for _reg in (*range(REGISTER.MCP_RXF0SIDH, REGISTER.MCP_RXF2EID0 + 1),
+             REGISTER.MCP_BFPCTRL, REGISTER.MCP_CANCTRL,
+             *range(REGISTER.MCP_RXF3SIDH, REGISTER.MCP_RXF5EID0 + 1),
+             *range(REGISTER.MCP_RXM0SIDH, REGISTER.MCP_CANINTE + 1)):
+    SHADOW_BITS[_reg] = 0xFF
+for _txb in TXB:
+    SHADOW_BITS[_txb.CTRL] = TXBnCTRL.TXB_TXP
+SHADOW_BITS[REGISTER.MCP_RXB0CTRL] = RXBnCTRL_RXM_MASK | RXB0CTRL_BUKT
+SHADOW_BITS[REGISTER.MCP_RXB1CTRL] = RXBnCTRL_RXM_MASK
+# Filters, masks and bit timing can only be written in configuration mode
+SHADOW_CONFIG_ONLY = frozenset(
+    reg for reg in range(REGISTER.MCP_CNF1 + 1)
+    if SHADOW_BITS[reg] and reg not in (REGISTER.MCP_BFPCTRL, REGISTER.MCP_CANCTRL)
+)
+# Shadowed registers with a known value after RESET
+SHADOW_RESET_VALUES = {
+    REGISTER.MCP_BFPCTRL: 0x00,
+    REGISTER.MCP_CANCTRL: CANCTRL_RESET,
+    REGISTER.MCP_CNF3: 0x00,
+    REGISTER.MCP_CNF2: 0x00,
+    REGISTER.MCP_CNF1: 0x00,
+    REGISTER.MCP_CANINTE: 0x00,
+    REGISTER.MCP_TXB0CTRL: 0x00,
+    REGISTER.MCP_TXB1CTRL: 0x00,
+    REGISTER.MCP_TXB2CTRL: 0x00,
+    REGISTER.MCP_RXB0CTRL: 0x00,
+    REGISTER.MCP_RXB1CTRL: 0x00,
+}
+
+
+def _holding(*names):
+    """Run a method with the named locks of the CAN object held, in order."""
+    def decorate(method):
+        if len(names) == 1:
+            @functools.wraps(method)
+            def locked(self, *args, **kwargs):
+                with getattr(self, names[0]):
+                    return method(self, *args, **kwargs)
+        else:
+            @functools.wraps(method)
+            def locked(self, *args, **kwargs):
+                with getattr(self, names[0]), getattr(self, names[1]):
+                    return method(self, *args, **kwargs)
+        return locked
+    return decorate
+
+
+# Configuration holds off both paths, the RX and TX sequences their own
+_exclusive = _holding("rx_lock", "tx_lock")
+_rxPath = _holding("rx_lock")
+_txPath = _holding("tx_lock")
+
 
 class CAN:
-    def __init__(self, SPI: Any) -> None:
+    def __init__(self, SPI: Any, shadow: bool = False) -> None:
         self.SPI = SPI
+        # Every instruction is one transaction, made indivisible together
+        # with the shadow and counter updates that belong to it
+        self._spi_lock = threading.RLock()
+        # Held across the instruction sequences of the receive and the
+        # transmit path, so a TX thread gets onto the SPI bus between the
+        # transactions of an RX drain. Configuration takes both, rx_lock
+        # first.
+        self.rx_lock = threading.RLock()
+        self.tx_lock = threading.RLock()
         self.mcp2515_rx_index = 0
-
+        # Optional write-through copy of the host owned registers, see
+        # SHADOW_BITS. shadow_valid marks registers whose value is known.
+        self.shadow = bytearray(0x80) if shadow else None
+        self.shadow_valid = bytearray(0x80)
+        self.shadow_hits = 0
+        self.shadow_misses = 0
+        # Always-on counters, see getStats()
+        self.rx_frames = [0, 0]
+        self.tx_frames = [0, 0, 0]
+        self.tx_busy = 0
+        self.mode_timeouts = 0
+        self.error_flags = [0] * 8
+        # Last EFLG value read, so a sticky flag is only counted once
+        self._eflg = 0
+        # Time the last configure() kept the controller off the bus
+        self.config_downtime_ns = 0
+        # Nanoseconds per phase of the last coldStart()
+        self.startup_timing = {}
+
+    @_exclusive
     def reset(self) -> int:
-        self.SPI.start()
-        self.SPI.transfer(INSTRUCTION.INSTRUCTION_RESET)
-        self.SPI.end()
+        self._transaction([INSTRUCTION.INSTRUCTION_RESET])
 
         time.sleep(0.01)  # 10ms delay
+        self.resetShadow(True)
+        self._eflg = 0
 
         # Initialize transmit buffers
         zeros = bytearray(14)
@@ -104,64 +223,218 @@ class CAN:
 
         return ERROR.ERROR_OK
 
-    def readRegister(self, reg: int) -> int:
-        self.SPI.start()
-        self.SPI.transfer(INSTRUCTION.INSTRUCTION_READ)
-        self.SPI.transfer(reg)
-        ret = self.SPI.transfer(read=True)
-        self.SPI.end()
+    @_exclusive
+    def coldStart(
+        self,
+        canSpeed: int,
+        canClock: int = CAN_CLOCK.MCP_16MHZ,
+        mode: int = CANCTRL_REQOP_MODE.CANCTRL_REQOP_NORMAL,
+        oneShot: bool = False,
+    ) -> int:
+        """Get from RESET to the requested mode with as few transfers as possible.
+
+        Sets up the same state as reset(), setBitrate() and setMode(), but
+        relies on the reset values instead of rewriting them: TX buffers
+        and their control registers are left alone, RXF0-5 go out in one
+        burst over 0x00-0x1B, and RXM0-1, CNF3-1 and CANINTE in another
+        over 0x20-0x2B. Config mode is entered once, by the reset itself.
+        The time spent in each phase is kept in startup_timing.
+
+        Returns:
+            ERROR_OK on success, otherwise error code
+        """
+        cnf = self.bitTiming(canSpeed, canClock)
+        if cnf is None:
+            return ERROR.ERROR_FAIL
+        cfg1, cfg2, cfg3 = cnf
+
+        start = t = time.monotonic_ns()
+        timing = self.startup_timing = {}
+
+        self._transaction([INSTRUCTION.INSTRUCTION_RESET])
+        self.resetShadow(False)
+        time.sleep(MCP_RESET_DELAY)
+        # CANCTRL reads back its reset value once the device is out of reset
+        deadline = time.monotonic() + MCP_RESET_TIMEOUT
+        while self.readRegister(REGISTER.MCP_CANCTRL) != CANCTRL_RESET:
+            self.shadow_valid[REGISTER.MCP_CANCTRL] = 0
+            if time.monotonic() > deadline:
+                return ERROR.ERROR_FAILINIT
+        self.resetShadow(True)
+        self.mcp2515_rx_index = 0
+        self._eflg = 0
+        timing["reset"] = time.monotonic_ns() - t
+
+        # RXF0 accepts all standard frames, RXF1 all extended frames and
+        # the rest nothing more. The registers between RXF2 and RXF3 get
+        # their reset values, CANSTAT is read only.
+        t = time.monotonic_ns()
+        filters = bytearray()
+        for ft in range(3):
+            filters += self.prepareId(ft == RXF.RXF1, 0)
+        filters += bytes((0, 0, 0, CANCTRL_RESET))
+        for ft in range(3):
+            filters += self.prepareId(False, 0)
+        self.setRegisters(REGISTER.MCP_RXF0SIDH, filters)
+        self.setRegister(
+            REGISTER.MCP_RXB0CTRL, RXBnCTRL_RXM_STDEXT | RXB0CTRL_BUKT | RXB0CTRL_FILHIT
+        )
+        self.setRegister(REGISTER.MCP_RXB1CTRL, RXBnCTRL_RXM_STDEXT | RXB1CTRL_FILHIT)
+        timing["filters"] = time.monotonic_ns() - t
+
+        # Both masks open, then CNF3, CNF2, CNF1 and CANINTE
+        t = time.monotonic_ns()
+        self.setRegisters(
+            REGISTER.MCP_RXM0SIDH,
+            self.prepareId(True, 0) * 2 + bytes((
+                cfg3, cfg2, cfg1,
+                CANINTF.CANINTF_RX0IF
+                | CANINTF.CANINTF_RX1IF
+                | CANINTF.CANINTF_ERRIF
+                | CANINTF.CANINTF_MERRF,
+            )),
+        )
+        timing["bit_timing"] = time.monotonic_ns() - t
+
+        t = time.monotonic_ns()
+        error = ERROR.ERROR_OK
+        if oneShot:
+            self.setOneShotMode(True)
+        if mode != CANCTRL_REQOP_MODE.CANCTRL_REQOP_CONFIG:
+            error = self.setMode(mode)
+        timing["mode"] = time.monotonic_ns() - t
+        timing["total"] = time.monotonic_ns() - start
+        return error
 
-        return ret
+    def readRegister(self, reg: int) -> int:
+        return self.readRegisters(reg, 1)[0]
 
     def readRegisters(self, reg: int, n: int) -> List[int]:
-        self.SPI.start()
-        self.SPI.transfer(INSTRUCTION.INSTRUCTION_READ)
-        self.SPI.transfer(reg)
-        # MCP2515 has auto-increment of address-pointer
-        values = []
-        for i in range(n):
-            values.append(self.SPI.transfer(read=True))
-        self.SPI.end()
-
+        shadow = self.shadow
+        if shadow is None:
+            # MCP2515 has auto-increment of address-pointer
+            return self._transaction(
+                [INSTRUCTION.INSTRUCTION_READ, reg] + [SPI_DUMMY_INT] * n
+            )[2:]
+
+        with self._spi_lock:
+            end = reg + n
+            if all(SHADOW_BITS[r] == 0xFF and self.shadow_valid[r] for r in range(reg, end)):
+                self.shadow_hits += 1
+                return list(shadow[reg:end])
+            if any(SHADOW_BITS[r] == 0xFF for r in range(reg, end)):
+                self.shadow_misses += 1
+
+            rx = self.SPI.transaction(
+                [INSTRUCTION.INSTRUCTION_READ, reg] + [SPI_DUMMY_INT] * n
+            )
+            values = rx[2:]
+            for r, value in enumerate(values, reg):
+                if SHADOW_BITS[r] == 0xFF:
+                    shadow[r] = value
+                    self.shadow_valid[r] = 1
         return values
 
     def setRegister(self, reg: int, value: int) -> None:
-        self.SPI.start()
-        self.SPI.transfer(INSTRUCTION.INSTRUCTION_WRITE)
-        self.SPI.transfer(reg)
-        self.SPI.transfer(value)
-        self.SPI.end()
+        self.setRegisters(reg, (value,))
 
     def setRegisters(self, reg: int, values: bytearray) -> None:
-        self.SPI.start()
-        self.SPI.transfer(INSTRUCTION.INSTRUCTION_WRITE)
-        self.SPI.transfer(reg)
-        for v in values:
-            self.SPI.transfer(v)
-        self.SPI.end()
+        shadow = self.shadow
+        if shadow is None:
+            self._transaction([INSTRUCTION.INSTRUCTION_WRITE, reg, *values])
+            return
+
+        with self._spi_lock:
+            if all(
+                SHADOW_BITS[r] == 0xFF and self.shadow_valid[r] and shadow[r] == value
+                for r, value in enumerate(values, reg)
+            ):
+                self.shadow_hits += 1
+                return
+            self.SPI.transaction([INSTRUCTION.INSTRUCTION_WRITE, reg, *values])
+            for r, value in enumerate(values, reg):
+                self._storeShadow(r, 0xFF, value)
 
     def modifyRegister(
         self, reg: int, mask: int, data: int, spifastend: bool = False
     ) -> None:
-        self.SPI.start()
-        self.SPI.transfer(INSTRUCTION.INSTRUCTION_BITMOD)
-        self.SPI.transfer(reg)
-        self.SPI.transfer(mask)
-        self.SPI.transfer(data)
-        if not spifastend:
-            self.SPI.end()
-        else:
-            # Direct GPIO control - not recommended in RPi implementation
-            # We'll use a regular end() with a shorter delay
-            self.SPI.end()
+        # spifastend is kept for API compatibility, CS is always released
+        # at the end of the single transfer
+        shadow = self.shadow
+        if shadow is None:
+            self._transaction([INSTRUCTION.INSTRUCTION_BITMOD, reg, mask, data])
+            return
+
+        with self._spi_lock:
+            bits = SHADOW_BITS[reg]
+            if self.shadow_valid[reg] and not mask & ~bits and not (shadow[reg] ^ data) & mask:
+                self.shadow_hits += 1
+                return
+            self.SPI.transaction([INSTRUCTION.INSTRUCTION_BITMOD, reg, mask, data])
+            self._storeShadow(reg, mask, data)
+
+    def _transaction(self, tx: List[int]) -> List[int]:
+        with self._spi_lock:
+            return self.SPI.transaction(tx)
+
+    def _storeShadow(self, reg: int, mask: int, data: int) -> None:
+        bits = SHADOW_BITS[reg]
+        if not bits:
+            return
+        if reg in SHADOW_CONFIG_ONLY and (
+            not self.shadow_valid[REGISTER.MCP_CANCTRL]
+            or self.shadow[REGISTER.MCP_CANCTRL] & CANCTRL_REQOP
+            != CANCTRL_REQOP_MODE.CANCTRL_REQOP_CONFIG
+        ):
+            # The write is ignored outside configuration mode
+            self.shadow_valid[reg] = 0
+        elif self.shadow_valid[reg] or mask & bits == bits:
+            self.shadow[reg] = (self.shadow[reg] & ~mask | data & mask) & bits
+            self.shadow_valid[reg] = 1
+
+    def resetShadow(self, known: bool) -> None:
+        """Forget the shadow copy after a reset.
+
+        Args:
+            known: The device finished its reset, registers with a defined
+                reset value are known again
+        """
+        if self.shadow is None:
+            return
+        self.shadow_valid[:] = bytes(0x80)
+        if known:
+            for reg, value in SHADOW_RESET_VALUES.items():
+                self.shadow[reg] = value & SHADOW_BITS[reg]
+                self.shadow_valid[reg] = 1
+
+    def verifyShadow(self) -> List[Tuple[int, int, int]]:
+        """Compare the shadow copy with the device.
+
+        Reads the whole register map in one burst, which does not clear
+        any flag.
+
+        Returns:
+            List of (register, shadow value, device value) that differ in
+            the tracked bits, empty if the copy is consistent
+        """
+        if self.shadow is None:
+            return []
+        with self._spi_lock:
+            rx = self.SPI.transaction(
+                [INSTRUCTION.INSTRUCTION_READ, 0] + [SPI_DUMMY_INT] * 0x80
+            )
+            device = rx[2:]
+            return [
+                (reg, self.shadow[reg], device[reg])
+                for reg in range(0x80)
+                if self.shadow_valid[reg] and (self.shadow[reg] ^ device[reg]) & SHADOW_BITS[reg]
+            ]
 
     def getStatus(self) -> int:
-        self.SPI.start()
-        self.SPI.transfer(INSTRUCTION.INSTRUCTION_READ_STATUS)
-        i = self.SPI.transfer(read=True)
-        self.SPI.end()
-
-        return i
+        rx = self._transaction(
+            [INSTRUCTION.INSTRUCTION_READ_STATUS, SPI_DUMMY_INT]
+        )
+        return rx[1]
 
     def setConfigMode(self) -> int:
         return self.setMode(CANCTRL_REQOP_MODE.CANCTRL_REQOP_CONFIG)
@@ -178,76 +451,135 @@ class CAN:
     def setNormalMode(self) -> int:
         return self.setMode(CANCTRL_REQOP_MODE.CANCTRL_REQOP_NORMAL)
 
+    def setOneShotMode(self, enable: bool) -> None:
+        self.modifyRegister(REGISTER.MCP_CANCTRL, CANCTRL_OSM, CANCTRL_OSM if enable else 0)
+
+    @_exclusive
     def setMode(self, mode: int) -> int:
         self.modifyRegister(REGISTER.MCP_CANCTRL, CANCTRL_REQOP, mode)
-
-        # Wait for the mode to change (timeout after 10ms)
-        start_time = time.time()
+        if mode == CANCTRL_REQOP_MODE.CANCTRL_REQOP_SLEEP:
+            # Waking up on bus activity changes REQOP behind our back
+            self.shadow_valid[REGISTER.MCP_CANCTRL] = 0
+
+        # Wait for the mode to change (timeout after 10ms). CANSTAT follows
+        # within a few bit times, polling back to back instead of sleeping
+        # keeps the controller off the bus for as short as possible.
+        start_time = time.monotonic()
         modeMatch = False
-        while (time.time() - start_time) < 0.01:  # 10ms timeout
+        while (time.monotonic() - start_time) < 0.01:  # 10ms timeout
             newmode = self.readRegister(REGISTER.MCP_CANSTAT)
             newmode &= CANSTAT_OPMOD
 
             modeMatch = newmode == mode
             if modeMatch:
                 break
-            time.sleep(0.001)  # 1ms delay
-
-        return ERROR.ERROR_OK if modeMatch else ERROR.ERROR_FAIL
-
-#     def setBitrate(self, canSpeed: int, canClock: int = CAN_CLOCK.MCP_8MHZ) -> int:
-#         error = self.setConfigMode()
-#         if error != ERROR.ERROR_OK:
-#             return error
-# 
-#         set_ = 1
-#         try:
-#             cfg1, cfg2, cfg3 = CAN_CFGS[canClock][canSpeed]
-#         except KeyError:
-#             set_ = 0
-# 
-#         if set_:
-#             self.setRegister(REGISTER.MCP_CNF1, cfg1)
-#             self.setRegister(REGISTER.MCP_CNF2, cfg2)
-#             self.setRegister(REGISTER.MCP_CNF3, cfg3)
-#             return ERROR.ERROR_OK
-#         return ERROR.ERROR_FAIL
 
+        if not modeMatch:
+            self.mode_timeouts += 1
+            return ERROR.ERROR_FAIL
+        return ERROR.ERROR_OK
+
+    def bitTiming(self, canSpeed: int, canClock: int) -> Optional[Tuple[int, int, int]]:
+        """CNF1-3 values for a bitrate, see bittiming.bit_timing().
+
+        Args:
+            canSpeed: CAN_SPEED value or bitrate in bit/s
+            canClock: CAN_CLOCK value or crystal frequency in Hz
+
+        Returns:
+            Tuple with (CNF1, CNF2, CNF3), or None if the crystal cannot
+            produce the bitrate
+        """
+        timing = bit_timing(canSpeed, canClock)
+        if timing is None:
+            print(f"Error: Invalid speed {canSpeed} for clock type {canClock}.")
+            return None
+        return cnf_registers(timing)
+
+    @_exclusive
     def setBitrate(self, canSpeed: int, canClock: int = CAN_CLOCK.MCP_16MHZ) -> int:
+        cnf = self.bitTiming(canSpeed, canClock)
+        if cnf is None:
+            return ERROR.ERROR_FAIL
+
         error = self.setConfigMode()
         if error != ERROR.ERROR_OK:
             return error
 
-        try:
-            # First check if the clock type exists in the dictionary
-            if canClock not in CAN_CFGS:
-                print(f"Error: Invalid clock type {canClock}. Valid options are: {list(CAN_CFGS.keys())}")
-                return ERROR.ERROR_FAIL
-                
-            # Then check if the speed exists for that clock type
-            if canSpeed not in CAN_CFGS[canClock]:
-                print(f"Error: Invalid speed {canSpeed} for clock type {canClock}.")
-                print(f"Valid speeds for this clock are: {list(CAN_CFGS[canClock].keys())}")
+        cfg1, cfg2, cfg3 = cnf
+        # CNF3, CNF2 and CNF1 are contiguous
+        self.setRegisters(REGISTER.MCP_CNF3, bytes((cfg3, cfg2, cfg1)))
+        return ERROR.ERROR_OK
+
+    @_exclusive
+    def configure(
+        self,
+        canSpeed: Optional[int] = None,
+        canClock: int = CAN_CLOCK.MCP_16MHZ,
+        masks: Optional[List[Tuple[bool, int]]] = None,
+        filters: Optional[List[Tuple[bool, int]]] = None,
+        mode: Optional[int] = None,
+    ) -> int:
+        """Change bit timing, masks and filters in one pass through
+        configuration mode.
+
+        The filter registers are written as two bursts (RXF0-2, RXF3-5) and
+        the masks plus CNF3..CNF1 as one more, they are contiguous from
+        RXM0SIDH. The time spent off the bus is kept in config_downtime_ns.
+
+        Args:
+            canSpeed: CAN_SPEED value or bitrate in bit/s, None keeps the
+                bit timing
+            canClock: CAN_CLOCK value or crystal frequency in Hz
+            masks: Up to 2 (extended, mask) for RXM0 and RXM1, None keeps them
+            filters: Up to 6 (extended, ID) from RXF0 on, None keeps them
+            mode: CANCTRL_REQOP_MODE to end in, None returns to the current one
+
+        Returns:
+            ERROR_OK on success, otherwise error code
+        """
+        cnf = b""
+        if canSpeed is not None:
+            cnf = self.bitTiming(canSpeed, canClock)
+            if cnf is None:
                 return ERROR.ERROR_FAIL
-                
-            # Now safely get the configuration values
-            cfg1, cfg2, cfg3 = CAN_CFGS[canClock][canSpeed]
-            
-            # Set the registers
-            self.setRegister(REGISTER.MCP_CNF1, cfg1)
-            self.setRegister(REGISTER.MCP_CNF2, cfg2)
-            self.setRegister(REGISTER.MCP_CNF3, cfg3)
-            return ERROR.ERROR_OK
-        except KeyError as e:
-            print(f"Configuration error: {e}")
-            print(f"Available clock types: {list(CAN_CFGS.keys())}")
-            # If we have the requested clock, show available speeds for it
-            if canClock in CAN_CFGS:
-                print(f"Available speeds for clock {canClock}: {list(CAN_CFGS[canClock].keys())}")
-            return ERROR.ERROR_FAIL
-        except Exception as e:
-            print(f"Unexpected error in setBitrate: {e}")
+            cnf = bytes(reversed(cnf))
+        masks = masks or []
+        filters = filters or []
+        if len(masks) > 2 or len(filters) > 6:
             return ERROR.ERROR_FAIL
+
+        if mode is None:
+            mode = self.readRegister(REGISTER.MCP_CANSTAT) & CANSTAT_OPMOD
+        start = time.monotonic_ns()
+        error = self.setConfigMode()
+        if error != ERROR.ERROR_OK:
+            return error
+
+        runs = [
+            (REGISTER.MCP_RXF0SIDH, filters[:3]),
+            (REGISTER.MCP_RXF3SIDH, filters[3:]),
+            (REGISTER.MCP_RXM0SIDH, masks),
+        ]
+        for reg, ids in runs:
+            values = bytearray()
+            for ext, id_ in ids:
+                values += self.prepareId(ext, id_)
+            # CNF3 follows RXM1EID0, so both masks and the bit timing go
+            # out in the same burst
+            if reg == REGISTER.MCP_RXM0SIDH and cnf and len(masks) == 2:
+                values += cnf
+                cnf = b""
+            if values:
+                self.setRegisters(reg, values)
+        if cnf:
+            self.setRegisters(REGISTER.MCP_CNF3, cnf)
+
+        error = self.setMode(mode)
+        self.config_downtime_ns = time.monotonic_ns() - start
+        return error
+
+    @_exclusive
     def setClkOut(self, divisor: int) -> int:
         if divisor == CAN_CLKOUT.CLKOUT_DISABLE:
             # Turn off CLKEN
@@ -287,6 +619,7 @@ class CAN:
 
         return buffer
 
+    @_exclusive
     def setFilterMask(self, mask: int, ext: int, ulData: int) -> int:
         res = self.setConfigMode()
         if res != ERROR.ERROR_OK:
@@ -305,6 +638,7 @@ class CAN:
 
         return ERROR.ERROR_OK
 
+    @_exclusive
     def setFilter(self, ft: int, ext: int, ulData: int) -> int:
         res = self.setConfigMode()
         if res != ERROR.ERROR_OK:
@@ -331,59 +665,109 @@ class CAN:
 
         return ERROR.ERROR_OK
 
-    def sendMessage(self, frame: Any, txbn: Optional[int] = None) -> int:
-        if txbn is None:
-            return self.sendMessage_(frame)
-
-        if frame.dlc > CAN_MAX_DLEN:
-            return ERROR.ERROR_FAILTX
-
-        txbuf = TXB[txbn]
-
-        ext = frame.can_id & CAN_EFF_FLAG
-        rtr = frame.can_id & CAN_RTR_FLAG
+    def prepareFrame(self, frame: Any) -> bytearray:
+        ext = frame.is_extended_id
+        rtr = frame.is_remote_frame
         id_ = frame.can_id & (CAN_EFF_MASK if ext else CAN_SFF_MASK)
 
         data = self.prepareId(ext, id_)
-        mcp_dlc = (frame.dlc | RTR_MASK) if rtr else frame.dlc
+        data.append((frame.dlc | RTR_MASK) if rtr else frame.dlc)
+        data.extend(frame.data)
 
-        data.extend(bytearray(1 + frame.dlc))
-        data[MCP_DLC] = mcp_dlc
-        for i in range(frame.dlc):
-            data[MCP_DATA + i] = frame.data[i]
+        return data
 
-        self.setRegisters(txbuf.SIDH, data)
-
-        self.modifyRegister(
-            txbuf.CTRL, TXBnCTRL.TXB_TXREQ, TXBnCTRL.TXB_TXREQ, spifastend=True
-        )
+    def loadTxBuffer(self, frame: Any, txbn: int, txp: Optional[int] = None) -> None:
+        data = self.prepareFrame(frame)
+        if txp is None:
+            # LOAD TX BUFFER starts at TXBnSIDH, no address byte needed
+            self._transaction([TXB[txbn].LOAD, *data])
+        else:
+            # WRITE from TXBnCTRL sets the priority in the same transfer
+            self.setRegisters(TXB[txbn].CTRL, bytes((txp & TXBnCTRL.TXB_TXP,)) + data)
+
+    def requestToSend(self, *txbns: int) -> None:
+        # A single RTS instruction can start any combination of buffers
+        rts = 0
+        for txbn in txbns:
+            rts |= TXB[txbn].RTS
+        with self._spi_lock:
+            self.SPI.transaction([rts])
+            for txbn in txbns:
+                self.tx_frames[txbn] += 1
+
+    @_txPath
+    def sendMessage(self, frame: Any, txbn: Optional[int] = None) -> int:
+        if txbn is None:
+            return self.sendMessage_(frame)
 
-        ctrl = self.readRegister(txbuf.CTRL)
-        if ctrl & (TXBnCTRL.TXB_ABTF | TXBnCTRL.TXB_MLOA | TXBnCTRL.TXB_TXERR):
+        if frame.dlc > CAN_MAX_DLEN:
             return ERROR.ERROR_FAILTX
+
+        self.loadTxBuffer(frame, txbn)
+        self.requestToSend(txbn)
         return ERROR.ERROR_OK
 
+    @_txPath
     def sendMessage_(self, frame: Any) -> int:
         if frame.dlc > CAN_MAX_DLEN:
             return ERROR.ERROR_FAILTX
 
-        txBuffers = [TXBn.TXB0, TXBn.TXB1, TXBn.TXB2]
-
-        for i in range(N_TXBUFFERS):
-            txbuf = TXB[txBuffers[i]]
-            ctrlval = self.readRegister(txbuf.CTRL)
-            if (ctrlval & TXBnCTRL.TXB_TXREQ) == 0:
-                return self.sendMessage(frame, txBuffers[i])
+        # READ STATUS reports TXREQ of all three buffers in one transfer
+        status = self.getStatus()
+        for txbn in (TXBn.TXB0, TXBn.TXB1, TXBn.TXB2):
+            if (status & TXB[txbn].STATTXREQ) == 0:
+                return self.sendMessage(frame, txbn)
 
+        self.tx_busy += 1
         return ERROR.ERROR_ALLTXBUSY
 
-    def readMessage(self, rxbn: int = None) -> Tuple[int, Any]:
+    @_txPath
+    def sendMessages(self, frames: List[Any]) -> Tuple[int, int]:
+        """Load one frame per free TX buffer and start them with one RTS.
+
+        Returns (error, number of frames queued), ERROR_ALLTXBUSY if some
+        frames did not fit into the free buffers.
+        """
+        for frame in frames:
+            if frame.dlc > CAN_MAX_DLEN:
+                return ERROR.ERROR_FAILTX, 0
+
+        status = self.getStatus()
+        loaded = []
+        # With equal TXP the highest buffer number goes first, so fill
+        # from TXB2 down to keep the frames in order on the bus
+        for txbn in (TXBn.TXB2, TXBn.TXB1, TXBn.TXB0):
+            if len(loaded) == len(frames):
+                break
+            if status & TXB[txbn].STATTXREQ:
+                continue
+            self.loadTxBuffer(frames[len(loaded)], txbn)
+            loaded.append(txbn)
+
+        if loaded:
+            self.requestToSend(*loaded)
+        if len(loaded) < len(frames):
+            self.tx_busy += 1
+            return ERROR.ERROR_ALLTXBUSY, len(loaded)
+        return ERROR.ERROR_OK, len(loaded)
+
+    def readMessageRaw(self, rxbn: int = None) -> Tuple[int, int, List[int]]:
+        """Read one RX buffer without building a frame object.
+
+        Returns (error, can_id including flags, buffer), the payload is
+        buffer[MCP_DATA:MCP_DATA + (buffer[MCP_DLC] & DLC_MASK)].
+        """
         if rxbn is None:
-            return self.readMessage_()
+            return self.readMessageRaw_()
 
         rxb = RXB[rxbn]
 
-        tbufdata = self.readRegisters(rxb.SIDH, 1 + CAN_IDLEN)
+        # READ RX BUFFER skips the address byte and clears RXnIF when CS
+        # is released, so no separate BITMOD of CANINTF is needed
+        with self._spi_lock:
+            tbufdata = self.SPI.transaction([rxb.READ] + [SPI_DUMMY_INT] * RXB_READ_LEN)
+            self.rx_frames[rxbn] += 1
+        del tbufdata[0]
 
         id_ = (tbufdata[MCP_SIDH] << 3) + (tbufdata[MCP_SIDL] >> 5)
 
@@ -392,38 +776,120 @@ class CAN:
             id_ = (id_ << 8) + tbufdata[MCP_EID8]
             id_ = (id_ << 8) + tbufdata[MCP_EID0]
             id_ |= CAN_EFF_FLAG
-
-        dlc = tbufdata[MCP_DLC] & DLC_MASK
-        if dlc > CAN_MAX_DLEN:
-            return ERROR.ERROR_FAIL, None
-
-        ctrl = self.readRegister(rxb.CTRL)
-        if ctrl & RXBnCTRL_RTR:
+            if tbufdata[MCP_DLC] & RTR_MASK:
+                id_ |= CAN_RTR_FLAG
+        elif tbufdata[MCP_SIDL] & RXB_SRR_MASK:
             id_ |= CAN_RTR_FLAG
 
-        frame = CANFrame(can_id=id_)
+        if tbufdata[MCP_DLC] & DLC_MASK > CAN_MAX_DLEN:
+            return ERROR.ERROR_FAIL, id_, tbufdata
 
-        data_array = self.readRegisters(rxb.DATA, dlc)
-        frame.data = bytes(data_array)
+        return ERROR.ERROR_OK, id_, tbufdata
 
-        return ERROR.ERROR_OK, frame
-
-    def readMessage_(self) -> Tuple[int, Any]:
-        rc = ERROR.ERROR_NOMSG, None
+    @_rxPath
+    def readMessageRaw_(self) -> Tuple[int, int, List[int]]:
+        rc = ERROR.ERROR_NOMSG, 0, None
 
         stat = self.getStatus()
         if stat & STAT.STAT_RX0IF and self.mcp2515_rx_index == 0:
-            rc = self.readMessage(RXBn.RXB0)
+            rc = self.readMessageRaw(RXBn.RXB0)
             if self.getStatus() & STAT.STAT_RX1IF:
                 self.mcp2515_rx_index = 1
-            self.modifyRegister(REGISTER.MCP_CANINTF, RXB[RXBn.RXB0].CANINTFRXnIF, 0)
         elif stat & STAT.STAT_RX1IF:
-            rc = self.readMessage(RXBn.RXB1)
+            rc = self.readMessageRaw(RXBn.RXB1)
             self.mcp2515_rx_index = 0
-            self.modifyRegister(REGISTER.MCP_CANINTF, RXB[RXBn.RXB1].CANINTFRXnIF, 0)
 
         return rc
 
+    @_rxPath
+    def drainRaw(
+        self, max_frames: int = 0, status: Optional[int] = None
+    ) -> Tuple[List[Tuple[int, List[int]]], int]:
+        """Read every pending RX buffer in arrival order.
+
+        READ STATUS is issued once per pass over both buffers instead of
+        twice per frame, so a burst of n frames costs about n / 2 + 1
+        status reads.
+
+        Args:
+            max_frames: Stop after this many frames, 0 for no limit
+            status: A READ STATUS value the caller already has
+
+        Returns:
+            Tuple with (list of (can_id including flags, buffer), last
+            READ STATUS value)
+        """
+        frames = []
+        if status is None:
+            status = self.getStatus()
+        while True:
+            rx = status & STAT_RXIF_MASK
+            if not rx:
+                break
+            if rx == STAT_RXIF_MASK:
+                # RXB1 only holds the older frame if it rolled over while
+                # RXB0 was still full
+                if self.mcp2515_rx_index == 1:
+                    order = (RXBn.RXB1, RXBn.RXB0)
+                else:
+                    order = (RXBn.RXB0, RXBn.RXB1)
+            elif rx & STAT.STAT_RX0IF:
+                order = (RXBn.RXB0,)
+            else:
+                order = (RXBn.RXB1,)
+
+            for rxbn in order:
+                error, id_, tbufdata = self.readMessageRaw(rxbn)
+                last = rxbn
+                if error == ERROR.ERROR_OK:
+                    frames.append((id_, tbufdata))
+                if max_frames and len(frames) >= max_frames:
+                    break
+
+            if max_frames and len(frames) >= max_frames:
+                pending = rxbn != order[-1]
+                self.mcp2515_rx_index = 1 if pending and last == RXBn.RXB0 else 0
+                break
+            status = self.getStatus()
+            # A frame that reached RXB1 while RXB0 was being read predates
+            # anything that lands in RXB0 afterwards
+            if last == RXBn.RXB0 and status & STAT.STAT_RX1IF:
+                self.mcp2515_rx_index = 1
+            else:
+                self.mcp2515_rx_index = 0
+
+        return frames, status
+
+    def drain(self, max_frames: int = 0) -> List[Any]:
+        """Read every pending RX buffer, see drainRaw().
+
+        Returns:
+            List of CanMsg objects, oldest first
+        """
+        frames, _ = self.drainRaw(max_frames)
+        now = time.monotonic_ns()
+        return [
+            CanMsg._from_raw(
+                id_, bytes(buf[MCP_DATA:MCP_DATA + (buf[MCP_DLC] & DLC_MASK)]), now
+            )
+            for id_, buf in frames
+        ]
+
+    def readMessage(self, rxbn: int = None) -> Tuple[int, Any]:
+        error, id_, tbufdata = self.readMessageRaw(rxbn)
+        if error != ERROR.ERROR_OK:
+            return error, None
+
+        dlc = tbufdata[MCP_DLC] & DLC_MASK
+        frame = CanMsg._from_raw(
+            id_, bytes(tbufdata[MCP_DATA:MCP_DATA + dlc]), time.monotonic_ns()
+        )
+
+        return ERROR.ERROR_OK, frame
+
+    def readMessage_(self) -> Tuple[int, Any]:
+        return self.readMessage()
+
     def checkReceive(self) -> bool:
         res = self.getStatus()
         if res & STAT_RXIF_MASK:
@@ -438,10 +904,20 @@ class CAN:
         return False
 
     def getErrorFlags(self) -> int:
-        return self.readRegister(REGISTER.MCP_EFLG)
+        with self._spi_lock:
+            eflg = self.readRegister(REGISTER.MCP_EFLG)
+            raised = eflg & ~self._eflg
+            self._eflg = eflg
+        if raised:
+            for bit in range(8):
+                if raised >> bit & 1:
+                    self.error_flags[bit] += 1
+        return eflg
 
     def clearRXnOVRFlags(self) -> None:
-        self.modifyRegister(REGISTER.MCP_EFLG, EFLG.EFLG_RX0OVR | EFLG.EFLG_RX1OVR, 0)
+        with self._spi_lock:
+            self.modifyRegister(REGISTER.MCP_EFLG, EFLG.EFLG_RX0OVR | EFLG.EFLG_RX1OVR, 0)
+            self._eflg &= ~(EFLG.EFLG_RX0OVR | EFLG.EFLG_RX1OVR)
 
     def getInterrupts(self) -> int:
         return self.readRegister(REGISTER.MCP_CANINTF)
@@ -452,10 +928,18 @@ class CAN:
     def getInterruptMask(self) -> int:
         return self.readRegister(REGISTER.MCP_CANINTE)
 
-    def clearTXInterrupts(self) -> None:
+    def setTXInterrupts(self, enable: bool) -> None:
+        self.modifyRegister(
+            REGISTER.MCP_CANINTE,
+            CANINTF_TXIF_MASK,
+            CANINTF_TXIF_MASK if enable else 0,
+        )
+
+    def clearTXInterrupts(self, flags: int = None) -> None:
+        # flags selects which CANINTF.TXnIF bits to clear, default all three
         self.modifyRegister(
             REGISTER.MCP_CANINTF,
-            CANINTF.CANINTF_TX0IF | CANINTF.CANINTF_TX1IF | CANINTF.CANINTF_TX2IF,
+            CANINTF_TXIF_MASK if flags is None else flags,
             0,
         )
 
@@ -471,6 +955,39 @@ class CAN:
     def clearERRIF(self) -> None:
         self.modifyRegister(REGISTER.MCP_CANINTF, CANINTF.CANINTF_ERRIF, 0)
         
+    def getStats(self) -> dict:
+        """Counters since creation or the last resetStats().
+
+        error_flags counts how often each EFLG bit was seen going from
+        clear to set, EFLG is only read by getErrorFlags() and its users.
+
+        Returns:
+            Dict with rx_frames per RX buffer, tx_frames per TX buffer
+            (transmissions requested), tx_busy (ALLTXBUSY rejections),
+            mode_timeouts, error_flags by EFLG bit name and the shadow
+            register hits and misses
+        """
+        return {
+            "rx_frames": list(self.rx_frames),
+            "tx_frames": list(self.tx_frames),
+            "tx_busy": self.tx_busy,
+            "mode_timeouts": self.mode_timeouts,
+            "error_flags": {
+                name: self.error_flags[bit] for bit, name in enumerate(EFLG_NAMES)
+            },
+            "shadow_hits": self.shadow_hits,
+            "shadow_misses": self.shadow_misses,
+        }
+
+    def resetStats(self) -> None:
+        self.rx_frames = [0, 0]
+        self.tx_frames = [0, 0, 0]
+        self.tx_busy = 0
+        self.mode_timeouts = 0
+        self.error_flags = [0] * 8
+        self.shadow_hits = 0
+        self.shadow_misses = 0
+
     def cleanup(self) -> None:
         """Clean up resources"""
         self.SPI.cleanup()
@@ -0,0 +1,298 @@
+'''
+replay.py
+Timed replay of captured traffic and a cangen style traffic generator
+Replayer sends frames through CAN_1.send() on an absolute schedule taken
+from the frame timestamps, so sleep overshoot never accumulates into
+drift: every frame is due at start + (timestamp - first timestamp) / rate,
+the thread sleeps until shortly before that and spins the rest. In
+saturate mode the schedule is ignored and the TX queue is kept topped up
+so all three TX buffers stay loaded. Frames come from capture files,
+candump -L logs or generate_frames()
+'''
+import random
+import re
+import sys
+import time
+from collections import deque
+from typing import Any, Iterable, Iterator, Optional, Tuple, Union
+
+from .can import CAN_EFF_FLAG, CAN_EFF_MASK, CAN_MAX_DLEN, CAN_RTR_FLAG, CAN_SFF_MASK, CanMsg
+from .capture import CAPTURE_MAGIC, CaptureReader
+from .constants import ERROR
+
+# The remainder of a wait that is spun instead of slept, covers the sleep
+# overshoot of a Pi 4 without a realtime kernel
+SPIN_NS = 300000
+# Frames queued ahead of the TX buffers in saturate mode, also the most
+# frames a scheduled replay lets pile up before waiting for completions
+TX_WINDOW = 16
+# Delay between run() and the first frame, time to get going
+START_DELAY_NS = 5000000
+# How long run() waits for the last frames to complete
+DRAIN_TIMEOUT = 1.0
+# Suggested GIL switch interval for Replayer(switch_interval=...). With the
+# default 5 ms a polling I/O thread keeps the replay thread waiting for the
+# GIL past the due times
+SWITCH_INTERVAL = 0.0005
+
+# (can_id including flags, data, timestamp_ns)
+Record = Tuple[int, bytes, int]
+
+# (1436509052.249713) can0 18FEF100#0102030405060708, R for a remote frame
+_CANDUMP_LINE = re.compile(
+    r"\s*\((\d+)\.(\d+)\)\s+(\S+)\s+([0-9A-Fa-f]{1,8})#(R\d?|[0-9A-Fa-f]*)\s*$"
+)
+
+
+def read_candump(lines: Iterable[str], channel: Optional[str] = None) -> Iterator[Record]:
+    """Parse a candump -L log, lines that are not frames are skipped.
+
+    IDs written with more than 3 hex digits are extended frames.
+
+    Args:
+        lines: Open text file or any iterable of lines
+        channel: Only frames of this interface (default: None, all)
+
+    Returns:
+        Iterator of (can_id including flags, data, timestamp_ns)
+    """
+    for line in lines:
+        match = _CANDUMP_LINE.match(line)
+        if match is None:
+            continue
+        seconds, fraction, iface, can_id, payload = match.groups()
+        if channel is not None and iface != channel:
+            continue
+        timestamp = int(seconds) * 1000000000 + int(fraction.ljust(9, "0")[:9])
+        flags = CAN_EFF_FLAG if len(can_id) > 3 else 0
+        can_id = int(can_id, 16) & (CAN_EFF_MASK if flags else CAN_SFF_MASK)
+        if payload[:1] in ("R", "r"):
+            yield can_id | flags | CAN_RTR_FLAG, b"", timestamp
+        else:
+            yield can_id | flags, bytes.fromhex(payload)[:CAN_MAX_DLEN], timestamp
+
+
+def open_records(path: str) -> Iterator[Record]:
+    """Frames of a capture file or a candump -L log, told apart by content."""
+    with open(path, "rb") as f:
+        binary = f.read(len(CAPTURE_MAGIC)) == CAPTURE_MAGIC
+    if binary:
+        return iter(CaptureReader(path))
+    return _read_candump_file(path)
+
+
+def _read_candump_file(path: str) -> Iterator[Record]:
+    with open(path) as f:
+        for record in read_candump(f):
+            yield record
+
+
+def generate_frames(count: Optional[int] = None, can_id: Union[int, str] = "r",
+                    dlc: Union[int, str] = "r", data: Union[bytes, str] = "r",
+                    gap: float = 0.0, extended: bool = False,
+                    seed: Optional[int] = None) -> Iterator[Record]:
+    """Synthetic frames in the style of can-utils cangen.
+
+    Args:
+        count: Number of frames (default: None, endless)
+        can_id: Fixed ID, "r" random or "i" incrementing (default: "r")
+        dlc: Fixed length, "r" random or "i" incrementing (default: "r")
+        data: Fixed payload, "r" random or "i" an incrementing counter in
+            the first bytes (default: "r")
+        gap: Seconds between frame timestamps, 0 for back to back
+        extended: Use 29 bit IDs
+        seed: Seed of the random choices, for repeatable runs
+
+    Returns:
+        Iterator of (can_id including flags, data, timestamp_ns)
+    """
+    rng = random.Random(seed)
+    id_mask = CAN_EFF_MASK if extended else CAN_SFF_MASK
+    flags = CAN_EFF_FLAG if extended else 0
+    gap_ns = int(gap * 1e9)
+    n = 0
+    while count is None or n < count:
+        if can_id == "r":
+            frame_id = rng.getrandbits(29 if extended else 11)
+        elif can_id == "i":
+            frame_id = n & id_mask
+        else:
+            frame_id = can_id & id_mask
+        if dlc == "r":
+            length = rng.randint(0, CAN_MAX_DLEN)
+        elif dlc == "i":
+            length = n % (CAN_MAX_DLEN + 1)
+        else:
+            length = dlc
+        if data == "r":
+            payload = bytes(rng.getrandbits(8) for _ in range(length))
+        elif data == "i":
+            payload = (n & (1 << 8 * CAN_MAX_DLEN) - 1).to_bytes(CAN_MAX_DLEN, "little")[:length]
+        else:
+            payload = bytes(data[:length])
+        yield frame_id | flags, payload, n * gap_ns
+        n += 1
+
+
+def _percentile(samples: list, q: float) -> float:
+    return samples[min(len(samples) - 1, int(q * len(samples)))] if samples else 0
+
+
+class Replayer:
+    def __init__(self, bus: Any, records: Iterable[Record], rate: float = 1.0,
+                 saturate: bool = False, max_late: Optional[float] = None,
+                 keep_order: bool = True, window: int = TX_WINDOW,
+                 switch_interval: Optional[float] = None) -> None:
+        """Send frames through a CAN_1 on their original timing.
+
+        Args:
+            bus: CAN_1 object, begin() must have been called
+            records: Iterable of (can_id including flags, data,
+                timestamp_ns), see open_records() and generate_frames()
+            rate: Speed up factor of the schedule, 2.0 replays twice as
+                fast (default: 1.0)
+            saturate: Ignore the timestamps and send as fast as the bus
+                takes the frames
+            max_late: Skip frames that are more than this many seconds
+                behind schedule, counted as dropped (default: None, send
+                every frame however late)
+            keep_order: Send in record order instead of the CAN ID order
+                the TX scheduler would pick for frames queued together
+            window: Frames allowed in the TX queue and buffers at once
+            switch_interval: Set sys.setswitchinterval() to this while
+                run() replays and restore it afterwards, e.g.
+                SWITCH_INTERVAL. The setting is process wide, leave it
+                None when several Replayers run at once and set it once
+                around all of them (default: None, unchanged)
+        """
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.bus = bus
+        self.records = records
+        self.rate = rate
+        self.saturate = saturate
+        self.max_late_ns = None if max_late is None else int(max_late * 1e9)
+        self.keep_order = keep_order
+        self.window = window
+        self.switch_interval = switch_interval
+        self._running = False
+
+    def stop(self) -> None:
+        """Make run() stop after the current frame, from any thread."""
+        self._running = False
+
+    def run(self) -> dict:
+        """Replay all records, blocking until the last one completed.
+
+        Returns:
+            Dict with frames (taken from records), sent, dropped (failed
+            or skipped), elapsed_s, frames_per_sec and the timing error
+            of the frames, load time minus due time, as error_p50_us,
+            error_p99_us and error_max_us (0 in saturate mode)
+        """
+        bus = self.bus
+        started_io = bus._io_thread is None
+        if started_io:
+            bus._start_io()
+        self._running = True
+        switch_interval = sys.getswitchinterval()
+        if self.switch_interval is not None:
+            sys.setswitchinterval(self.switch_interval)
+        saturate = self.saturate
+        rate = self.rate
+        max_late = self.max_late_ns
+        monotonic_ns = time.monotonic_ns
+        in_flight = deque()  # (handle, due_ns)
+        done = []
+        frames = skipped = 0
+        first = None
+        start = monotonic_ns() + START_DELAY_NS
+        try:
+            for seq, (can_id, data, timestamp) in enumerate(self.records):
+                if not self._running:
+                    break
+                frames += 1
+                while len(in_flight) >= self.window:
+                    in_flight[0][0].wait(DRAIN_TIMEOUT)
+                    done.append(in_flight.popleft())
+                due = 0
+                if not saturate:
+                    if first is None:
+                        first = timestamp
+                    due = start + int((timestamp - first) / rate)
+                    now = monotonic_ns()
+                    if max_late is not None and now - due > max_late:
+                        skipped += 1
+                        continue
+                    if due - now > SPIN_NS:
+                        time.sleep((due - now - SPIN_NS) / 1e9)
+                    while monotonic_ns() < due:
+                        time.sleep(0)
+                elif first is None:
+                    first = start = monotonic_ns()
+                handle = bus.send(CanMsg(can_id, data), seq if self.keep_order else None)
+                in_flight.append((handle, due))
+            for handle, due in in_flight:
+                handle.wait(DRAIN_TIMEOUT)
+            done.extend(in_flight)
+        finally:
+            self._running = False
+            if self.switch_interval is not None:
+                sys.setswitchinterval(switch_interval)
+            if started_io:
+                bus._stop_io()
+
+        end = max([handle.sent_ns for handle, _ in done] or [monotonic_ns()])
+        sent = sum(1 for handle, _ in done if handle.error == ERROR.ERROR_OK)
+        errors = sorted(
+            (handle.loaded_ns - due) / 1e3
+            for handle, due in done if due and handle.loaded_ns
+        )
+        elapsed = max(end - start, 1) / 1e9
+        return {
+            "frames": frames,
+            "sent": sent,
+            "dropped": frames - sent,
+            "skipped": skipped,
+            "elapsed_s": elapsed,
+            "frames_per_sec": sent / elapsed,
+            "error_p50_us": _percentile(errors, 0.5),
+            "error_p99_us": _percentile(errors, 0.99),
+            "error_max_us": errors[-1] if errors else 0,
+        }
+
+
+def main() -> None:
+    import argparse
+    from .CAN import CAN_1
+    parser = argparse.ArgumentParser(description="Replay or generate CAN traffic")
+    parser.add_argument("path", nargs="?", help="capture file or candump -L log")
+    parser.add_argument("--rate", type=float, default=1.0, help="replay speed factor")
+    parser.add_argument("--saturate", action="store_true", help="send as fast as possible")
+    parser.add_argument("--count", type=int, default=1000, help="generated frames")
+    parser.add_argument("--gap", type=float, default=0.001, help="seconds between generated frames")
+    parser.add_argument("--bitrate", type=int, default=500000)
+    parser.add_argument("--clock", type=int, default=16000000, help="MCP2515 crystal in Hz")
+    parser.add_argument("--spics", type=int, default=8)
+    parser.add_argument("--int-pin", type=int)
+    parser.add_argument("--loopback", action="store_true")
+    args = parser.parse_args()
+
+    bus = CAN_1(spics=args.spics, int_pin=args.int_pin)
+    if bus.begin(args.bitrate, args.clock, 'loopback' if args.loopback else 'normal') != ERROR.ERROR_OK:
+        raise SystemExit("CAN init failed")
+    if args.path:
+        records = open_records(args.path)
+    else:
+        records = generate_frames(args.count, gap=args.gap)
+    try:
+        result = Replayer(bus, records, args.rate, args.saturate,
+                          switch_interval=SWITCH_INTERVAL).run()
+    finally:
+        bus.cleanup()
+    for key, value in result.items():
+        print("%-16s %.1f" % (key, value))
+
+
+if __name__ == "__main__":
+    main()
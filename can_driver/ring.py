@@ -0,0 +1,130 @@
+'''
+ring.py
+Fixed capacity receive ring buffer for CAN frames
+All storage is allocated up front in flat arrays, so buffering a frame
+does not create any Python objects
+'''
+import array
+import time
+from typing import Optional, Tuple
+
+from .can import CAN_EFF_MASK, CAN_FLAGS_SHIFT, CAN_MAX_DLEN
+
+
+class RxRing:
+    # What push() does when the ring is full
+    OVERWRITE_OLDEST = 0
+    DROP_NEWEST = 1
+
+    def __init__(self, capacity: int = 1024, policy: int = OVERWRITE_OLDEST) -> None:
+        """Preallocate storage for capacity frames.
+
+        Slot i of ids, flags, dlcs and timestamps describes one frame, its
+        payload is payload[i * 8:i * 8 + dlcs[i]]. The ring is not thread
+        safe, callers serialize push and pop themselves.
+
+        Args:
+            capacity: Number of frames the ring can hold
+            policy: OVERWRITE_OLDEST or DROP_NEWEST
+        """
+        if capacity <= 0:
+            raise ValueError("capacity must be positive")
+        if policy not in (self.OVERWRITE_OLDEST, self.DROP_NEWEST):
+            raise ValueError("unknown ring policy %r" % policy)
+        self.capacity = capacity
+        self.policy = policy
+
+        self.ids = array.array("I", bytes(4 * capacity))
+        self.flags = array.array("B", bytes(capacity))
+        self.dlcs = array.array("B", bytes(capacity))
+        self.timestamps = array.array("q", bytes(8 * capacity))
+        self.payload = bytearray(CAN_MAX_DLEN * capacity)
+        self._payload_view = memoryview(self.payload)
+
+        # Absolute read and write positions, slot is position % capacity
+        self._head = 0
+        self._tail = 0
+
+        self.received = 0
+        self.dropped = 0
+        self.overwritten = 0
+
+    def __len__(self) -> int:
+        return self._tail - self._head
+
+    def push(self, can_id: int, data, timestamp_ns: Optional[int] = None) -> bool:
+        """Store one frame.
+
+        Args:
+            can_id: 32 bit CAN ID including the EFF/RTR/ERR flags
+            data: Payload, any sequence of up to 8 byte values
+            timestamp_ns: Receive time, defaults to time.monotonic_ns()
+
+        Returns:
+            False if the frame was dropped because the ring is full
+        """
+        if self._tail - self._head == self.capacity:
+            if self.policy == self.DROP_NEWEST:
+                self.dropped += 1
+                return False
+            self._head += 1
+            self.overwritten += 1
+
+        slot = self._tail % self.capacity
+        dlc = len(data)
+        self.ids[slot] = can_id & CAN_EFF_MASK
+        self.flags[slot] = can_id >> CAN_FLAGS_SHIFT
+        self.dlcs[slot] = dlc
+        self.timestamps[slot] = (
+            time.monotonic_ns() if timestamp_ns is None else timestamp_ns
+        )
+        offset = slot * CAN_MAX_DLEN
+        self.payload[offset:offset + dlc] = data
+        self._tail += 1
+        self.received += 1
+        return True
+
+    def pop(self) -> Optional[Tuple[int, bytes, int]]:
+        """Remove the oldest frame.
+
+        Returns:
+            Tuple with (can_id including flags, data, timestamp_ns), or
+            None if the ring is empty
+        """
+        if self._tail == self._head:
+            return None
+        slot = self._head % self.capacity
+        offset = slot * CAN_MAX_DLEN
+        frame = (
+            self.ids[slot] | (self.flags[slot] << CAN_FLAGS_SHIFT),
+            bytes(self.payload[offset:offset + self.dlcs[slot]]),
+            self.timestamps[slot],
+        )
+        self._head += 1
+        return frame
+
+    def readable(self) -> Tuple[int, int]:
+        """Return (first slot, count) of the oldest contiguous run of frames.
+
+        The run ends at the end of the arrays, so a wrapped ring is read in
+        two passes of readable() and consume().
+        """
+        slot = self._head % self.capacity
+        return slot, min(self._tail - self._head, self.capacity - slot)
+
+    def consume(self, n: int) -> None:
+        """Release the n oldest frames after reading them in place."""
+        self._head += min(n, self._tail - self._head)
+
+    def data(self, slot: int) -> memoryview:
+        """Zero-copy view of the payload stored in slot.
+
+        With OVERWRITE_OLDEST the view is only valid until the producer
+        wraps around to this slot again.
+        """
+        offset = slot * CAN_MAX_DLEN
+        return self._payload_view[offset:offset + self.dlcs[slot]]
+
+    def clear(self) -> None:
+        """Drop all buffered frames, counters are kept."""
+        self._head = self._tail
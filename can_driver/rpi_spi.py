@@ -7,30 +7,61 @@ Modified by: Yui Nguyen
 Date: March 16th, 2025
 SPI Interface for Raspberry Pi 4
 '''
+import threading
 import time
-import spidev
-import RPi.GPIO as GPIO
+
+try:
+    import spidev
+    import RPi.GPIO as GPIO
+except ImportError:
+    # Not on a Pi, only other backends such as emulator.MCP2515Emulator work
+    spidev = None
+    GPIO = None
 
 from .constants import SPI_DEFAULT_BAUDRATE, SPI_DUMMY_INT, SPI_TRANSFER_LEN, SPI_HOLD_US
 
+# One lock per SPI bus, shared by every SPI object opened on it. A GPIO
+# chip select is driven outside the kernel transfer, so no other device on
+# the bus may be clocked while it is low.
+_bus_locks = {}
+_bus_locks_guard = threading.Lock()
+
+
+def bus_lock(bus):
+    """Lock serializing transactions on one SPI bus."""
+    with _bus_locks_guard:
+        return _bus_locks.setdefault(bus, threading.Lock())
+
+
 class SPI:
     def __init__(self, cs=8, baudrate=SPI_DEFAULT_BAUDRATE, bus=0, device=0):
         """Initialize SPI interface for Raspberry Pi 4.
         
         Args:
-            cs: GPIO pin number for chip select (BCM numbering)
+            cs: GPIO pin number for chip select (BCM numbering), or None to
+                let spidev drive the hardware CE line of `device`
             baudrate: SPI clock frequency in Hz
             bus: SPI bus number
-            device: SPI device/chip select
+            device: SPI device/chip select, with a GPIO chip select the
+                kernel CS line to park the transfers on
         """
-        # Initialize GPIO
-        GPIO.setwarnings(False)
-        GPIO.setmode(GPIO.BCM)
-        GPIO.setup(cs, GPIO.OUT)
-        GPIO.output(cs, GPIO.HIGH)
-        
+        if spidev is None:
+            raise ImportError("SPI needs the spidev and RPi.GPIO packages")
         # SPI CS pin
         self._SPICS = cs
+        self._bus_lock = bus_lock(bus)
+        # Always-on counters, see stats()
+        self.transactions = 0
+        self.bytes = 0
+        self.cs_toggles = 0
+        self.sleep_ns = 0
+
+        # Initialize GPIO, only needed for a software chip select
+        if cs is not None:
+            GPIO.setwarnings(False)
+            GPIO.setmode(GPIO.BCM)
+            GPIO.setup(cs, GPIO.OUT)
+            GPIO.output(cs, GPIO.HIGH)
         
         # Initialize SPI
         self._SPI = spidev.SpiDev()
@@ -45,13 +76,51 @@ class SPI:
     
     def start(self):
         """Pull CS low to start SPI communication."""
+        if self._SPICS is None:
+            return
         GPIO.output(self._SPICS, GPIO.LOW)
-        time.sleep(SPI_HOLD_US / 1000000.0)
+        with self._bus_lock:
+            self.cs_toggles += 1
+        self._hold()
     
     def end(self):
         """Pull CS high to end SPI communication."""
+        if self._SPICS is None:
+            return
         GPIO.output(self._SPICS, GPIO.HIGH)
+        with self._bus_lock:
+            self.cs_toggles += 1
+        self._hold()
+
+    def _hold(self):
+        start = time.monotonic_ns()
         time.sleep(SPI_HOLD_US / 1000000.0)
+        with self._bus_lock:
+            self.sleep_ns += time.monotonic_ns() - start
+
+    def transaction(self, tx):
+        """Clock out a whole MCP2515 instruction in a single CS cycle.
+        
+        CS is held low for the full transfer, by spidev for a hardware CE
+        line or around the transfer for a GPIO chip select. Transactions of
+        all controllers on the same SPI bus are serialized.
+        
+        Args:
+            tx: Bytes to write (list, bytes or bytearray)
+            
+        Returns:
+            List of bytes read back, same length as tx
+        """
+        with self._bus_lock:
+            self.transactions += 1
+            self.bytes += len(tx)
+            if self._SPICS is None:
+                return self._SPI.xfer2(list(tx))
+            GPIO.output(self._SPICS, GPIO.LOW)
+            rx = self._SPI.xfer2(list(tx))
+            GPIO.output(self._SPICS, GPIO.HIGH)
+            self.cs_toggles += 2
+            return rx
     
     def transfer(self, value=SPI_DUMMY_INT, read=False):
         """Write int value to SPI and read SPI value simultaneously.
@@ -63,14 +132,42 @@ class SPI:
         Returns:
             Read byte value if read=True, otherwise None
         """
-        if read:
-            # For read operations, send the value and read the response
-            response = self._SPI.xfer2([value])
-            return response[0]
-        else:
-            # For write operations, just send the value
-            self._SPI.xfer2([value])
-            return None
+        with self._bus_lock:
+            self.bytes += 1
+            if read:
+                # For read operations, send the value and read the response
+                response = self._SPI.xfer2([value])
+                return response[0]
+            else:
+                # For write operations, just send the value
+                self._SPI.xfer2([value])
+                return None
+
+    def stats(self):
+        """Counters since creation or the last reset_stats().
+
+        cs_toggles only counts edges driven on a GPIO chip select, a
+        hardware CE line is toggled by the kernel once per transaction.
+
+        Returns:
+            Dict with transactions, bytes, cs_toggles and sleep_ns, the
+            time spent sleeping for CS hold times
+        """
+        # Under the bus lock the counters are updated with
+        with self._bus_lock:
+            return {
+                "transactions": self.transactions,
+                "bytes": self.bytes,
+                "cs_toggles": self.cs_toggles,
+                "sleep_ns": self.sleep_ns,
+            }
+
+    def reset_stats(self):
+        with self._bus_lock:
+            self.transactions = 0
+            self.bytes = 0
+            self.cs_toggles = 0
+            self.sleep_ns = 0
 
     def cleanup(self):
         """Clean up GPIO and SPI resources."""
@@ -0,0 +1,363 @@
+'''
+timeseries.py
+In-memory per-ID time series of received frames
+Every CAN ID gets a list of chunks, each a column of timestamps, payloads
+and lengths preallocated like RxRing: frames are written with plain
+array and bytearray stores, and readers get NumPy arrays that share the
+memory of those columns. Chunks grow from FIRST_CHUNK_FRAMES up to
+MAX_CHUNK_FRAMES, so slow IDs do not pin large buffers. Frames older than
+max_age and, when the memory budget is reached, the least recently
+written chunks are dropped a whole chunk at a time. A time range is found
+with a bisect over the chunk start times and a binary search inside the
+chunks
+'''
+import array
+import bisect
+import threading
+import time
+from collections import namedtuple
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:
+    # TimeSeriesStore needs it, the module imports without it
+    np = None
+
+from .can import CAN_EFF_FLAG, CAN_EFF_MASK, CAN_ERR_FLAG, CAN_MAX_DLEN, CAN_RTR_FLAG
+
+# Frames in the first chunk of an ID, every further chunk doubles
+FIRST_CHUNK_FRAMES = 64
+MAX_CHUNK_FRAMES = 4096
+# Default memory budget of all chunks together
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+# Storage of one frame: timestamp, payload and length
+FRAME_BYTES = 8 + CAN_MAX_DLEN + 1
+
+Window = namedtuple("Window", "timestamps data dlc")
+Window.__doc__ = """Frames of one ID in a time range.
+
+timestamps is an int64 array of time.monotonic_ns() receive times, data
+an (n, 8) uint8 array of payloads, zero past the length, and dlc a uint8
+array of payload lengths. The arrays are read-only.
+"""
+
+
+class _Chunk:
+    __slots__ = ("timestamps", "payload", "lengths", "ts", "data", "dlc", "start", "n")
+
+    def __init__(self, capacity: int) -> None:
+        # Written through the array and bytearray, read through the views
+        self.timestamps = array.array("q", bytes(8 * capacity))
+        self.payload = bytearray(CAN_MAX_DLEN * capacity)
+        self.lengths = bytearray(capacity)
+        self.ts = np.frombuffer(self.timestamps, np.int64)
+        self.data = np.frombuffer(self.payload, np.uint8).reshape(capacity, CAN_MAX_DLEN)
+        self.dlc = np.frombuffer(self.lengths, np.uint8)
+        for view in (self.ts, self.data, self.dlc):
+            view.flags.writeable = False
+        # Frames start:n are stored, the ones before start were evicted
+        self.start = 0
+        self.n = 0
+
+    @property
+    def capacity(self) -> int:
+        return len(self.lengths)
+
+    def window(self, lo: int, hi: int) -> Window:
+        return Window(self.ts[lo:hi], self.data[lo:hi], self.dlc[lo:hi])
+
+
+class _Series:
+    __slots__ = ("chunks", "firsts")
+
+    def __init__(self) -> None:
+        self.chunks = []  # type: List[_Chunk]
+        # First stored timestamp of every chunk, for bisect
+        self.firsts = []  # type: List[int]
+
+
+class TimeSeriesStore:
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES,
+                 max_age: Optional[float] = None) -> None:
+        """Per-ID time series of frames, fed from CAN_1.recv_many().
+
+        Frames are keyed by CAN ID with CAN_EFF_FLAG set for extended
+        frames, remote and error frames are not stored. Timestamps of an
+        ID must not go backwards, an earlier one is stored as the last
+        one. The store is thread safe, views returned by queries stay
+        valid after the frames were evicted.
+
+        Args:
+            max_bytes: Memory budget of the stored frames, whole chunks of
+                the least recently written IDs are dropped to stay below
+            max_age: Seconds frames are kept, measured against the newest
+                timestamp stored (default: None, until the budget is used)
+
+        Raises:
+            ImportError: NumPy is not installed
+        """
+        if np is None:
+            raise ImportError("TimeSeriesStore needs numpy")
+        if max_bytes < FIRST_CHUNK_FRAMES * FRAME_BYTES:
+            raise ValueError("max_bytes must hold at least one chunk")
+        self.max_bytes = max_bytes
+        self.max_age_ns = None if max_age is None else int(max_age * 1e9)
+        self.bytes = 0
+        self.frames = 0
+        self.evicted = 0
+        self.newest = 0
+        self._series = {}  # type: Dict[int, _Series]
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._series)
+
+    def __contains__(self, can_id: int) -> bool:
+        return can_id in self._series
+
+    def ids(self) -> List[int]:
+        """CAN IDs with stored frames, CAN_EFF_FLAG set for extended."""
+        with self._lock:
+            return sorted(self._series)
+
+    def stats(self) -> dict:
+        """IDs, stored and evicted frames and bytes allocated."""
+        with self._lock:
+            return {
+                "ids": len(self._series),
+                "frames": self.frames,
+                "evicted": self.evicted,
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    def add(self, can_id: int, data: bytes, timestamp_ns: Optional[int] = None) -> bool:
+        """Store one frame.
+
+        Args:
+            can_id: CAN ID including the EFF/RTR/ERR flags
+            data: Payload of up to 8 bytes
+            timestamp_ns: Receive time, defaults to time.monotonic_ns()
+
+        Returns:
+            False for remote and error frames, which are not stored
+        """
+        with self._lock:
+            return self._add(can_id, data,
+                             time.monotonic_ns() if timestamp_ns is None else timestamp_ns)
+
+    def add_messages(self, msgs: Iterable[Any]) -> int:
+        """Store CanMsg objects, as from CAN_1.recv_many().
+
+        Messages received without an I/O thread carry no timestamp, they
+        are stored with the current time.
+
+        Returns:
+            Number of frames stored
+        """
+        now = time.monotonic_ns()
+        stored = 0
+        with self._lock:
+            for msg in msgs:
+                stored += self._add(msg.raw_id, msg.data, msg.timestamp or now)
+        return stored
+
+    def feed(self, bus: Any, max_frames: int = 64, timeout: Optional[float] = None) -> int:
+        """Receive from a CAN_1 once and store what arrived.
+
+        Args:
+            bus: CAN_1 object
+            max_frames: Most frames taken, see CAN_1.recv_many()
+            timeout: Seconds to wait for the first frame
+
+        Returns:
+            Number of frames stored
+        """
+        _, msgs = bus.recv_many(max_frames, timeout)
+        return self.add_messages(msgs)
+
+    def _add(self, can_id: int, data: bytes, timestamp: int) -> bool:
+        if can_id & (CAN_RTR_FLAG | CAN_ERR_FLAG):
+            return False
+        key = can_id & (CAN_EFF_FLAG | CAN_EFF_MASK)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = _Series()
+        chunk = series.chunks[-1] if series.chunks else None
+        if chunk is not None and chunk.n:
+            timestamp = max(timestamp, chunk.timestamps[chunk.n - 1])
+        if chunk is None or chunk.n == chunk.capacity:
+            chunk = self._allocate(key, series, timestamp)
+        i = chunk.n
+        dlc = min(len(data), CAN_MAX_DLEN)
+        chunk.timestamps[i] = timestamp
+        chunk.payload[i * CAN_MAX_DLEN:i * CAN_MAX_DLEN + dlc] = data[:dlc]
+        chunk.lengths[i] = dlc
+        chunk.n = i + 1
+        self.frames += 1
+        if timestamp > self.newest:
+            self.newest = timestamp
+        return True
+
+    def _allocate(self, key: int, series: _Series, timestamp: int) -> _Chunk:
+        """Append a chunk to series, making room in the budget first."""
+        capacity = FIRST_CHUNK_FRAMES
+        if series.chunks:
+            capacity = min(series.chunks[-1].capacity * 2, MAX_CHUNK_FRAMES)
+        if self.max_age_ns is not None:
+            self._evict_before(max(timestamp, self.newest) - self.max_age_ns)
+        size = capacity * FRAME_BYTES
+        while self.bytes + size > self.max_bytes and self._evict_oldest_chunk(key):
+            pass
+        chunk = _Chunk(capacity)
+        series.chunks.append(chunk)
+        series.firsts.append(timestamp)
+        self.bytes += size
+        # The series may have been emptied and removed to make room
+        self._series[key] = series
+        return chunk
+
+    def _drop_chunk(self, key: int, series: _Series, index: int = 0) -> None:
+        chunk = series.chunks.pop(index)
+        del series.firsts[index]
+        self.bytes -= chunk.capacity * FRAME_BYTES
+        self.frames -= chunk.n - chunk.start
+        self.evicted += chunk.n - chunk.start
+        if not series.chunks:
+            del self._series[key]
+
+    def _evict_oldest_chunk(self, keep: int) -> bool:
+        """Drop the chunk written to least recently, never the chunk being
+        filled of ID keep. Returns False if there is nothing to drop."""
+        oldest = None
+        for key, series in self._series.items():
+            chunks = series.chunks
+            if key == keep and len(chunks) < 2:
+                continue
+            first = chunks[0]
+            last = first.timestamps[first.n - 1] if first.n else series.firsts[0]
+            if oldest is None or last < oldest[0]:
+                oldest = (last, key, series)
+        if oldest is None:
+            return False
+        self._drop_chunk(oldest[1], oldest[2])
+        return True
+
+    def _evict_before(self, cutoff: int) -> None:
+        for key, series in list(self._series.items()):
+            chunks = series.chunks
+            while chunks and chunks[0].n and chunks[0].timestamps[chunks[0].n - 1] < cutoff:
+                self._drop_chunk(key, series)
+            if chunks and series.firsts[0] < cutoff:
+                chunk = chunks[0]
+                start = chunk.start + int(np.searchsorted(chunk.ts[chunk.start:chunk.n], cutoff))
+                self.frames -= start - chunk.start
+                self.evicted += start - chunk.start
+                chunk.start = start
+                series.firsts[0] = chunk.timestamps[start]
+
+    def evict(self, now_ns: Optional[int] = None) -> None:
+        """Drop frames older than max_age now, instead of on the next chunk
+        allocation.
+
+        Args:
+            now_ns: Reference time (default: None, the newest timestamp)
+        """
+        if self.max_age_ns is None:
+            return
+        with self._lock:
+            self._evict_before((now_ns or self.newest) - self.max_age_ns)
+
+    def _locate(self, series: _Series, start_ns: Optional[int],
+                end_ns: Optional[int]) -> List[Tuple[_Chunk, int, int]]:
+        """(chunk, lo, hi) of the frames with start_ns <= timestamp < end_ns."""
+        first = 0 if start_ns is None else max(bisect.bisect_right(series.firsts, start_ns) - 1, 0)
+        stop = len(series.chunks) if end_ns is None else bisect.bisect_left(series.firsts, end_ns)
+        spans = []
+        for chunk in series.chunks[first:stop]:
+            lo, hi = chunk.start, chunk.n
+            stored = chunk.ts[lo:hi]
+            if start_ns is not None and stored[0] < start_ns:
+                lo += int(np.searchsorted(stored, start_ns))
+            if end_ns is not None and stored[-1] >= end_ns:
+                hi = chunk.start + int(np.searchsorted(stored, end_ns))
+            if lo < hi:
+                spans.append((chunk, lo, hi))
+        return spans
+
+    def chunks(self, can_id: int, start_ns: Optional[int] = None,
+               end_ns: Optional[int] = None) -> List[Window]:
+        """Frames of can_id with start_ns <= timestamp < end_ns as one
+        Window of views per chunk, without copying.
+
+        Args:
+            can_id: CAN ID, CAN_EFF_FLAG set for extended frames
+            start_ns: Start of the range (default: None, the oldest frame)
+            end_ns: End of the range (default: None, the newest frame)
+        """
+        with self._lock:
+            series = self._series.get(can_id)
+            if series is None:
+                return []
+            return [chunk.window(lo, hi) for chunk, lo, hi in self._locate(series, start_ns, end_ns)]
+
+    def range(self, can_id: int, start_ns: Optional[int] = None,
+              end_ns: Optional[int] = None) -> Window:
+        """Frames of can_id with start_ns <= timestamp < end_ns.
+
+        The arrays are views when the range lies in one chunk, which
+        covers short windows of most IDs, and concatenated otherwise. Use
+        chunks() to never copy.
+        """
+        windows = self.chunks(can_id, start_ns, end_ns)
+        if len(windows) == 1:
+            return windows[0]
+        if not windows:
+            return Window(np.zeros(0, np.int64), np.zeros((0, CAN_MAX_DLEN), np.uint8),
+                          np.zeros(0, np.uint8))
+        return Window(*(np.concatenate(column) for column in zip(*windows)))
+
+    def last(self, can_id: int, seconds: float, now_ns: Optional[int] = None) -> Window:
+        """Frames of can_id received in the last seconds, see range().
+
+        Args:
+            can_id: CAN ID, CAN_EFF_FLAG set for extended frames
+            seconds: Length of the window
+            now_ns: End of the window (default: None, time.monotonic_ns())
+        """
+        now = time.monotonic_ns() if now_ns is None else now_ns
+        return self.range(can_id, now - int(seconds * 1e9), now + 1)
+
+    def latest(self, can_id: int) -> Optional[Tuple[int, bytes]]:
+        """(timestamp_ns, data) of the newest frame of can_id, or None."""
+        with self._lock:
+            series = self._series.get(can_id)
+            if series is None:
+                return None
+            chunk = series.chunks[-1]
+            i = chunk.n - 1
+            offset = i * CAN_MAX_DLEN
+            return chunk.timestamps[i], bytes(chunk.payload[offset:offset + chunk.lengths[i]])
+
+    def downsample(self, can_id: int, interval: float, start_ns: Optional[int] = None,
+                   end_ns: Optional[int] = None) -> Window:
+        """The newest frame of every interval in a range, as copies.
+
+        Intervals are aligned to start_ns, or to the first frame. Empty
+        intervals have no entry.
+
+        Args:
+            can_id: CAN ID, CAN_EFF_FLAG set for extended frames
+            interval: Seconds per output frame
+            start_ns: Start of the range (default: None, the oldest frame)
+            end_ns: End of the range (default: None, the newest frame)
+        """
+        window = self.range(can_id, start_ns, end_ns)
+        if not len(window.timestamps):
+            return window
+        origin = window.timestamps[0] if start_ns is None else start_ns
+        buckets = (window.timestamps - origin) // int(interval * 1e9)
+        # Last frame of every bucket, buckets never decrease
+        keep = np.flatnonzero(np.append(buckets[1:] != buckets[:-1], True))
+        return Window(window.timestamps[keep], window.data[keep], window.dlc[keep])
@@ -0,0 +1,367 @@
+'''
+txsched.py
+Priority transmit scheduler for the three MCP2515 TX buffers
+Queued frames wait in a software heap ordered like bus arbitration, the
+scheduler keeps every free hardware buffer loaded and sets TXBnCTRL.TXP so
+the controller sends the loaded frames in that same order. Every frame gets
+a TxHandle that completes when CANINTF.TXnIF reports it on the bus
+'''
+import heapq
+import itertools
+import threading
+import time
+from typing import Any, Callable, List, Optional, Tuple
+
+from .can import CAN_EFF_MASK, CAN_MAX_DLEN, CAN_SFF_MASK
+from .constants import ERROR, TXBn, TXBnCTRL
+from .mcp2515 import TXB
+
+TX_BUFFERS = (TXBn.TXB2, TXBn.TXB1, TXBn.TXB0)
+TXP_LEVELS = TXBnCTRL.TXB_TXP + 1
+# How often TxHandle.wait() checks the controller when nothing else does
+TX_POLL_INTERVAL = 0.001
+# TXBnCTRL bits describing why a transmission did not complete
+TXB_FAIL_MASK = TXBnCTRL.TXB_ABTF | TXBnCTRL.TXB_MLOA | TXBnCTRL.TXB_TXERR
+
+# Orders add_done_callback() against completion, shared by all handles
+_callback_lock = threading.Lock()
+
+
+def arbitration_key(msg: Any) -> int:
+    """Sort key of a frame that matches CAN arbitration, lower wins.
+
+    The 11 bit base ID is compared first. A standard frame beats an
+    extended frame with the same base ID because SRR and IDE are
+    recessive, then the 18 bit ID extension and the RTR bit decide.
+    """
+    rtr = 1 if msg.is_remote_frame else 0
+    if msg.is_extended_id:
+        can_id = msg.can_id & CAN_EFF_MASK
+        return (can_id >> 18) << 21 | 3 << 19 | (can_id & 0x3FFFF) << 1 | rtr
+    return (msg.can_id & CAN_SFF_MASK) << 21 | rtr << 20
+
+
+class TxHandle:
+    __slots__ = (
+        "msg", "error", "ctrl", "queued_ns", "loaded_ns", "sent_ns",
+        "_event", "_callbacks", "_poll",
+    )
+
+    def __init__(self, msg: Any, poll: Optional[Callable[[], None]] = None) -> None:
+        """Result of one queued frame.
+
+        error is None while the frame is pending, then ERROR_OK once the
+        controller set TXnIF, or ERROR_FAILTX if the buffer was released
+        without TXnIF (abort, or arbitration loss and bus errors in one
+        shot mode). ctrl then holds the ABTF/MLOA/TXERR bits of TXBnCTRL.
+
+        Args:
+            msg: CanMsg object
+            poll: Called by wait() to check the controller when no I/O
+                thread is servicing it
+        """
+        self.msg = msg
+        self.error = None  # type: Optional[int]
+        self.ctrl = 0
+        self.queued_ns = time.monotonic_ns()
+        self.loaded_ns = 0
+        self.sent_ns = 0
+        self._event = threading.Event()
+        self._callbacks = []  # type: List[Callable[[TxHandle], None]]
+        self._poll = poll
+
+    def done(self) -> bool:
+        return self._event.is_set()
+
+    @property
+    def latency_ns(self) -> int:
+        """Time from send() until the completion was seen, 0 while pending.
+
+        The end is the READ STATUS that saw TXnIF, so it includes the
+        wake up latency of whoever services the controller.
+        """
+        return self.sent_ns - self.queued_ns if self.sent_ns else 0
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Block until the frame was sent or failed.
+
+        Args:
+            timeout: Seconds to wait, None waits forever (default: None)
+
+        Returns:
+            True if the handle completed, its result is in error
+        """
+        if self._poll is None:
+            return self._event.wait(timeout)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            self._poll()
+            if self._event.is_set():
+                return True
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(TX_POLL_INTERVAL)
+
+    def add_done_callback(self, fn: Callable[["TxHandle"], None]) -> None:
+        """Call fn(handle) on completion, right away if already complete.
+
+        Callbacks run on the thread that services the controller.
+        """
+        with _callback_lock:
+            if not self._event.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _complete(self, error: int, ctrl: int = 0) -> None:
+        self.error = error
+        self.ctrl = ctrl
+        self.sent_ns = time.monotonic_ns()
+        with _callback_lock:
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn(self)
+
+
+class TxScheduler:
+    def __init__(self, can: Any) -> None:
+        """Schedule frames onto the TX buffers of an MCP2515.
+
+        push() may be called from any thread. service() and reset() talk
+        to the controller and must be called with can.tx_lock held,
+        service() also runs the TxHandle callbacks.
+
+        Args:
+            can: mcp2515.CAN object
+        """
+        self.can = can
+        self._lock = threading.Lock()
+        # Heap of (key, seq, handle), seq keeps equal keys in submission order
+        self._queue = []  # type: List[Tuple[int, int, TxHandle]]
+        self._seq = itertools.count()
+        # (key, seq, txp, handle) of the frame loaded into each TX buffer
+        self._slots = [None, None, None]  # type: List[Optional[Tuple[int, int, int, TxHandle]]]
+        # TXP last written to each TXBnCTRL, so unchanged values are not rewritten
+        self._txp = [0, 0, 0]
+
+        self.queued = 0
+        self.loaded = 0
+        self.sent = 0
+        self.failed = 0
+        self.max_queue_delay_ns = 0
+        self.total_queue_delay_ns = 0
+        self.max_latency_ns = 0
+        self.total_latency_ns = 0
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    def stats(self) -> dict:
+        """Counters since creation or the last reset_stats().
+
+        Returns:
+            Dict with queued, loaded, sent and failed frame counts, the
+            frames waiting and in flight, and the max/total queue delay
+            and send latency in ns
+        """
+        return {
+            "queued": self.queued,
+            "loaded": self.loaded,
+            "sent": self.sent,
+            "failed": self.failed,
+            "waiting": len(self._queue),
+            "in_flight": self.in_flight,
+            "max_queue_delay_ns": self.max_queue_delay_ns,
+            "total_queue_delay_ns": self.total_queue_delay_ns,
+            "max_latency_ns": self.max_latency_ns,
+            "total_latency_ns": self.total_latency_ns,
+        }
+
+    def reset_stats(self) -> None:
+        # Under the lock the counters are updated with, so no count is lost
+        # or split between before and after the reset
+        with self._lock:
+            self.queued = 0
+            self.loaded = 0
+            self.sent = 0
+            self.failed = 0
+            self.max_queue_delay_ns = 0
+            self.total_queue_delay_ns = 0
+            self.max_latency_ns = 0
+            self.total_latency_ns = 0
+
+    @property
+    def free(self) -> bool:
+        """True if a TX buffer is known to be free, without any SPI access."""
+        return None in self._slots
+
+    @property
+    def in_flight(self) -> int:
+        """Frames loaded into TX buffers that have not completed yet."""
+        return 3 - self._slots.count(None)
+
+    def push(self, msg: Any, priority: Optional[int] = None,
+             poll: Optional[Callable[[], None]] = None) -> TxHandle:
+        """Queue a frame.
+
+        Args:
+            msg: CanMsg object
+            priority: Lower values are sent first, defaults to
+                arbitration_key(msg) so frames go out in bus priority order
+            poll: Passed on to the TxHandle
+
+        Returns:
+            TxHandle of the frame
+        """
+        key = arbitration_key(msg) if priority is None else priority
+        handle = TxHandle(msg, poll)
+        with self._lock:
+            heapq.heappush(self._queue, (key, next(self._seq), handle))
+            self.queued += 1
+        return handle
+
+    def reset(self) -> None:
+        """Forget the buffer state after the controller was reset.
+
+        Frames that were loaded into a TX buffer fail with ERROR_FAILTX.
+        """
+        slots = self._slots
+        self._slots = [None, None, None]
+        self._txp = [0, 0, 0]
+        for slot in slots:
+            if slot is not None:
+                with self._lock:
+                    self.failed += 1
+                slot[3]._complete(ERROR.ERROR_FAILTX)
+
+    def cancel(self) -> int:
+        """Fail every queued frame that is not in a TX buffer yet.
+
+        Returns:
+            Number of frames dropped
+        """
+        with self._lock:
+            queue, self._queue = self._queue, []
+            self.failed += len(queue)
+        for entry in queue:
+            entry[2]._complete(ERROR.ERROR_FAILTX)
+        return len(queue)
+
+    def service(self, status: int) -> int:
+        """Complete finished frames and load queued ones into free buffers.
+
+        Buffers are tracked locally, a READ STATUS value the caller already
+        has shows which loaded frames are done: TXnIF means the frame was
+        sent, TXREQ cleared without TXnIF means it was aborted or failed,
+        and only then TXBnCTRL is read for the reason. All frames loaded
+        in one call are started with a single RTS.
+
+        Args:
+            status: READ STATUS value read under the same can.tx_lock
+
+        Returns:
+            Number of frames completed and loaded
+        """
+        done = 0
+        finished = []
+        for txbn in TX_BUFFERS:
+            if status & TXB[txbn].STATTXIF:
+                done |= TXB[txbn].CANINTFTXnIF
+            slot = self._slots[txbn]
+            if slot is None or status & TXB[txbn].STATTXREQ:
+                continue
+            self._slots[txbn] = None
+            if status & TXB[txbn].STATTXIF:
+                finished.append((slot[3], ERROR.ERROR_OK, 0))
+            else:
+                ctrl = self.can.readRegister(TXB[txbn].CTRL) & TXB_FAIL_MASK
+                finished.append((slot[3], ERROR.ERROR_FAILTX, ctrl))
+        if done:
+            self.can.clearTXInterrupts(done)
+
+        loaded = []
+        max_delay = total_delay = 0
+        while self._queue and None in self._slots:
+            with self._lock:
+                key, seq = self._queue[0][:2]
+                place = self._place(key, seq, status)
+                if place is None:
+                    break
+                handle = heapq.heappop(self._queue)[2]
+            txbn, txp = place
+            if handle.msg.dlc > CAN_MAX_DLEN:
+                finished.append((handle, ERROR.ERROR_FAILTX, 0))
+                continue
+
+            self.can.loadTxBuffer(handle.msg, txbn, None if txp == self._txp[txbn] else txp)
+            self._txp[txbn] = txp
+            self._slots[txbn] = (key, seq, txp, handle)
+            loaded.append(txbn)
+
+            handle.loaded_ns = time.monotonic_ns()
+            delay = handle.loaded_ns - handle.queued_ns
+            total_delay += delay
+            if delay > max_delay:
+                max_delay = delay
+
+        if loaded:
+            self.can.requestToSend(*loaded)
+
+        # Completions run last, a callback may queue the next frame
+        failed = max_latency = total_latency = 0
+        for handle, error, ctrl in finished:
+            handle._complete(error, ctrl)
+            if error != ERROR.ERROR_OK:
+                failed += 1
+                continue
+            latency = handle.latency_ns
+            total_latency += latency
+            if latency > max_latency:
+                max_latency = latency
+
+        if loaded or finished:
+            with self._lock:
+                self.loaded += len(loaded)
+                self.total_queue_delay_ns += total_delay
+                self.max_queue_delay_ns = max(self.max_queue_delay_ns, max_delay)
+                self.sent += len(finished) - failed
+                self.failed += failed
+                self.total_latency_ns += total_latency
+                self.max_latency_ns = max(self.max_latency_ns, max_latency)
+        return len(finished) + len(loaded)
+
+    def _place(self, key: int, seq: int, status: int) -> Optional[Tuple[int, int]]:
+        """Pick a free buffer and TXP for the next frame.
+
+        The controller sends the highest TXP first and the highest buffer
+        number among equal TXP, so (txp, txbn) is the send rank. Frames
+        with the same key must keep their order, if no free rank sits below
+        the loaded ones the frame waits. Otherwise the rank that puts the
+        most loaded frames in arbitration order wins, highest first.
+
+        Returns:
+            Tuple with (txbn, txp), or None if the frame has to wait
+        """
+        loaded = [
+            (slot[0], slot[1], (slot[2], txbn))
+            for txbn, slot in enumerate(self._slots) if slot is not None
+        ]
+        best = None
+        best_score = -1
+        for txp in range(TXP_LEVELS - 1, -1, -1):
+            for txbn in TX_BUFFERS:
+                if self._slots[txbn] is not None or status & TXB[txbn].STATTXREQ:
+                    continue
+                rank = (txp, txbn)
+                score = 0
+                for other_key, other_seq, other_rank in loaded:
+                    before = (other_key, other_seq) < (key, seq)
+                    if before == (other_rank > rank):
+                        score += 1
+                    elif other_key == key:
+                        break
+                else:
+                    if score > best_score:
+                        best, best_score = (txbn, txp), score
+        return best
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+'''
+rpi4-can-dual-receive.py
+Example for dual CAN HATs, two MCP2515 controllers on CE0 and CE1 of SPI0
+serviced by one shared I/O thread
+'''
+import sys
+import time
+from can_driver import CAN_1, CanError, CanGroup, CAN_SPEED, CAN_CLOCK
+
+SPI0_CE0_PIN = 8
+SPI0_CE1_PIN = 7
+# GPIOs wired to the INT outputs of the two controllers, set to None to poll
+CAN0_INT_PIN = 25
+CAN1_INT_PIN = 24
+
+# Setup
+buses = [
+    CAN_1(board="RaspberryPi4", spics=SPI0_CE0_PIN, int_pin=CAN0_INT_PIN),
+    CAN_1(board="RaspberryPi4", spics=SPI0_CE1_PIN, int_pin=CAN1_INT_PIN),
+]
+for n, can in enumerate(buses):
+    ret = can.begin(bitrate=CAN_SPEED.CAN_500KBPS, canclock=CAN_CLOCK.MCP_16MHZ)
+    if ret != CanError.ERROR_OK:
+        print("Error initializing can%d!" % n)
+        sys.exit(1)
+print("Initialized successfully!")
+
+
+def printer(n):
+    def on_message(msg):
+        print("can%d  %#x  [%d]  %s" % (n, msg.can_id, msg.dlc, msg.data.hex()))
+    return on_message
+
+
+# One thread services both controllers, messages are delivered per bus
+group = CanGroup()
+for n, can in enumerate(buses):
+    group.add(can, on_message=printer(n))
+
+print("Waiting for CAN messages...")
+try:
+    while True:
+        time.sleep(1)
+except KeyboardInterrupt:
+    print("\nExiting...")
+finally:
+    # Clean up
+    group.close()
+    for can in buses:
+        can.cleanup()
+    print("CAN interfaces closed")
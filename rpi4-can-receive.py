@@ -9,14 +9,15 @@ Date: March 16th, 2025
 A simple example to receive data from CAN bus on Raspberry Pi 4
 '''
 import sys
-import time
 from can_driver import CAN_1, CanError, CAN_SPEED, CAN_CLOCK
 
 SPI0_CE0_PIN = 8
 SPI0_CE1_PIN = 7
+# GPIO wired to the MCP2515 INT output, set to None to poll the controller
+CAN_INT_PIN = 25
 
 # Setup
-can = CAN_1(board="RaspberryPi4", spics=SPI0_CE0_PIN) 
+can = CAN_1(board="RaspberryPi4", spics=SPI0_CE0_PIN, int_pin=CAN_INT_PIN)
 
 # Initialize - default 250kbps @ CAN module crystal frequency = 8MHz, change if network uses a different baudrate
 # or module uses a different crystal clk source
@@ -30,17 +31,14 @@ print("Initialized successfully!")
 print("Waiting for CAN messages...")
 try:
     while True:
-        if can.checkReceive():
-            error, msg = can.recv()
-            if error == CanError.ERROR_OK:
-                print('------------------------------')
-                print("CAN ID: %#x" % msg.can_id)
-                print("Is RTR frame:", msg.is_remote_frame)
-                print("Is EFF frame:", msg.is_extended_id)
-                print("CAN data hex:", msg.data.hex())
-                print("CAN data dlc:", msg.dlc)
-        else:
-            time.sleep(0.1)
+        error, msg = can.recv(timeout=1.0)
+        if error == CanError.ERROR_OK:
+            print('------------------------------')
+            print("CAN ID: %#x" % msg.can_id)
+            print("Is RTR frame:", msg.is_remote_frame)
+            print("Is EFF frame:", msg.is_extended_id)
+            print("CAN data hex:", msg.data.hex())
+            print("CAN data dlc:", msg.dlc)
 except KeyboardInterrupt:
     print("\nExiting...")
 finally:
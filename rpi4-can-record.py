@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+'''
+rpi4-can-record.py
+Record all CAN traffic to a binary capture file on Raspberry Pi 4
+Convert it to text afterwards with
+    python3 -m can_driver.capture capture.cancap --format candump
+'''
+import sys
+import time
+from can_driver import CAN_1, CanError, CAN_SPEED, CAN_CLOCK
+from can_driver.capture import CaptureRecorder
+
+SPI0_CE0_PIN = 8
+# GPIO wired to the MCP2515 INT output, set to None to poll the controller
+CAN_INT_PIN = 25
+CAPTURE_FILE = sys.argv[1] if len(sys.argv) > 1 else "capture.cancap"
+
+# A large receive ring absorbs disk stalls on a busy bus
+can = CAN_1(board="RaspberryPi4", spics=SPI0_CE0_PIN, int_pin=CAN_INT_PIN, rx_ring_size=16384)
+
+ret = can.begin(bitrate=CAN_SPEED.CAN_500KBPS, canclock=CAN_CLOCK.MCP_16MHZ)
+if ret != CanError.ERROR_OK:
+    print("Error initializing CAN!")
+    sys.exit(1)
+
+# 64 MiB files, the newest 10 are kept
+recorder = CaptureRecorder(can, CAPTURE_FILE, max_bytes=64 << 20, max_files=10)
+recorder.start()
+print("Recording to %s, Ctrl+C to stop" % CAPTURE_FILE)
+try:
+    while True:
+        time.sleep(1)
+        stats = recorder.stats()
+        print("%d frames, %d lost" % (stats["recorded"], stats["ring_lost"]))
+except KeyboardInterrupt:
+    print("\nExiting...")
+finally:
+    recorder.stop()
+    can.cleanup()
+    print("Files:", ", ".join(recorder.writer.paths))